@@ -4,12 +4,49 @@ const axiosInstance = axios.create({
   baseURL: "http://localhost:8000/api",
 });
 
+// Last response per GET url, replayed when the server answers 304 Not Modified.
+const etagCache = new Map();
+
 axiosInstance.interceptors.request.use((config) => {
   const token = localStorage.getItem("token");
   if (token) {
     config.headers.Authorization = `Bearer ${token}`;
   }
+  if ((config.method || "get").toLowerCase() === "get") {
+    const cached = etagCache.get(`${token}:${axiosInstance.getUri(config)}`);
+    if (cached) {
+      config.headers["If-None-Match"] = cached.etag;
+    }
+    config.validateStatus = (status) => (status >= 200 && status < 300) || status === 304;
+  }
   return config;
 });
 
+axiosInstance.interceptors.response.use((response) => {
+  if ((response.config.method || "get").toLowerCase() !== "get") return response;
+  const key = `${localStorage.getItem("token")}:${axiosInstance.getUri(response.config)}`;
+  if (response.status === 304) {
+    const cached = etagCache.get(key);
+    if (cached) {
+      return { ...response, status: 200, data: cached.data, headers: { ...cached.headers, ...response.headers } };
+    }
+  } else if (response.headers.etag) {
+    etagCache.set(key, { etag: response.headers.etag, data: response.data, headers: response.headers });
+  }
+  return response;
+});
+
+// Every page of a keyset-paginated list: follows X-Next-Cursor until the last page.
+export const fetchAll = async (url, config = {}) => {
+  const items = [];
+  let cursor;
+  do {
+    const params = { ...config.params, limit: 500, ...(cursor ? { cursor } : {}) };
+    const res = await axiosInstance.get(url, { ...config, params });
+    items.push(...res.data);
+    cursor = res.headers["x-next-cursor"];
+  } while (cursor);
+  return items;
+};
+
 export default axiosInstance;
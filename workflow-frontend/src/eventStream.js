@@ -0,0 +1,58 @@
+import axiosInstance from "./axiosInstance";
+
+const RECONNECT_DELAY = 5000;
+
+// Subscribes to /api/stream/ (Server-Sent Events, served by the ASGI app).
+// `handlers` maps event names ("inbox", "submission", "reset") to callbacks that
+// receive the parsed data. Returns a function that closes the stream.
+//
+// EventSource cannot send the Authorization header and the access token must not
+// go in a URL, so every connection opens with a short-lived ticket from
+// POST /api/stream/ticket/. Tickets expire, so instead of letting EventSource retry
+// the same URL we reconnect ourselves with a new one, resuming from the last event.
+const subscribeToUpdates = (handlers) => {
+  if (!localStorage.getItem("token") || typeof EventSource === "undefined") return () => {};
+
+  let source = null;
+  let retry = null;
+  let lastEventId = null;
+  let closed = false;
+
+  const reconnect = () => {
+    if (!closed) retry = setTimeout(connect, RECONNECT_DELAY);
+  };
+
+  const connect = async () => {
+    let ticket;
+    try {
+      ticket = (await axiosInstance.post("/stream/ticket/")).data.ticket;
+    } catch (error) {
+      if (error.response?.status !== 401) reconnect();
+      return;
+    }
+    if (closed) return;
+
+    const params = new URLSearchParams({ ticket });
+    if (lastEventId) params.set("last_event_id", lastEventId);
+    source = new EventSource(`${axiosInstance.defaults.baseURL}/stream/?${params}`);
+    Object.entries(handlers).forEach(([event, handler]) => {
+      source.addEventListener(event, (e) => {
+        if (e.lastEventId) lastEventId = e.lastEventId;
+        handler(JSON.parse(e.data));
+      });
+    });
+    source.onerror = () => {
+      source.close();
+      reconnect();
+    };
+  };
+
+  connect();
+  return () => {
+    closed = true;
+    clearTimeout(retry);
+    if (source) source.close();
+  };
+};
+
+export default subscribeToUpdates;
@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from "react";
-import axios from "../axiosInstance";
+import axios, { fetchAll } from "../axiosInstance";
 
 const AdminDashboard = () => {
   const [templates, setTemplates] = useState([]);
@@ -16,13 +16,11 @@ const AdminDashboard = () => {
   }, []);
 
   const fetchTemplates = async () => {
-    const res = await axios.get("/form-templates/");
-    setTemplates(res.data);
+    setTemplates(await fetchAll("/form-templates/"));
   };
 
   const fetchWorkflows = async () => {
-    const res = await axios.get("/workflows/");
-    setWorkflows(res.data);
+    setWorkflows(await fetchAll("/workflows/"));
   };
 
   const handleAddField = () => {
@@ -1,19 +1,50 @@
-import React, { useEffect, useState } from "react";
-import axios from "../axiosInstance";
+import React, { useEffect, useRef, useState } from "react";
+import axios, { fetchAll } from "../axiosInstance";
+import subscribeToUpdates from "../eventStream";
 
 const ApproverDashboard = () => {
   const [pendingSubmissions, setPendingSubmissions] = useState([]);
   const [selectedSubmission, setSelectedSubmission] = useState(null);
   const [nextState, setNextState] = useState("");
   const [availableTransitions, setAvailableTransitions] = useState([]);
+  const [selectedIds, setSelectedIds] = useState([]);
+  const [bulkState, setBulkState] = useState("");
+  const refetch = useRef(null);
 
   useEffect(() => {
     fetchPending();
+    const unsubscribe = subscribeToUpdates({
+      inbox: ({ submission_id, action }) => {
+        if (action === "removed") {
+          setPendingSubmissions((subs) => subs.filter((sub) => sub.submission.id !== submission_id));
+        } else {
+          schedulePending();
+        }
+      },
+      reset: () => schedulePending(),
+    });
+    return () => {
+      unsubscribe();
+      clearTimeout(refetch.current);
+    };
   }, []);
 
+  // Inbox events arrive in bursts: refetch once they settle rather than once per event.
+  const schedulePending = (delay = 500) => {
+    clearTimeout(refetch.current);
+    refetch.current = setTimeout(fetchPending, delay);
+  };
+
   const fetchPending = async () => {
-    const res = await axios.get("/pending-approvals/");
-    setPendingSubmissions(res.data);
+    try {
+      setPendingSubmissions(await fetchAll("/pending-approvals/"));
+    } catch (error) {
+      const status = error.response?.status;
+      if (status === 429 || status === 503) {
+        // Throttled or shed: try again when the server says to.
+        schedulePending((Number(error.response.headers["retry-after"]) || 1) * 1000);
+      }
+    }
   };
 
   const selectSubmission = async (submission) => {
@@ -28,6 +59,7 @@ const ApproverDashboard = () => {
       const res = await axios.post("/transition/", {
         submission_id: selectedSubmission.submission.id,
         next_state: nextState,
+        expected_state: selectedSubmission.current_state,
       });
       alert("Transitioned successfully");
       setSelectedSubmission(null);
@@ -35,6 +67,40 @@ const ApproverDashboard = () => {
       fetchPending();
     } catch (error) {
       alert(error.response?.data?.error || "Error transitioning workflow");
+      if (error.response?.status === 409) {
+        setSelectedSubmission(null);
+        fetchPending();
+      }
+    }
+  };
+
+  const toggleSelected = (id) => {
+    setSelectedIds(
+      selectedIds.includes(id) ? selectedIds.filter((s) => s !== id) : [...selectedIds, id]
+    );
+  };
+
+  const handleBulkTransition = async () => {
+    if (!bulkState) return alert("Please enter the next state for the selected submissions");
+    const items = pendingSubmissions
+      .filter((sub) => selectedIds.includes(sub.submission.id))
+      .map((sub) => ({
+        submission_id: sub.submission.id,
+        next_state: bulkState,
+        expected_state: sub.current_state,
+      }));
+    try {
+      const res = await axios.post("/transitions/bulk/", items);
+      const failed = res.data.results.filter((r) => r.status !== "ok");
+      alert(
+        `${items.length - failed.length} of ${items.length} submissions updated` +
+          (failed.length ? `\n${failed.map((r) => `#${r.submission_id}: ${r.status}`).join("\n")}` : "")
+      );
+      setSelectedIds([]);
+      setBulkState("");
+      fetchPending();
+    } catch (error) {
+      alert(error.response?.data?.error || "Error transitioning workflows");
     }
   };
 
@@ -45,8 +111,31 @@ const ApproverDashboard = () => {
       <div className="grid grid-cols-2 gap-4">
         <div>
           <h3 className="font-semibold mb-2">Pending Submissions</h3>
+          {selectedIds.length > 0 && (
+            <div className="border p-2 mb-2 bg-gray-100">
+              <input
+                placeholder="Next state for selected"
+                value={bulkState}
+                onChange={(e) => setBulkState(e.target.value)}
+                className="border p-1 mr-2"
+              />
+              <button
+                className="bg-green-600 text-white px-2 py-1 rounded"
+                onClick={handleBulkTransition}
+              >
+                Approve selected ({selectedIds.length})
+              </button>
+            </div>
+          )}
           {pendingSubmissions.map((sub) => (
             <div key={sub.id} className="border p-2 mb-2">
+              <label className="float-right">
+                <input
+                  type="checkbox"
+                  checked={selectedIds.includes(sub.submission.id)}
+                  onChange={() => toggleSelected(sub.submission.id)}
+                />
+              </label>
               <div className="font-bold">{sub.submission.form_template_details.name}</div>
               <div>Submitted by: {sub.submission.submitted_by}</div>
               <div>Current State: {sub.current_state}</div>
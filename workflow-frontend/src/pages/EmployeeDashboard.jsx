@@ -1,5 +1,6 @@
 import React, { useEffect, useState } from "react";
-import axios from "../axiosInstance";
+import axios, { fetchAll } from "../axiosInstance";
+import subscribeToUpdates from "../eventStream";
 
 const EmployeeDashboard = () => {
   const [templates, setTemplates] = useState([]);
@@ -10,18 +11,28 @@ const EmployeeDashboard = () => {
   useEffect(() => {
     fetchTemplates();
     fetchSubmissions();
+    return subscribeToUpdates({
+      submission: ({ submission_id, current_state, partial_approvals }) =>
+        setSubmissions((subs) =>
+          subs.map((sub) =>
+            sub.submission.id === submission_id ? { ...sub, current_state, partial_approvals } : sub
+          )
+        ),
+      reset: () => fetchSubmissions(),
+    });
   }, []);
 
   const fetchTemplates = async () => {
-    const res = await axios.get("/form-templates/");
-    setTemplates(res.data);
+    setTemplates(await fetchAll("/form-templates/"));
   };
 
   const fetchSubmissions = async () => {
-    const res = await axios.get("/my-submissions/");
-    setSubmissions(res.data);
+    // Templates are already loaded above, so ask for them by reference only
+    setSubmissions(await fetchAll("/my-submissions/", { params: { expand: "" } }));
   };
 
+  const templateName = (id) => templates.find((tpl) => tpl.id === id)?.name || `Template #${id}`;
+
   const handleSelectTemplate = (template) => {
     setSelectedTemplate(template);
     setFormData({});
@@ -90,7 +101,7 @@ const EmployeeDashboard = () => {
         <h3 className="font-semibold mb-2">My Submissions</h3>
         {submissions.map((sub, index) => (
           <div key={index} className="border p-2 mb-2">
-            <div className="font-bold">{sub.submission.form_template_details.name}</div>
+            <div className="font-bold">{templateName(sub.submission.form_template)}</div>
             <div>Submitted At: {new Date(sub.submission.submitted_at).toLocaleString()}</div>
             <div>Current State: {sub.current_state}</div>
           </div>
@@ -0,0 +1,280 @@
+"""Workflow analytics: instances per state and time spent in each state.
+
+Answering these from the live tables would mean a GROUP BY over every
+instance and a scan of the event log. Instead ``fold`` (run periodically by
+``manage.py fold_analytics``) adds what happened since its previous run to
+small rollup tables:
+
+* ``StateCount``: instances per template and state, from new instances and
+  ``transitioned`` events;
+* ``TransitionRollup``: per template, transition and hour, how many
+  transitions were made and a ``DurationSketch`` of how long the instances
+  had been in ``from_state``.
+
+Folding stays out of the approval path, so concurrent transitions never wait
+on shared counter rows. Rows younger than ``WORKFLOW_ANALYTICS_LAG_SECONDS``
+are left for the next fold, so the id watermark does not skip a transaction
+that commits late. ``report`` reads the counts and merges the sketches of
+the requested hours; its cost depends on the window, not on history size.
+
+``rebuild`` recounts ``StateCount`` from the instances' current states and
+moves the watermark past every existing row, for instances that moved
+before the event log existed.
+"""
+import math
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .models import (
+    AnalyticsWatermark, ArchivedEvent, ArchivedInstance, StateCount, TransitionRollup, WorkflowDefinition,
+    WorkflowEvent, WorkflowInstance,
+)
+from .state_machine import get_compiled_version
+
+ALPHA = 0.02  # relative error of sketch quantiles
+QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_WINDOW = timedelta(days=30)
+
+
+class DurationSketch:
+    """Mergeable quantile sketch (DDSketch) of durations in seconds.
+
+    Durations fall in logarithmic buckets, so every quantile is within
+    ``ALPHA`` of the true value and two sketches merge by adding bucket counts.
+    """
+
+    gamma = (1 + ALPHA) / (1 - ALPHA)
+    min_seconds = 0.001  # shorter durations share the lowest bucket
+
+    def __init__(self, buckets=None):
+        self.buckets = {int(key): count for key, count in (buckets or {}).items()}
+
+    def add(self, seconds):
+        key = math.ceil(math.log(max(seconds, self.min_seconds), self.gamma))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def quantile(self, q):
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return None
+
+    def to_json(self):
+        return {str(key): count for key, count in self.buckets.items()}
+
+
+def _older_than(rows, cutoff, at):
+    """The leading ``rows`` whose ``row[at]`` is before ``cutoff``, and whether any were cut."""
+    for n, row in enumerate(rows):
+        if row[at] >= cutoff:
+            return rows[:n], True
+    return rows, False
+
+
+def _save_counts(counts):
+    counts = {key: delta for key, delta in counts.items() if delta}
+    if not counts:
+        return
+    existing = {
+        (row.form_template_id, row.state): row
+        for row in StateCount.objects.filter(form_template_id__in={template_id for template_id, _ in counts})
+    }
+    changed, new = [], []
+    for (template_id, state), delta in counts.items():
+        row = existing.get((template_id, state))
+        if row is None:
+            new.append(StateCount(form_template_id=template_id, state=state, count=delta))
+        else:
+            row.count += delta
+            changed.append(row)
+    StateCount.objects.bulk_update(changed, ['count'])
+    StateCount.objects.bulk_create(new)
+
+
+def _save_rollups(rollups):
+    existing = {
+        (row.form_template_id, row.from_state, row.to_state, row.hour): row
+        for row in TransitionRollup.objects.filter(
+            form_template_id__in={key[0] for key in rollups}, hour__in={key[3] for key in rollups}
+        )
+    }
+    changed, new = [], []
+    for key, (count, total, sketch) in rollups.items():
+        row = existing.get(key)
+        if row is None:
+            template_id, from_state, to_state, hour = key
+            new.append(TransitionRollup(form_template_id=template_id, from_state=from_state, to_state=to_state,
+                                        hour=hour, count=count, total_seconds=total, sketch=sketch.to_json()))
+        else:
+            merged = DurationSketch(row.sketch)
+            merged.merge(sketch)
+            row.count, row.total_seconds, row.sketch = row.count + count, row.total_seconds + total, merged.to_json()
+            changed.append(row)
+    TransitionRollup.objects.bulk_update(changed, ['count', 'total_seconds', 'sketch'])
+    TransitionRollup.objects.bulk_create(new)
+
+
+def fold(batch_size=5000, now=None):
+    """Fold up to ``batch_size`` new instances and transitions into the rollups.
+
+    One transaction, serialised with other folds by locking the watermark.
+    Returns the number of rows folded; 0 once caught up.
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=settings.WORKFLOW_ANALYTICS_LAG_SECONDS)
+    with transaction.atomic():
+        watermark, _ = AnalyticsWatermark.objects.select_for_update().get_or_create(id=1)
+        counts = Counter()
+
+        instances = list(
+            WorkflowInstance.objects.filter(id__gt=watermark.last_instance_id).order_by('id')
+            .values_list('id', 'workflow_version_id', 'submission__form_template_id', 'submission__submitted_at')
+            [:batch_size]
+        )
+        fetched = len(instances)
+        instances, cut = _older_than(instances, cutoff, 3)
+        instances_done = cut or fetched < batch_size
+        for instance_id, version_id, template_id, _ in instances:
+            try:
+                counts[template_id, get_compiled_version(version_id).initial_state] += 1
+            except WorkflowDefinition.DoesNotExist:
+                pass
+        if instances:
+            watermark.last_instance_id = instances[-1][0]
+
+        events = list(
+            WorkflowEvent.objects.filter(id__gt=watermark.last_event_id, kind=WorkflowEvent.TRANSITIONED)
+            .order_by('id').values_list('id', 'instance_id', 'instance__submission__form_template_id',
+                                        'instance__submission__submitted_at', 'from_state', 'to_state', 'created_at',
+                                        'instance__workflow_version_id')
+            [:batch_size]
+        )
+        fetched = len(events)
+        events, cut = _older_than(events, cutoff, 6)
+        events_done = cut or fetched < batch_size
+        if events:
+            # When each instance entered the state it leaves: its previous transition, else its submission.
+            entered = dict(
+                WorkflowEvent.objects.filter(
+                    instance_id__in={event[1] for event in events}, kind=WorkflowEvent.TRANSITIONED,
+                    id__lt=events[0][0],
+                ).values('instance_id').annotate(at=Max('created_at')).values_list('instance_id', 'at')
+            )
+            rollups = {}
+            for _, instance_id, template_id, submitted_at, from_state, to_state, created_at, version_id in events:
+                seconds = max((created_at - entered.get(instance_id, submitted_at)).total_seconds(), 0)
+                entered[instance_id] = created_at
+                key = (template_id, from_state, to_state, created_at.replace(minute=0, second=0, microsecond=0))
+                count, total, sketch = rollups.get(key) or (0, 0.0, DurationSketch())
+                sketch.add(seconds)
+                rollups[key] = (count + 1, total + seconds, sketch)
+                if version_id is not None:  # unversioned instances were never counted into a state, see above
+                    counts[template_id, from_state] -= 1
+                    counts[template_id, to_state] += 1
+            _save_rollups(rollups)
+            watermark.last_event_id = events[-1][0]
+
+        _save_counts(counts)
+        if instances_done and events_done:
+            watermark.folded_until = cutoff
+        watermark.save()
+    return len(instances) + len(events)
+
+
+def _max_id(*querysets):
+    return max((queryset.aggregate(top=Max('id'))['top'] or 0 for queryset in querysets), default=0)
+
+
+def rebuild(now=None):
+    """Recount instances per state from their current state and fold only what comes after.
+
+    Instances, live and archived, are counted where they are now, and the
+    watermark moves past every existing instance and event, so folding goes
+    on from that snapshot. Durations of the transitions already made are not
+    rolled up. Run it while no transitions are being made, e.g. right after
+    migrating. Returns the number of instances counted.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        watermark, _ = AnalyticsWatermark.objects.select_for_update().get_or_create(id=1)
+        counts = Counter()
+        for queryset, template in ((WorkflowInstance.objects, 'submission__form_template_id'),
+                                   (ArchivedInstance.objects, 'form_template_id')):
+            # Like fold: instances without a version are not counted.
+            rows = (queryset.filter(workflow_version__isnull=False).order_by()
+                    .values_list(template, 'current_state').annotate(n=Count('pk')))
+            for template_id, state, n in rows:
+                counts[template_id, state] += n
+        StateCount.objects.all().delete()
+        _save_counts(counts)
+        watermark.last_instance_id = max(_max_id(WorkflowInstance.objects),
+                                         ArchivedInstance.objects.aggregate(top=Max('instance_id'))['top'] or 0)
+        watermark.last_event_id = _max_id(WorkflowEvent.objects, ArchivedEvent.objects)
+        watermark.folded_until = now
+        watermark.save()
+    return sum(counts.values())
+
+
+def report(form_template_id=None, since=None, until=None):
+    """Instances per state, and transition counts and durations between ``since`` and ``until``.
+
+    Durations are bucketed by hour, so ``since`` is rounded down to the hour.
+    """
+    until = until or timezone.now()
+    since = (since or until - DEFAULT_WINDOW).replace(minute=0, second=0, microsecond=0)
+    counts = StateCount.objects.exclude(count=0)
+    rollups = TransitionRollup.objects.filter(hour__gte=since, hour__lt=until)
+    if form_template_id is not None:
+        counts = counts.filter(form_template_id=form_template_id)
+        rollups = rollups.filter(form_template_id=form_template_id)
+
+    templates = {}
+
+    def template(template_id, name):
+        if template_id not in templates:
+            templates[template_id] = {'form_template': template_id, 'name': name, 'states': {}, 'transitions': {}}
+        return templates[template_id]
+
+    for template_id, name, state, count in counts.values_list(
+            'form_template_id', 'form_template__name', 'state', 'count').order_by('form_template_id', 'state'):
+        template(template_id, name)['states'][state] = count
+    for template_id, name, from_state, to_state, count, total, buckets in rollups.values_list(
+            'form_template_id', 'form_template__name', 'from_state', 'to_state', 'count', 'total_seconds', 'sketch'):
+        edge = template(template_id, name)['transitions'].setdefault(
+            (from_state, to_state), {'count': 0, 'total': 0.0, 'sketch': DurationSketch()}
+        )
+        edge['count'] += count
+        edge['total'] += total
+        edge['sketch'].merge(DurationSketch(buckets))
+
+    for entry in templates.values():
+        entry['transitions'] = [
+            {
+                'from_state': from_state, 'to_state': to_state, 'count': edge['count'],
+                'mean_seconds': edge['total'] / edge['count'],
+                **{f'p{round(q * 100)}_seconds': edge['sketch'].quantile(q) for q in QUANTILES},
+            }
+            for (from_state, to_state), edge in sorted(entry['transitions'].items())
+        ]
+    return {
+        'as_of': AnalyticsWatermark.objects.filter(id=1).values_list('folded_until', flat=True).first(),
+        'since': since,
+        'until': until,
+        'templates': [templates[template_id] for template_id in sorted(templates)],
+    }
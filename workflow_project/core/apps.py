@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db.backends.signals import connection_created
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        if getattr(settings, 'WORKFLOW_METRICS_ENABLED', True):
+            from .metrics import install_query_recorder
+            connection_created.connect(install_query_recorder, dispatch_uid='core.metrics.install_query_recorder')
+
+        from .db import check_connections, mark_idle
+        request_started.connect(check_connections, dispatch_uid='core.db.check_connections')
+        request_finished.connect(mark_idle, dispatch_uid='core.db.mark_idle')
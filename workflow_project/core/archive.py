@@ -0,0 +1,53 @@
+"""Moving closed workflow instances out of the live tables.
+
+An instance is closed (``is_open`` false) once it reaches a terminal state,
+one with no outgoing transitions. ``archive_batch`` copies closed instances
+last changed before a cutoff, with their submission and events, into
+``ArchivedInstance`` and ``ArchivedEvent`` and deletes the live rows, one
+batch per transaction. Batches come off the front of the partial index on
+closed instances, so an interrupted run simply resumes: what was archived is
+no longer there to pick.
+"""
+from django.db import transaction
+
+from .models import ArchivedEvent, ArchivedInstance, FormSubmission, WorkflowEvent, WorkflowInstance
+
+_INSTANCE_FIELDS = (
+    'id', 'submission_id', 'submission__form_template_id', 'workflow_version_id', 'submission__submitted_by',
+    'submission__data', 'submission__submitted_at', 'current_state', 'partial_approvals', 'escalations',
+    'updated_at',
+)
+_EVENT_FIELDS = ('id', 'instance_id', 'kind', 'actor', 'roles', 'from_state', 'to_state', 'created_at')
+
+
+def archive_batch(before, batch_size=1000):
+    """Archive up to ``batch_size`` instances closed before ``before``. Returns how many."""
+    with transaction.atomic():
+        rows = list(
+            WorkflowInstance.objects.select_for_update(of=('self',))
+            .filter(is_open=False, updated_at__lt=before).order_by('updated_at', 'id')
+            .values_list(*_INSTANCE_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0
+        submission_of = {row[0]: row[1] for row in rows}
+        ArchivedInstance.objects.bulk_create([
+            ArchivedInstance(
+                instance_id=instance_id, submission_id=submission_id, form_template_id=form_template_id,
+                workflow_version_id=version_id, submitted_by=submitted_by, data=data, submitted_at=submitted_at,
+                current_state=state, partial_approvals=partial_approvals, escalations=escalations,
+                updated_at=updated_at,
+            )
+            for (instance_id, submission_id, form_template_id, version_id, submitted_by, data, submitted_at,
+                 state, partial_approvals, escalations, updated_at) in rows
+        ])
+        events = WorkflowEvent.objects.filter(instance_id__in=list(submission_of)).values_list(*_EVENT_FIELDS)
+        ArchivedEvent.objects.bulk_create([
+            ArchivedEvent(id=event_id, instance_id=submission_of[instance_id], kind=kind, actor=actor, roles=roles,
+                          from_state=from_state, to_state=to_state, created_at=created_at)
+            for event_id, instance_id, kind, actor, roles, from_state, to_state, created_at in events.iterator()
+        ], batch_size=1000)
+        # Cascades to the instances and their events, inbox entries and timers.
+        FormSubmission.objects.filter(id__in=list(submission_of.values())).delete()
+    return len(rows)
+
@@ -1,7 +1,12 @@
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
 from rest_framework.response import Response
 from rest_framework import status
 from functools import wraps
-from .keycloak import decode_token
+from ..db import pin_to_primary
+from ..metrics import timed
+from ..throttling import admit, release_when_sent, throttled
+from .keycloak import adecode_token, decode_token
 
 def keycloak_required(required_roles=None):
     def decorator(func):
@@ -14,7 +19,8 @@ def keycloak_required(required_roles=None):
             token = auth_header.split()[1]
 
             try:
-                payload = decode_token(token)
+                with timed('auth'):
+                    payload = decode_token(token)
                 request.user_info = payload  # Inject user info into request
 
                 if required_roles:
@@ -25,6 +31,54 @@ def keycloak_required(required_roles=None):
             except Exception as e:
                 return Response({"detail": f"Token error: {str(e)}"}, status=401)
 
-            return func(request, *args, **kwargs)
+            retry_after, release = admit(request, payload)
+            if release is None:
+                return Response(throttled(retry_after), status=429, headers={'Retry-After': str(retry_after)})
+            try:
+                response = func(request, *args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            release_when_sent(response, release)
+            if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+                pin_to_primary(payload)  # let the writer read its own write while replicas catch up
+            return response
+        return wrapper
+    return decorator
+
+def async_keycloak_required(required_roles=None):
+    """``keycloak_required`` for async views; the token is verified without blocking the event loop."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(request, *args, **kwargs):
+            auth_header = request.headers.get('Authorization')
+            if not auth_header or not auth_header.startswith('Bearer '):
+                return JsonResponse({"detail": "Missing or invalid token"}, status=401)
+
+            token = auth_header.split()[1]
+
+            try:
+                with timed('auth'):
+                    payload = await adecode_token(token)
+                request.user_info = payload
+
+                if required_roles:
+                    user_roles = payload.get("realm_access", {}).get("roles", [])
+                    if not any(role in user_roles for role in required_roles):
+                        return JsonResponse({"detail": "Forbidden: Insufficient role"}, status=403)
+
+            except Exception as e:
+                return JsonResponse({"detail": f"Token error: {str(e)}"}, status=401)
+
+            # Throttle state lives in a cache, which may be a network round trip: keep it off the event loop.
+            retry_after, release = await sync_to_async(admit)(request, payload)
+            if release is None:
+                return JsonResponse(throttled(retry_after), status=429, headers={'Retry-After': str(retry_after)})
+            try:
+                response = await func(request, *args, **kwargs)
+            except BaseException:
+                await sync_to_async(release)()
+                raise
+            return await sync_to_async(release_when_sent)(response, release)
         return wrapper
     return decorator
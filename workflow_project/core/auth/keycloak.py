@@ -1,16 +1,249 @@
-from jose import jwt
+import asyncio
+import logging
+import threading
+import time
+
 import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from jose import jwk, jwt
+from jose.exceptions import JWTError
+
+from ..metrics import JWKS_FETCH
+from .token_cache import VerifiedTokenCache
+
+logger = logging.getLogger(__name__)
 
-KEYCLOAK_CONFIG_URL = 'http://localhost:8080/realms/demo-realm/.well-known/openid-configuration'
-KEYCLOAK_CLIENT_ID = 'django-backend'
+KEYCLOAK_CONFIG_URL = getattr(
+    settings, 'KEYCLOAK_CONFIG_URL',
+    'http://localhost:8080/realms/demo-realm/.well-known/openid-configuration'
+)
+KEYCLOAK_CLIENT_ID = getattr(settings, 'KEYCLOAK_CLIENT_ID', 'django-backend')
 ALGORITHMS = ['RS256']
 
-def get_public_key():
-    config = requests.get(KEYCLOAK_CONFIG_URL).json()
-    jwks_uri = config["jwks_uri"]
-    jwks = requests.get(jwks_uri).json()
-    return jwks["keys"][0]  # Use the first public key
+
+class JWKSKeyStore:
+    """Process-wide cache of the realm's signing keys, indexed by ``kid``.
+
+    Keys are fetched once and served from memory. After ``ttl`` seconds they
+    are refreshed in a background thread while the old keys keep serving. A
+    token signed with an unknown ``kid`` triggers one synchronous refetch (at
+    most every ``min_refetch_interval`` seconds) so key rotation is picked up
+    without letting bogus tokens hammer Keycloak. If Keycloak is unreachable
+    the last good key set is kept.
+
+    ``aget_key`` is the async counterpart: cache hits never leave the event
+    loop, and concurrent misses on one loop await a single fetch that runs on
+    the shared HTTP session in a worker thread.
+    """
+
+    def __init__(self, config_url, ttl=300, min_refetch_interval=10, timeout=5, session=None):
+        self.config_url = config_url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._session = session or requests.Session()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._keys = {}
+        self._default_kid = None
+        self._jwks_uri = None
+        self._fetched_at = None
+        self._last_attempt = None
+        self._last_finished = None
+        self._refreshing = False
+        self._pending = {}  # event loop -> in-flight async refresh
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0}
+
+    def get_key(self, kid=None):
+        if self._fetched_at is None:
+            self.refresh()
+        elif time.monotonic() - self._fetched_at >= self.ttl:
+            self._refresh_in_background()
+
+        key = self._lookup(kid)
+        if key is not None:
+            self._count('hits')
+            return key
+
+        self._count('misses')
+        if self._may_refetch():
+            self.refresh()
+            key = self._lookup(kid)
+        if key is None:
+            raise JWTError(f"No signing key found for kid {kid!r}")
+        return key
+
+    async def aget_key(self, kid=None):
+        if self._fetched_at is None:
+            await self.arefresh()
+        elif time.monotonic() - self._fetched_at >= self.ttl:
+            self._refresh_in_background()
+
+        key = self._lookup(kid)
+        if key is not None:
+            self._count('hits')
+            return key
+
+        self._count('misses')
+        if self._may_refetch():
+            await self.arefresh()
+            key = self._lookup(kid)
+        if key is None:
+            raise JWTError(f"No signing key found for kid {kid!r}")
+        return key
+
+    async def arefresh(self):
+        """Async ``refresh``. Coroutines on the same loop share one in-flight fetch."""
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(loop)
+        if pending is None:
+            pending = asyncio.ensure_future(sync_to_async(self.refresh, thread_sensitive=False)())
+            self._pending[loop] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(loop, None))
+        await asyncio.shield(pending)
+
+    def refresh(self):
+        """Fetch the key set now. Concurrent callers share a single fetch."""
+        started = time.monotonic()
+        with self._refresh_lock:
+            if self._last_finished is not None and self._last_finished >= started:
+                return  # a fetch finished while we waited for the lock; use its result
+            self._last_attempt = time.monotonic()
+            try:
+                keys, default_kid = self._fetch()
+            except (requests.RequestException, ValueError, KeyError) as exc:
+                JWKS_FETCH.observe(time.monotonic() - self._last_attempt, 'error')
+                self._count('refresh_errors')
+                if not self._keys:
+                    raise JWTError(f"Unable to fetch signing keys: {exc}") from exc
+                logger.warning("JWKS refresh failed, serving cached keys: %s", exc)
+                return
+            finally:
+                self._last_finished = time.monotonic()
+            JWKS_FETCH.observe(self._last_finished - self._last_attempt, 'ok')
+            with self._lock:
+                self._keys = keys
+                self._default_kid = default_kid
+                self._fetched_at = time.monotonic()
+                self._stats['refreshes'] += 1
+
+    def load(self, jwks):
+        """Install a JWKS document directly, bypassing the HTTP fetch."""
+        keys, default_kid = self._parse(jwks)
+        with self._lock:
+            self._keys = keys
+            self._default_kid = default_kid
+            self._fetched_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['keys'] = len(self._keys)
+            stats['age'] = None if self._fetched_at is None else time.monotonic() - self._fetched_at
+        return stats
+
+    def clear(self):
+        with self._refresh_lock, self._lock:
+            self._keys = {}
+            self._default_kid = None
+            self._jwks_uri = None
+            self._fetched_at = None
+            self._last_attempt = None
+            self._last_finished = None
+            self._stats = dict.fromkeys(self._stats, 0)
+
+    def _lookup(self, kid):
+        if kid is None:
+            kid = self._default_kid
+        return self._keys.get(kid)
+
+    def _may_refetch(self):
+        return self._last_attempt is None or time.monotonic() - self._last_attempt >= self.min_refetch_interval
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or not self._may_refetch():
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except JWTError:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def _fetch(self):
+        if self._jwks_uri is None:
+            config = self._session.get(self.config_url, timeout=self.timeout)
+            config.raise_for_status()
+            self._jwks_uri = config.json()["jwks_uri"]
+        response = self._session.get(self._jwks_uri, timeout=self.timeout)
+        response.raise_for_status()
+        return self._parse(response.json())
+
+    @staticmethod
+    def _parse(jwks):
+        keys = {}
+        default_kid = None
+        for key_data in jwks["keys"]:
+            if key_data.get("use", "sig") != "sig":
+                continue
+            algorithm = key_data.get("alg", ALGORITHMS[0])
+            if algorithm not in ALGORITHMS:
+                continue
+            kid = key_data.get("kid")
+            keys[kid] = jwk.construct(key_data, algorithm)
+            if default_kid is None:
+                default_kid = kid
+        if not keys:
+            raise ValueError("JWKS contains no usable signing keys")
+        return keys, default_kid
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+key_store = JWKSKeyStore(
+    KEYCLOAK_CONFIG_URL,
+    ttl=getattr(settings, 'KEYCLOAK_JWKS_TTL', 300),
+    min_refetch_interval=getattr(settings, 'KEYCLOAK_JWKS_MIN_REFETCH_INTERVAL', 10),
+    timeout=getattr(settings, 'KEYCLOAK_HTTP_TIMEOUT', 5),
+)
+
+token_cache = VerifiedTokenCache(
+    max_size=getattr(settings, 'KEYCLOAK_TOKEN_CACHE_SIZE', 10000),
+    max_age=getattr(settings, 'KEYCLOAK_TOKEN_CACHE_MAX_AGE', 300),
+)
+
+
+def get_public_key(kid=None):
+    return key_store.get_key(kid)
+
 
 def decode_token(token):
-    key = get_public_key()
-    return jwt.decode(token, key, algorithms=ALGORITHMS, audience="account")
\ No newline at end of file
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    kid = jwt.get_unverified_header(token).get("kid")
+    key = get_public_key(kid)
+    claims = jwt.decode(token, key, algorithms=ALGORITHMS, audience="account")
+    token_cache.set(token, claims)
+    return claims
+
+
+async def adecode_token(token):
+    """Async ``decode_token``; only a key fetch is ever awaited."""
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    kid = jwt.get_unverified_header(token).get("kid")
+    key = await key_store.aget_key(kid)
+    claims = jwt.decode(token, key, algorithms=ALGORITHMS, audience="account")
+    token_cache.set(token, claims)
+    return claims
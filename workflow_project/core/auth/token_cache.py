@@ -0,0 +1,70 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of claims for tokens whose signature has already been verified.
+
+    Entries are keyed by a SHA-256 digest of the raw token, so bearer tokens are
+    never kept in memory, and expire at the token's ``exp`` or after
+    ``max_age`` seconds, whichever comes first. A ``max_size`` of 0 disables
+    the cache.
+    """
+
+    def __init__(self, max_size=10000, max_age=300):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if not self.max_size:
+            return None
+        key = self._key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expires_at, claims = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return claims
+
+    def set(self, token, claims):
+        if not self.max_size:
+            return
+        expires_at = time.time() + self.max_age
+        exp = claims.get('exp')
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats = dict.fromkeys(self._stats, 0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
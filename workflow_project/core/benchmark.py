@@ -0,0 +1,368 @@
+"""Seeded query-count and latency benchmark for every endpoint in core/urls.py.
+
+Used by ``manage.py benchmark_api`` (large volumes, JSON report) and by the
+test suite (small volumes) so query-count regressions fail CI. TokenFactory
+and StubKeycloak are shared with ``manage.py benchmark_asgi``.
+"""
+import json
+import random
+import statistics
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.management.color import no_style
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from jose import jwk, jwt
+
+from .auth import keycloak
+from .models import (
+    FormSubmission, FormTemplate, Transition, WorkflowDefinition, WorkflowInboxEntry, WorkflowInstance,
+    WorkflowTimer,
+)
+from .state_machine import publish_workflow
+
+ROLES = ['Manager', 'HR', 'Finance', 'Legal']
+STATES = ['Submitted', 'Reviewed', 'Approved', 'Closed']
+
+
+def _bulk_rows_budget(rows):
+    # Without RETURNING on bulk INSERT (SQLite on Django 3.2) every row is its own INSERT pair.
+    if connection.features.can_return_rows_from_bulk_insert:
+        return 9
+    return 2 * rows + 9
+
+
+# Upper bound on queries per request; a request over budget is a regression.
+QUERY_BUDGETS = {
+    'create_form_template': 3,
+    'update_form_template': 4,
+    'create_workflow_definition': 11,
+    'update_workflow_definition': 7,
+    'submit_form': 9,
+    'replayed_submit_form': 0,  # a retry with the same Idempotency-Key, answered from memory
+    'bulk_submit_forms': _bulk_rows_budget,
+    'transition_workflow': 9,
+    'bulk_transition_workflow': 9,
+    'get_available_transitions': 1,
+    'submission_history': 2,
+    'list_workflow_events': 1,
+    'create_stream_ticket': 0,  # signed, not stored
+    'search_submissions': 2,
+    'export_submissions': 3,
+    'list_form_templates': 2,
+    'list_workflows': 3,
+    'list_user_submissions': 1,
+    'list_pending_approvals': 2,
+    'workflow_analytics': 3,
+    'metrics': 0,
+}
+
+
+class TokenFactory:
+    """Signs bearer tokens with a throwaway key.
+
+    The public key is installed in the process-wide key store unless
+    ``install`` is false, e.g. when it should only be served by a StubKeycloak.
+    """
+
+    def __init__(self, kid='benchmark', install=True):
+        self.kid = kid
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        self.public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+        self.public_jwk['kid'] = kid
+        if install:
+            keycloak.key_store.load({'keys': [self.public_jwk]})
+
+    def headers(self, username, *roles):
+        token = jwt.encode(
+            {'aud': 'account', 'exp': int(time.time()) + 3600, 'sub': username,
+             'preferred_username': username, 'realm_access': {'roles': list(roles)}},
+            self.private_pem, algorithm='RS256', headers={'kid': self.kid},
+        )
+        return {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+
+class StubKeycloak:
+    """Local OIDC discovery + JWKS endpoint that answers after ``delay`` seconds."""
+
+    def __init__(self, keys, delay=0.0):
+        self.keys = list(keys)
+        self.delay = delay
+        self.jwks_requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so the shared session reuses connections
+
+            def do_GET(self):
+                if self.path.endswith('/openid-configuration'):
+                    body = {'jwks_uri': f'{stub.base_url}/certs'}
+                else:
+                    stub.jwks_requests += 1
+                    time.sleep(stub.delay)
+                    body = {'keys': stub.keys}
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.config_url = f'{self.base_url}/.well-known/openid-configuration'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def seed(submissions=1000, workflows=5, users=100, batch_size=5000, rng=None):
+    """Create ``workflows`` templates with mixed AND/OR workflows and spread
+    ``submissions`` over them and over ``users`` submitters, in random states.
+
+    Rows get explicit primary keys so seeding is a handful of multi-row INSERTs
+    on every backend; sequences are reset afterwards.
+    """
+    rng = rng or random.Random(0)
+    templates = []
+    for i in range(workflows):
+        template = FormTemplate.objects.create(
+            name=f'Benchmark form {i}',
+            schema={'fields': [
+                {'name': 'title', 'type': 'text', 'required': True, 'max_length': 200},
+                {'name': 'amount', 'type': 'number', 'min': 0},
+                {'name': 'department', 'type': 'text', 'enum': ['IT', 'HR', 'Sales', 'Ops']},
+            ]},
+        )
+        workflow = WorkflowDefinition.objects.create(form_template=template, states=STATES)
+        for step, (from_state, to_state) in enumerate(zip(STATES, STATES[1:])):
+            logical_type = 'AND' if (i + step) % 2 else 'OR'
+            roles = rng.sample(ROLES, 2 if logical_type == 'AND' else 1)
+            Transition.objects.create(workflow=workflow, from_state=from_state, to_state=to_state,
+                                      allowed_roles=roles, logical_type=logical_type, sla_seconds=86400 * (step + 1))
+        compiled = publish_workflow(workflow)
+        templates.append((template, compiled.version_id,
+                          {t.from_state: t.allowed_roles for t in workflow.transitions.all()}))
+
+    next_submission = (FormSubmission.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    next_instance = (WorkflowInstance.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    created = 0
+    now = timezone.now()
+    while created < submissions:
+        count = min(batch_size, submissions - created)
+        rows, instances, inbox, timers = [], [], [], []
+        for offset in range(count):
+            template, version_id, roles_by_state = templates[rng.randrange(len(templates))]
+            state = rng.choice(STATES)
+            submission_id = next_submission + created + offset
+            instance_id = next_instance + created + offset
+            rows.append(FormSubmission(
+                id=submission_id, form_template=template, submitted_by=f'user{rng.randrange(users)}',
+                data={'title': f'Request {submission_id}', 'amount': rng.randrange(10000),
+                      'department': rng.choice(['IT', 'HR', 'Sales', 'Ops'])},
+            ))
+            instances.append(WorkflowInstance(id=instance_id, submission_id=submission_id,
+                                              workflow_version_id=version_id, current_state=state,
+                                              is_open=state in roles_by_state))
+            inbox.extend(WorkflowInboxEntry(instance_id=instance_id, role=role)
+                         for role in roles_by_state.get(state, ()))
+            if state in roles_by_state:
+                # Deadlines spread over the next hour, so the scheduler benchmark has work.
+                timers.append(WorkflowTimer(instance_id=instance_id, state=state, entered_at=now,
+                                            due_at=now + timedelta(seconds=rng.randrange(3600))))
+        FormSubmission.objects.bulk_create(rows)
+        WorkflowInstance.objects.bulk_create(instances)
+        WorkflowInboxEntry.objects.bulk_create(inbox)
+        WorkflowTimer.objects.bulk_create(timers)
+        created += count
+
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [FormSubmission, WorkflowInstance]):
+            cursor.execute(sql)
+    return [template for template, _, _ in templates]
+
+
+class Scenario:
+    """Builds one request per endpoint against the seeded data."""
+
+    def __init__(self, templates, tokens, rng=None):
+        self.templates = templates
+        self.tokens = tokens
+        self.rng = rng or random.Random(1)
+        self.counter = 0
+
+    def _next(self):
+        self.counter += 1
+        return self.counter
+
+    def _actionable(self, count=1):
+        # Instances in their first state whose outgoing edge is a plain OR approval.
+        transition = Transition.objects.select_related('workflow').filter(
+            from_state=STATES[0], logical_type='OR', workflow__form_template__name__startswith='Benchmark form'
+        ).first()
+        candidates = WorkflowInstance.objects.filter(
+            current_state=STATES[0], submission__form_template=transition.workflow.form_template_id,
+        ).order_by('id').values_list('submission_id', flat=True)
+        last_id = WorkflowInstance.objects.order_by('-id').values_list('id', flat=True).first()
+        rows = list(candidates.filter(id__gte=self.rng.randrange(last_id // 2 or 1))[:count])
+        return rows if len(rows) == count else list(candidates[:count]), transition
+
+    def requests(self):
+        """Return ``{name: callable() -> (method, path, body, headers)}``."""
+        admin = self.tokens.headers('admin', 'Admin')
+        employee = self.tokens.headers('user0', 'Employee')
+        approver = self.tokens.headers('approver', *ROLES)
+        template = self.templates[0]
+
+        def create_form_template():
+            return 'post', '/api/form-template/', {
+                'name': f'Scratch template {self._next()}', 'schema': {'fields': [{'name': 'x'}]},
+            }, admin
+
+        def update_form_template():
+            return 'put', f'/api/form-template/{template.id}/', {'schema': template.schema}, admin
+
+        def create_workflow_definition():
+            scratch = FormTemplate.objects.create(name=f'Scratch workflow {self._next()}', schema={'fields': []})
+            return 'post', '/api/workflow-definition/', {
+                'form_template': scratch.id, 'states': STATES,
+                'transitions': [{'from_state': a, 'to_state': b, 'allowed_roles': ['Manager'], 'logical_type': 'OR'}
+                                for a, b in zip(STATES, STATES[1:])],
+            }, admin
+
+        def update_workflow_definition():
+            scratch = FormTemplate.objects.create(name=f'Scratch workflow {self._next()}', schema={'fields': []})
+            workflow = WorkflowDefinition.objects.create(form_template=scratch, states=STATES)
+            return 'put', f'/api/workflow-definition/{workflow.id}/', {
+                'states': STATES,
+                'transitions': [{'from_state': STATES[0], 'to_state': STATES[-1], 'allowed_roles': ['HR']}],
+            }, admin
+
+        def submit_form():
+            return 'post', '/api/submit-form/', {
+                'form_template': template.id, 'data': {'title': 'Benchmark', 'amount': 10, 'department': 'IT'},
+            }, employee
+
+        def bulk_submit_forms():
+            line = json.dumps({'form_template': template.id, 'data': {'title': 'Bulk', 'amount': 1}})
+            return 'ndjson', '/api/submissions/bulk/', '\n'.join([line] * 20), admin
+
+        def transition_workflow():
+            (submission_id,), transition = self._actionable()
+            return 'post', '/api/transition/', {
+                'submission_id': submission_id, 'next_state': transition.to_state, 'expected_state': STATES[0],
+            }, approver
+
+        def bulk_transition_workflow():
+            submission_ids, transition = self._actionable(20)
+            return 'post', '/api/transitions/bulk/', [
+                {'submission_id': submission_id, 'next_state': transition.to_state, 'expected_state': STATES[0]}
+                for submission_id in submission_ids
+            ], approver
+
+        def get_available_transitions():
+            submission_id = self.rng.randrange(1, FormSubmission.objects.count())
+            return 'get', f'/api/transitions/{submission_id}/', None, approver
+
+        def submission_history():
+            submission_id = self.rng.randrange(1, FormSubmission.objects.count())
+            return 'get', f'/api/submissions/{submission_id}/history/', None, approver
+
+        return {
+            'create_form_template': create_form_template,
+            'update_form_template': update_form_template,
+            'create_workflow_definition': create_workflow_definition,
+            'update_workflow_definition': update_workflow_definition,
+            'submit_form': submit_form,
+            'replayed_submit_form': lambda: (*submit_form()[:3], {**employee, 'HTTP_IDEMPOTENCY_KEY': 'benchmark'}),
+            'bulk_submit_forms': bulk_submit_forms,
+            'transition_workflow': transition_workflow,
+            'bulk_transition_workflow': bulk_transition_workflow,
+            'get_available_transitions': get_available_transitions,
+            'submission_history': submission_history,
+            'list_workflow_events': lambda: ('get', '/api/events/?actor=approver', None, admin),
+            'create_stream_ticket': lambda: ('post', '/api/stream/ticket/', {}, approver),
+            'export_submissions': lambda: ('get', f'/api/submissions/export.csv?form_template={template.id}'
+                                                  '&data.amount__gte=9900', None, admin),
+            'search_submissions': lambda: ('get', f'/api/submissions/?form_template={template.id}'
+                                                  '&data.amount__gt=5000&data.department=IT', None, admin),
+            'list_form_templates': lambda: ('get', '/api/form-templates/', None, employee),
+            'list_workflows': lambda: ('get', '/api/workflows/', None, admin),
+            'list_user_submissions': lambda: ('get', '/api/my-submissions/', None, employee),
+            'list_pending_approvals': lambda: ('get', '/api/pending-approvals/', None, approver),
+            'workflow_analytics': lambda: ('get', f'/api/analytics/?form_template={template.id}', None, admin),
+            'metrics': lambda: ('get', '/metrics', None, {}),
+        }
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+@override_settings(WORKFLOW_THROTTLES={})
+def run(scenario, iterations=20, endpoints=None):
+    """Run every endpoint ``iterations`` times and return a report dict.
+
+    Each entry records the worst query count seen, its budget, whether the
+    budget held, and p50/p99 latency in milliseconds. The first call of each
+    endpoint warms the compiled-workflow and validator caches and is not counted.
+    Rate limits are off: each endpoint is called back to back by one user.
+    """
+    client = Client()
+    report = {}
+    for name, build in scenario.requests().items():
+        if endpoints and name not in endpoints:
+            continue
+        budget = QUERY_BUDGETS[name]
+        latencies, queries, statuses = [], [], set()
+        for i in range(iterations + 1):
+            method, path, body, headers = build()
+            if method == 'ndjson':
+                send = lambda: client.post(path, body, content_type='application/x-ndjson', **headers)  # noqa: E731
+                if callable(budget):
+                    budget = budget(body.count('\n') + 1)
+            elif method == 'get':
+                send = lambda: client.get(path, **headers)  # noqa: E731
+            else:
+                send = lambda: getattr(client, method)(path, body, content_type='application/json', **headers)  # noqa: E731
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = send()
+                if response.streaming:
+                    b''.join(response.streaming_content)  # rows are only queried as the body is read
+                elapsed = (time.perf_counter() - started) * 1000
+            statuses.add(response.status_code)
+            if i == 0:
+                continue
+            latencies.append(elapsed)
+            queries.append(len(captured))
+        report[name] = {
+            'requests': iterations,
+            'statuses': sorted(statuses),
+            'max_queries': max(queries),
+            'query_budget': budget,
+            'within_budget': max(queries) <= budget,
+            'p50_ms': round(statistics.median(latencies), 3),
+            'p99_ms': round(_percentile(latencies, 99), 3),
+        }
+    return report
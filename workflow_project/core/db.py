@@ -0,0 +1,111 @@
+"""Read-replica routing and persistent connection health.
+
+Reads go to the primary unless a view opts in with ``@read_replica``; inside
+such a view every ORM read goes to one of ``WORKFLOW_READ_REPLICAS``, picked
+per request. Writes always go to the primary. After a user's successful
+write (any non-GET request through ``keycloak_required``) their reads stick
+to the primary for ``WORKFLOW_REPLICA_PIN_SECONDS``, so they read their own
+writes however far the replicas lag. Pins live in the default cache; use a
+shared one with several workers.
+
+Connections persist for ``CONN_MAX_AGE``. Django 3.2 only checks a reused
+connection after an error, so ``check_connections`` pings connections that
+sat idle for ``WORKFLOW_DB_HEALTH_CHECK_AFTER`` seconds before a request
+uses them, and drops the dead ones.
+"""
+import asyncio
+import contextvars
+import hashlib
+import random
+import time
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_read_alias = contextvars.ContextVar('workflow_read_alias', default=None)
+
+
+class ReplicaRouter:
+    """Routes reads to the alias chosen by ``read_replica`` and everything else to the primary."""
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # replicas hold the primary's rows
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in getattr(settings, 'WORKFLOW_READ_REPLICAS', ())
+
+
+def _pin_key(username):
+    return 'db-pin:' + hashlib.sha256(username.encode()).hexdigest()[:32]
+
+
+def pin_to_primary(user_info):
+    """Send this user's replica reads to the primary for a while, after a write of theirs."""
+    username = user_info.get('preferred_username')
+    if username and getattr(settings, 'WORKFLOW_READ_REPLICAS', ()):
+        cache.set(_pin_key(username), True, timeout=settings.WORKFLOW_REPLICA_PIN_SECONDS)
+
+
+def read_alias():
+    """The alias reads of the current request go to."""
+    return _read_alias.get() or DEFAULT_DB_ALIAS
+
+
+def _choose(request):
+    replicas = getattr(settings, 'WORKFLOW_READ_REPLICAS', ())
+    if not replicas:
+        return None
+    username = getattr(request, 'user_info', {}).get('preferred_username')
+    if username and cache.get(_pin_key(username)):
+        return None
+    return random.choice(replicas)
+
+
+def read_replica(func):
+    """Serve a read-only view (sync or async) from a replica. Apply below ``keycloak_required``."""
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(request, *args, **kwargs):
+            token = _read_alias.set(await sync_to_async(_choose)(request))  # the pin lookup hits the cache
+            try:
+                return await func(request, *args, **kwargs)
+            finally:
+                _read_alias.reset(token)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        token = _read_alias.set(_choose(request))
+        try:
+            return func(request, *args, **kwargs)
+        finally:
+            _read_alias.reset(token)
+    return wrapper
+
+
+def check_connections(**kwargs):
+    """``request_started`` receiver: close persistent connections that died while idle."""
+    now = time.monotonic()
+    for conn in connections.all():
+        idle_since = getattr(conn, 'idle_since', None)
+        if conn.connection is None or idle_since is None:
+            continue
+        if now - idle_since >= settings.WORKFLOW_DB_HEALTH_CHECK_AFTER and not conn.is_usable():
+            conn.close()
+
+
+def mark_idle(**kwargs):
+    """``request_finished`` receiver: remember when each open connection was last used."""
+    now = time.monotonic()
+    for conn in connections.all():
+        if conn.connection is not None:
+            conn.idle_since = now
@@ -0,0 +1,224 @@
+from typing import NamedTuple
+
+from django.db import transaction
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+
+from .events import approval_event
+from .inbox import escalated_roles, replace_inbox, sync_inbox
+from .models import WorkflowEvent, WorkflowInstance
+from .notify import instance_message, notify_instances
+from .sla import arm_timers
+from .state_machine import get_compiled_version_or_404
+
+
+class TransitionError(Exception):
+    status_code = 400
+
+    def __init__(self, message, current_state=None):
+        super().__init__(message)
+        self.message = message
+        self.current_state = current_state
+
+    def as_response_data(self):
+        data = {"error": self.message}
+        if self.current_state is not None:
+            data["current_state"] = self.current_state
+        return data
+
+
+class InvalidTransition(TransitionError):
+    status_code = 400
+
+
+class TransitionForbidden(TransitionError):
+    status_code = 403
+
+
+class TransitionConflict(TransitionError):
+    status_code = 409
+
+
+class TransitionResult(NamedTuple):
+    instance: WorkflowInstance
+    from_state: str
+    transitioned: bool
+    already_approved: bool
+
+    @property
+    def message(self):
+        if self.already_approved:
+            return "You have already approved this transition."
+        return f"Transitioned to {self.instance.current_state}"
+
+
+def user_roles_of(user_info):
+    return user_info.get("realm_access", {}).get("roles", [])
+
+
+def record_approval(instance, workflow, target_state, user_roles, username, expected_state=None):
+    """Apply one approval to an instance that the caller has locked.
+
+    Mutates ``instance`` in memory and returns ``(transitioned, already_approved)``;
+    persisting it is left to the caller so bulk paths can batch the writes.
+    """
+    current_state = instance.current_state
+    if expected_state is not None and expected_state != current_state:
+        raise TransitionConflict(
+            f"Workflow is in state {current_state!r}, expected {expected_state!r}.", current_state
+        )
+
+    transition = workflow.get_transition(current_state, target_state)
+    if transition is None:
+        if target_state == current_state:
+            raise TransitionConflict("Transition already completed by another role.", current_state)
+        raise InvalidTransition("Invalid transition")
+
+    escalated = instance.escalations.get(target_state, ())
+    if not transition.allows(user_roles) and not any(role in escalated for role in user_roles):
+        raise TransitionForbidden("Permission denied. Role not allowed.")
+
+    approvals = list(instance.partial_approvals.get(target_state, []))
+    if username in approvals:
+        return False, True
+    approvals.append(username)
+
+    partial_approvals = dict(instance.partial_approvals)
+    if transition.logical_type == "AND" and len(approvals) < len(set(transition.allowed_roles)):
+        partial_approvals[target_state] = approvals
+        instance.partial_approvals = partial_approvals
+        return False, False
+
+    partial_approvals.pop(target_state, None)
+    instance.partial_approvals = partial_approvals
+    instance.current_state = target_state
+    instance.escalations = {}
+    instance.is_open = not workflow.is_terminal(target_state)
+    return True, False
+
+
+def _message(instance, workflow, from_state, escalations):
+    # Who could act before (from_state plus escalated roles) and who can act now.
+    return instance_message(
+        instance, instance.submission.submitted_by,
+        workflow.actionable_roles(from_state) | escalated_roles(escalations),
+        workflow.actionable_roles(instance.current_state) | escalated_roles(instance.escalations),
+    )
+
+
+def apply_transition(submission_id, target_state, user_info, expected_state=None):
+    """Approve ``target_state`` for a submission as the given user.
+
+    Runs in a single transaction with the instance row locked, so concurrent
+    approvals are serialised by the database instead of overwriting each
+    other's ``partial_approvals``. Clients that pass ``expected_state`` get a
+    ``TransitionConflict`` (409) if another approval moved the instance first.
+    Every recorded approval appends a ``WorkflowEvent`` in the same transaction.
+    """
+    user_roles = user_roles_of(user_info)
+    username = user_info.get("preferred_username")
+
+    with transaction.atomic():
+        instance = get_object_or_404(
+            WorkflowInstance.objects.select_for_update(of=('self',)).select_related('submission'),
+            submission_id=submission_id,
+        )
+        from_state = instance.current_state
+        escalations = instance.escalations
+        workflow = get_compiled_version_or_404(instance.workflow_version_id)
+
+        transitioned, already_approved = record_approval(
+            instance, workflow, target_state, user_roles, username, expected_state
+        )
+        if not already_approved:
+            instance.save(update_fields=['current_state', 'partial_approvals', 'escalations', 'is_open', 'updated_at'])
+            approval_event(
+                instance, workflow.get_transition(from_state, target_state),
+                from_state, user_roles, username, transitioned, escalations.get(target_state, ()),
+            ).save()
+            notify_instances([_message(instance, workflow, from_state, escalations)])
+        if transitioned:
+            sync_inbox(instance, workflow.actionable_roles(instance.current_state))
+            arm_timers({instance.id: (workflow, instance.current_state)})
+
+    return TransitionResult(instance, from_state, transitioned, already_approved)
+
+
+BULK_STATUSES = {
+    InvalidTransition: 'invalid',
+    TransitionForbidden: 'forbidden',
+    TransitionConflict: 'conflict',
+}
+
+
+def apply_bulk_transitions(items, user_info):
+    """Apply many ``{submission_id, next_state, expected_state}`` approvals at once.
+
+    All instances are locked and loaded with one query, workflows come from the
+    compiled cache, and the changes are written back with ``bulk_update`` in the
+    same transaction, with their events in one multi-row insert. Each item is
+    validated independently; one result dict is returned per item with
+    ``status`` ok / conflict / forbidden / invalid.
+    """
+    user_roles = user_roles_of(user_info)
+    username = user_info.get("preferred_username")
+    submission_ids = {item.get("submission_id") for item in items}
+
+    results = []
+    with transaction.atomic():
+        instances = {
+            instance.submission_id: instance
+            for instance in WorkflowInstance.objects.select_for_update(of=('self',))
+            .select_related('submission').filter(submission_id__in=submission_ids).order_by('id')
+        }
+        changed = {}
+        moved = {}
+        events = []
+        before = {}  # instance id -> (workflow, state and escalations before this request)
+        for item in items:
+            submission_id = item.get("submission_id")
+            instance = instances.get(submission_id)
+            result = {"submission_id": submission_id}
+            try:
+                if instance is None:
+                    raise InvalidTransition("Workflow instance not found.")
+                workflow = get_compiled_version_or_404(instance.workflow_version_id)
+                from_state = instance.current_state
+                escalations = instance.escalations
+                transitioned, already_approved = record_approval(
+                    instance, workflow, item.get("next_state"), user_roles, username, item.get("expected_state")
+                )
+            except Http404:
+                result.update(status='invalid', error="Workflow definition not found.")
+            except TransitionError as e:
+                result.update(status=BULK_STATUSES[type(e)], **e.as_response_data())
+            else:
+                if not already_approved:
+                    changed[instance.id] = instance
+                    before.setdefault(instance.id, (workflow, from_state, escalations))
+                    events.append(approval_event(
+                        instance, workflow.get_transition(from_state, item.get("next_state")),
+                        from_state, user_roles, username, transitioned, escalations.get(item.get("next_state"), ()),
+                    ))
+                if transitioned:
+                    moved[instance.id] = workflow.actionable_roles(instance.current_state)
+                message = TransitionResult(instance, from_state, transitioned, already_approved).message
+                result.update(status='ok', current_state=instance.current_state, message=message)
+            results.append(result)
+
+        now = timezone.now()
+        for instance in changed.values():
+            instance.updated_at = now
+        WorkflowInstance.objects.bulk_update(
+            changed.values(), ['current_state', 'partial_approvals', 'escalations', 'is_open', 'updated_at']
+        )
+        WorkflowEvent.objects.bulk_create(events)
+        if moved:
+            replace_inbox(moved)
+            arm_timers({
+                instance_id: (before[instance_id][0], changed[instance_id].current_state)
+                for instance_id in moved
+            }, now)
+        notify_instances(_message(instance, *before[instance.id]) for instance in changed.values())
+    return results
@@ -0,0 +1,56 @@
+import hashlib
+import json
+
+from django.db.models import Count, Max
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, quote_etag
+
+from .models import WorkflowInboxEntry
+
+
+def catalog_stamp(queryset):
+    """Row count, highest id and latest ``updated_at`` of ``queryset`` in one aggregate.
+
+    Any insert, edit or delete changes at least one of the three.
+    """
+    return queryset.aggregate(rows=Count('id'), last_id=Max('id'), last_change=Max('updated_at'))
+
+
+def inbox_stamp(roles):
+    """Stamp for the pending-approvals list of a user holding ``roles``.
+
+    Inbox rows are replaced rather than edited, so their count and highest id
+    track membership; the instances' and templates' ``updated_at`` track the
+    embedded state and form details.
+    """
+    return WorkflowInboxEntry.objects.filter(role__in=roles).aggregate(
+        rows=Count('id'),
+        last_id=Max('id'),
+        last_change=Max('instance__updated_at'),
+        last_template_change=Max('instance__submission__form_template__updated_at'),
+    )
+
+
+def make_etag(request, name, stamp, *extra):
+    """Strong ETag for a list response, from its stamp and the request's page and projection."""
+    payload = json.dumps([name, stamp, request.get_full_path(), *extra], default=str, sort_keys=True)
+    return quote_etag(hashlib.sha1(payload.encode()).hexdigest())
+
+
+def is_fresh(request, etag):
+    """True if the client's ``If-None-Match`` already names ``etag``."""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag in etags
+
+
+def add_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    # Responses are per user; browsers may keep them but must revalidate every time.
+    response['Cache-Control'] = 'private, no-cache'
+    patch_vary_headers(response, ['Authorization'])
+    return response
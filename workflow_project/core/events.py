@@ -0,0 +1,80 @@
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from .inbox import rebuild_inbox
+from .models import WorkflowDefinition, WorkflowEvent, WorkflowInstance
+from .state_machine import get_compiled_version
+
+
+def approval_event(instance, transition, from_state, user_roles, username, transitioned, escalated=()):
+    """Unsaved WorkflowEvent for one approval of ``transition`` by ``username``.
+
+    ``escalated`` are roles an SLA escalation added to the transition.
+    """
+    allowed = list(transition.allowed_roles) + [role for role in escalated if role not in transition.allowed_roles]
+    return WorkflowEvent(
+        instance=instance,
+        kind=WorkflowEvent.TRANSITIONED if transitioned else WorkflowEvent.APPROVED,
+        actor=username or "",
+        roles=[role for role in allowed if role in user_roles],
+        from_state=from_state,
+        to_state=transition.to_state,
+    )
+
+
+def replay(events, initial_state=None):
+    """Fold events, oldest first, into ``(current_state, partial_approvals)``.
+
+    Mirrors ``engine.record_approval``: a partial approval adds the actor to
+    the target state's list, a transition clears that list and moves the
+    instance. SLA ``escalated`` / ``overdue`` events change neither.
+    ``initial_state`` defaults to the first event's ``from_state``.
+    """
+    state = initial_state
+    partial_approvals = {}
+    for event in events:
+        if state is None:
+            state = event.from_state
+        if event.kind == WorkflowEvent.TRANSITIONED:
+            partial_approvals.pop(event.to_state, None)
+            state = event.to_state
+        elif event.kind == WorkflowEvent.APPROVED:
+            partial_approvals.setdefault(event.to_state, []).append(event.actor)
+    return state, partial_approvals
+
+
+def rebuild_instances(instances, chunk_size=500, save=True):
+    """Recompute ``current_state``, ``partial_approvals`` and ``is_open`` from the event log.
+
+    Only instances with at least one event are considered; the rest predate the
+    log and are left alone. Returns the ids of instances whose stored state
+    differed from their history, after writing the replayed state (and their
+    inbox entries) back unless ``save`` is false.
+    """
+    ids = list(instances.filter(events__isnull=False).distinct().order_by('id').values_list('id', flat=True))
+    drifted = []
+    for start in range(0, len(ids), chunk_size):
+        chunk = WorkflowInstance.objects.filter(id__in=ids[start:start + chunk_size]).prefetch_related(
+            Prefetch('events', queryset=WorkflowEvent.objects.order_by('id'))
+        )
+        changed = []
+        for instance in chunk:
+            state, partial_approvals = replay(instance.events.all())
+            if (state, partial_approvals) != (instance.current_state, instance.partial_approvals):
+                instance.current_state = state
+                instance.partial_approvals = partial_approvals
+                try:
+                    instance.is_open = not get_compiled_version(instance.workflow_version_id).is_terminal(state)
+                except WorkflowDefinition.DoesNotExist:
+                    pass
+                instance.updated_at = timezone.now()
+                changed.append(instance)
+        if save and changed:
+            with transaction.atomic():
+                WorkflowInstance.objects.bulk_update(
+                    changed, ['current_state', 'partial_approvals', 'is_open', 'updated_at']
+                )
+                rebuild_inbox(WorkflowInstance.objects.filter(id__in=[i.id for i in changed]))
+        drifted.extend(instance.id for instance in changed)
+    return drifted
@@ -0,0 +1,98 @@
+"""Streaming CSV / NDJSON export of submissions with their workflow state.
+
+Rows are read with ``.iterator(chunk_size=...)`` (a server-side cursor on
+PostgreSQL) as plain tuples and encoded a chunk at a time, so memory stays
+flat however many rows are exported.
+"""
+import csv
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import FormTemplate
+
+COLUMNS = (
+    'submission_id', 'form_template_id', 'form_template', 'submitted_by', 'submitted_at',
+    'current_state', 'partial_approvals', 'updated_at',
+)
+_SOURCES = (
+    'submission_id', 'submission__form_template_id', 'submission__form_template__name',
+    'submission__submitted_by', 'submission__submitted_at', 'current_state', 'partial_approvals',
+    'updated_at', 'submission__data',
+)
+_encoder = DjangoJSONEncoder()
+
+
+def data_fields(form_template_id=None):
+    """Names of the schema fields of every template (or one), in first-seen order."""
+    templates = FormTemplate.objects.order_by('id')
+    if form_template_id is not None:
+        templates = templates.filter(id=form_template_id)
+    names = {}
+    for schema in templates.values_list('schema', flat=True).iterator():
+        for spec in schema.get('fields', []) if isinstance(schema, dict) else []:
+            if isinstance(spec, dict) and isinstance(spec.get('name'), str):
+                names.setdefault(spec['name'])
+    return list(names)
+
+
+def export_rows(instances, chunk_size):
+    """``(*COLUMNS values, data)`` tuples for a WorkflowInstance queryset, oldest first."""
+    return instances.order_by('id').values_list(*_SOURCES).iterator(chunk_size=chunk_size)
+
+
+class _Echo:
+    # csv.writer target that hands each encoded line back instead of buffering it.
+    def write(self, line):
+        return line
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return _encoder.default(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@', '\t', '\r'):
+        try:
+            float(value)
+        except ValueError:
+            return "'" + value  # keep spreadsheets from evaluating submitted text as a formula
+    return value
+
+
+def csv_chunks(instances, form_template_id=None, chunk_size=2000):
+    """CSV text in chunks of ``chunk_size`` rows; schema fields become ``data.<name>`` columns."""
+    fields = data_fields(form_template_id)
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS + tuple(f'data.{name}' for name in fields))
+    lines = []
+    for *row, data in export_rows(instances, chunk_size):
+        data = data if isinstance(data, dict) else {}
+        lines.append(writer.writerow([_cell(value) for value in row] + [_cell(data.get(name)) for name in fields]))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def ndjson_chunks(instances, form_template_id=None, chunk_size=2000):
+    """One JSON object per line, with the submitted ``data`` kept as an object."""
+    lines = []
+    for *row, data in export_rows(instances, chunk_size):
+        record = dict(zip(COLUMNS, row), data=data)
+        lines.append(json.dumps(record, cls=DjangoJSONEncoder) + '\n')
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_chunks),
+    'ndjson': ('application/x-ndjson', ndjson_chunks),
+}
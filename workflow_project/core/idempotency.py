@@ -0,0 +1,241 @@
+"""``Idempotency-Key`` support for the mutating endpoints.
+
+A client that sends ``Idempotency-Key: <unique string>`` with a POST or PUT
+may retry it freely: it takes effect once. The first request claims the key
+by inserting an ``IdempotencyKey`` row (unique per user and key) and stores
+its response in that row, in the same transaction as the view's own writes.
+Retries get the stored response back, with ``Idempotent-Replayed: true``.
+
+* A retry that arrives while the first request is still running waits up to
+  ``WORKFLOW_IDEMPOTENCY_WAIT_SECONDS`` for it to finish, then gets a 409.
+* A key reused for a different request (method, path with its query string,
+  or body) gets a 422.
+* A request that fails (an exception or a 5xx) gives up its key, so it can
+  be retried.
+
+Completed responses are also kept in a per-process LRU, so most retries cost
+no query. Keys expire after ``WORKFLOW_IDEMPOTENCY_TTL`` seconds;
+``manage.py purge_idempotency_keys`` deletes expired rows in batches.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.05
+
+
+class CompletedResponses:
+    """Bounded LRU of ``(username, key) -> (expires_at, request_hash, status_code, data)``."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username, key):
+        with self._lock:
+            entry = self._entries.get((username, key))
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[(username, key)]
+                return None
+            self._entries.move_to_end((username, key))
+            return entry
+
+    def set(self, username, key, expires_at, request_hash, status_code, data):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._entries[(username, key)] = (expires_at.timestamp(), request_hash, status_code, data)
+            self._entries.move_to_end((username, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+completed = CompletedResponses(max_size=getattr(settings, 'WORKFLOW_IDEMPOTENCY_CACHE_SIZE', 10000))
+
+
+def _request_digest(request):
+    return hashlib.sha256(f'{request.method} {request.get_full_path()}\n'.encode())
+
+
+def _request_hash(request):
+    digest = _request_digest(request)
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+class HashingStream:
+    """Wraps a streamed request body and hashes it as the view reads it, so it is never buffered."""
+
+    def __init__(self, request):
+        self._stream = request.stream
+        self._digest = _request_digest(request)
+
+    def read(self, *args):
+        data = self._stream.read(*args) if self._stream is not None else b''
+        self._digest.update(data)
+        return data
+
+    def readline(self, *args):
+        data = self._stream.readline(*args) if self._stream is not None else b''
+        self._digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """The request hash, once the rest of the body (what the view did not read) is hashed too."""
+        for _ in iter(lambda: self.read(64 * 1024), b''):
+            pass
+        return self._digest.hexdigest()
+
+
+def _in_flight_hash(request):
+    # A streamed request's body hash is only known once it is read: until then
+    # its key is held under a hash of the method, path and body length.
+    return hashlib.sha256(
+        f"{request.method} {request.get_full_path()}\n{request.headers.get('Content-Length', '')}".encode()
+    ).hexdigest()
+
+
+def _claim(username, key, request_hash):
+    """Insert the in-flight row for ``key``. Returns None if claimed, else the row holding the key."""
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                username=username, key=key, request_hash=request_hash, created_at=now,
+                expires_at=now + timedelta(seconds=settings.WORKFLOW_IDEMPOTENCY_TTL),
+            )
+        return None
+    except IntegrityError:
+        pass
+    record = IdempotencyKey.objects.filter(username=username, key=key).first()
+    if record is None:
+        return _claim(username, key, request_hash)  # purged meanwhile
+    if record.expires_at <= now or (
+        record.status_code is None
+        and record.created_at <= now - timedelta(seconds=settings.WORKFLOW_IDEMPOTENCY_LOCK_SECONDS)
+    ):
+        # Expired, or held by a request whose worker died: take it over, unless another retry just did.
+        taken = IdempotencyKey.objects.filter(id=record.id, created_at=record.created_at).update(
+            request_hash=request_hash, status_code=None, response=None, created_at=now,
+            expires_at=now + timedelta(seconds=settings.WORKFLOW_IDEMPOTENCY_TTL),
+        )
+        if taken:
+            return None
+        record = IdempotencyKey.objects.filter(id=record.id).first() or record
+    return record
+
+
+def _replay(request_hash, stored_hash, status_code, data):
+    if stored_hash != request_hash:
+        return Response({"error": f"{HEADER} was already used for a different request."}, status=422)
+    return Response(data, status=status_code, headers={'Idempotent-Replayed': 'true'})
+
+
+def _store(username, key, response, request_hash):
+    """Save the response on the claimed row; False if it is not one to replay."""
+    if response.status_code >= 500 or not isinstance(response, Response):
+        return False
+    IdempotencyKey.objects.filter(username=username, key=key).update(
+        request_hash=request_hash, status_code=response.status_code, response=response.data,
+    )
+    return True
+
+
+def _release(username, key):
+    IdempotencyKey.objects.filter(username=username, key=key, status_code__isnull=True).delete()
+
+
+def idempotent(streamed=False):
+    """Honour ``Idempotency-Key`` on a mutating view. Apply below ``keycloak_required``.
+
+    ``streamed`` views read ``request.stream`` themselves and commit in
+    chunks, so they do not run in one transaction. Their body is hashed as it
+    is read; a retry of one that completed reads and hashes its own body
+    before it is answered.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return func(request, *args, **kwargs)
+            if not 0 < len(key) <= MAX_KEY_LENGTH:
+                return Response({"error": f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters."}, status=400)
+            username = request.user_info.get("preferred_username", "")
+            if streamed:
+                body = HashingStream(request)
+                request._stream = body  # what DRF's request.stream returns
+                request_hash = _in_flight_hash(request)
+            else:
+                request_hash = _request_hash(request)
+
+            entry = completed.get(username, key)
+            if entry is not None:
+                return _replay(body.hexdigest() if streamed else request_hash, *entry[1:])
+            deadline = time.monotonic() + settings.WORKFLOW_IDEMPOTENCY_WAIT_SECONDS
+            while True:
+                record = _claim(username, key, request_hash)
+                if record is None:
+                    break
+                if record.status_code is not None:
+                    completed.set(username, key, record.expires_at, record.request_hash,
+                                  record.status_code, record.response)
+                    if streamed:
+                        request_hash = body.hexdigest()
+                if record.status_code is not None or record.request_hash != request_hash:
+                    return _replay(request_hash, record.request_hash, record.status_code, record.response)
+                if time.monotonic() >= deadline:
+                    return Response({"error": "A request with this Idempotency-Key is still in progress."},
+                                    status=409, headers={'Retry-After': '1'})
+                time.sleep(POLL_SECONDS)
+
+            try:
+                if streamed:
+                    response = func(request, *args, **kwargs)
+                    request_hash = body.hexdigest()
+                    stored = _store(username, key, response, request_hash)
+                else:
+                    with transaction.atomic():
+                        response = func(request, *args, **kwargs)
+                        stored = _store(username, key, response, request_hash)
+            except BaseException:
+                _release(username, key)
+                raise
+            if stored:
+                expires_at = timezone.now() + timedelta(seconds=settings.WORKFLOW_IDEMPOTENCY_TTL)
+                completed.set(username, key, expires_at, request_hash, response.status_code, response.data)
+            else:
+                _release(username, key)
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired(batch_size=1000, now=None):
+    """Delete expired keys, ``batch_size`` rows per statement. Returns how many."""
+    now = now or timezone.now()
+    purged = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(expires_at__lte=now).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,46 @@
+from .models import WorkflowDefinition, WorkflowInboxEntry
+from .state_machine import get_compiled_version
+
+
+def escalated_roles(escalations):
+    """Every role an instance's SLA ``escalations`` let approve something."""
+    return {role for roles in escalations.values() for role in roles}
+
+
+def sync_inbox(instance, roles):
+    """Make ``instance``'s inbox entries match ``roles``, touching only the difference."""
+    roles = set(roles)
+    existing = set(instance.inbox_entries.values_list('role', flat=True))
+    stale = existing - roles
+    if stale:
+        instance.inbox_entries.filter(role__in=stale).delete()
+    missing = roles - existing
+    if missing:
+        WorkflowInboxEntry.objects.bulk_create(
+            [WorkflowInboxEntry(instance=instance, role=role) for role in missing]
+        )
+
+
+def replace_inbox(roles_by_instance):
+    """Overwrite the inbox of many instances at once from ``{instance_id: roles}``."""
+    WorkflowInboxEntry.objects.filter(instance_id__in=list(roles_by_instance)).delete()
+    WorkflowInboxEntry.objects.bulk_create([
+        WorkflowInboxEntry(instance_id=instance_id, role=role)
+        for instance_id, roles in roles_by_instance.items()
+        for role in roles
+    ])
+
+
+def rebuild_inbox(instances):
+    """Recompute inbox entries for a queryset of instances in a constant number of queries."""
+    rows = list(instances.values_list('id', 'workflow_version_id', 'current_state', 'escalations'))
+    roles_by_instance = {}
+    for instance_id, version_id, current_state, escalations in rows:
+        try:
+            workflow = get_compiled_version(version_id)
+        except WorkflowDefinition.DoesNotExist:
+            roles_by_instance[instance_id] = ()
+            continue
+        roles_by_instance[instance_id] = workflow.actionable_roles(current_state) | escalated_roles(escalations)
+    replace_inbox(roles_by_instance)
+    return len(rows)
@@ -0,0 +1,176 @@
+import json
+import logging
+import time
+
+from django.db import connection, transaction
+
+from .inbox import replace_inbox
+from .models import FormSubmission, FormTemplate, WorkflowDefinition, WorkflowInstance
+from .notify import instance_message, notify_instances
+from .sla import arm_timers
+from .state_machine import get_compiled_workflow, with_current_version
+from .validators import SchemaError, format_errors, get_validator
+
+logger = logging.getLogger(__name__)
+
+
+class IngestReport:
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def error(self, line_no, message):
+        self.errors.append({"line": line_no, "error": message})
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "created": self.created,
+            "failed": len(self.errors),
+            "errors": self.errors,
+            "elapsed": round(self.elapsed, 3),
+            "rows_per_sec": round(self.rows_per_sec, 1),
+        }
+
+
+class _TemplateRules:
+    """Everything needed to accept a row for one template, resolved once per import."""
+
+    def __init__(self, template, workflow):
+        self.template = template
+        self.workflow = workflow
+        self.validator = get_validator(template)
+
+    def validate(self, data):
+        errors = self.validator.validate(data)
+        return format_errors(errors) if errors else None
+
+
+def _resolve(templates, template_id):
+    if template_id not in templates:
+        try:
+            template = with_current_version(FormTemplate.objects).get(id=template_id)
+            workflow = get_compiled_workflow(template_id, template.current_version_id)
+            templates[template_id] = _TemplateRules(template, workflow)
+        except (FormTemplate.DoesNotExist, WorkflowDefinition.DoesNotExist, SchemaError):
+            templates[template_id] = None
+    return templates[template_id]
+
+
+def _bulk_create(model, objs):
+    # Backends that can't return primary keys from a multi-row INSERT (SQLite on
+    # Django 3.2) fall back to one INSERT per row; the chunk is still one transaction.
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    for obj in objs:
+        obj.save(force_insert=True)
+    return objs
+
+
+def _flush(pending, report):
+    """Insert a chunk in one transaction. If that fails its lines are reported, so the
+    client can resend just those, and the import goes on with the next chunk."""
+    if not pending:
+        return
+    try:
+        _insert(pending)
+    except Exception as e:
+        logger.exception("Import of lines %d-%d failed", pending[0][0], pending[-1][0])
+        for line_no, _, _ in pending:
+            report.error(line_no, f"Not imported, the chunk of lines {pending[0][0]}-{pending[-1][0]} failed: {e}")
+    else:
+        report.created += len(pending)
+    pending.clear()
+
+
+def _insert(pending):
+    with transaction.atomic():
+        submissions = _bulk_create(FormSubmission, [submission for _, submission, _ in pending])
+        instances = _bulk_create(WorkflowInstance, [
+            WorkflowInstance(submission=submission, workflow_version_id=rules.workflow.version_id,
+                             current_state=rules.workflow.initial_state,
+                             is_open=not rules.workflow.is_terminal(rules.workflow.initial_state))
+            for submission, (_, _, rules) in zip(submissions, pending)
+        ])
+        roles = {
+            instance.id: rules.workflow.actionable_roles(instance.current_state)
+            for instance, (_, _, rules) in zip(instances, pending)
+        }
+        replace_inbox(roles)
+        arm_timers({
+            instance.id: (rules.workflow, instance.current_state)
+            for instance, (_, _, rules) in zip(instances, pending)
+        }, replace=False)
+        notify_instances(
+            instance_message(instance, submission.submitted_by, (), roles[instance.id])
+            for instance, submission in zip(instances, submissions)
+        )
+
+
+def ingest_submissions(lines, submitted_by, chunk_size=500):
+    """Create submissions and their workflow instances from NDJSON lines.
+
+    Each line is ``{"form_template": <id>, "data": {...}, "submitted_by": "..."}``
+    (``submitted_by`` defaults to the importing user). ``lines`` is consumed
+    lazily, so a request body or file is never held in memory, and valid rows
+    are inserted ``chunk_size`` at a time, each chunk in its own transaction.
+    Invalid lines, and the lines of a chunk that could not be inserted, are
+    reported with their line number and skipped: resending just those lines
+    completes the import.
+    """
+    report = IngestReport()
+    templates = {}
+    pending = []
+
+    for line_no, raw in enumerate(lines, 1):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', errors='replace')
+        raw = raw.strip()
+        if not raw:
+            continue
+        report.rows += 1
+
+        try:
+            row = json.loads(raw)
+        except ValueError as e:
+            report.error(line_no, f"Invalid JSON: {e}")
+            continue
+        if not isinstance(row, dict) or not isinstance(row.get("data"), dict):
+            report.error(line_no, "Expected an object with a 'data' object.")
+            continue
+        template_id = row.get("form_template")
+        if not isinstance(template_id, int):
+            report.error(line_no, "'form_template' must be an integer id.")
+            continue
+        row_submitted_by = row.get("submitted_by", submitted_by)
+        if not isinstance(row_submitted_by, str) or not 0 < len(row_submitted_by) <= 100:
+            report.error(line_no, "'submitted_by' must be a string of 1 to 100 characters.")
+            continue
+
+        rules = _resolve(templates, template_id)
+        if rules is None:
+            report.error(line_no, f"Form template {template_id} does not exist, has no workflow or has an invalid schema.")
+            continue
+        error = rules.validate(row["data"])
+        if error:
+            report.error(line_no, error)
+            continue
+
+        pending.append((
+            line_no,
+            FormSubmission(form_template=rules.template, submitted_by=row_submitted_by, data=row["data"]),
+            rules,
+        ))
+        if len(pending) >= chunk_size:
+            _flush(pending, report)
+
+    _flush(pending, report)
+    report.elapsed = time.perf_counter() - report.started
+    return report
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.analytics import fold
+from core.archive import archive_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Move workflow instances that reached a terminal state more than --days ago, with their "
+        "submissions and events, into the archive tables. Each batch commits on its own, so an "
+        "interrupted run can simply be started again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.WORKFLOW_ARCHIVE_AFTER_DAYS,
+                            help="Archive instances closed at least this many days ago.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Instances moved per transaction.")
+
+    def handle(self, *args, **options):
+        while fold():
+            pass  # archived events are never folded into the analytics rollups, so catch up first
+        before = timezone.now() - timedelta(days=options['days'])
+        archived = 0
+        while True:
+            count = archive_batch(before, options['batch_size'])
+            archived += count
+            if count:
+                self.stdout.write(f"Archived {archived} instances")
+            if count < options['batch_size']:
+                break
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} instances closed before {before:%Y-%m-%d %H:%M}"))
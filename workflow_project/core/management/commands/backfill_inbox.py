@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.inbox import rebuild_inbox
+from core.models import WorkflowInstance
+
+
+class Command(BaseCommand):
+    help = "Rebuild the role inbox (WorkflowInboxEntry) for existing workflow instances."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        total = 0
+        while True:
+            ids = list(
+                WorkflowInstance.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                total += rebuild_inbox(WorkflowInstance.objects.filter(id__in=ids))
+            last_id = ids[-1]
+            self.stdout.write(f"Rebuilt inbox for {total} instances", ending='\r')
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt inbox for {total} instances"))
@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core import benchmark
+from core.auth import keycloak
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway test database, call every API endpoint and check query counts "
+        "against budgets. Writes p50/p99 latency per endpoint to a JSON report and fails "
+        "if any endpoint exceeds its query budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=100000)
+        parser.add_argument('--workflows', type=int, default=50)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--iterations', type=int, default=20, help="Requests per endpoint.")
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            help="Only run this endpoint (repeatable).")
+        parser.add_argument('--report', default='benchmark_report.json')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.stdout.write(f"Seeding {options['submissions']} submissions over {options['workflows']} workflows...")
+            templates = benchmark.seed(options['submissions'], options['workflows'], options['users'])
+            scenario = benchmark.Scenario(templates, benchmark.TokenFactory())
+            results = benchmark.run(scenario, options['iterations'], options['endpoints'])
+        finally:
+            keycloak.key_store.clear()
+            keycloak.token_cache.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'database': connection.vendor,
+            'submissions': options['submissions'],
+            'workflows': options['workflows'],
+            'iterations': options['iterations'],
+            'endpoints': results,
+        }
+        with open(options['report'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.stdout.write(f"{'endpoint':<28} {'queries':>7} {'budget':>6} {'p50 ms':>9} {'p99 ms':>9}  status")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<28} {result['max_queries']:>7} {result['query_budget']:>6} "
+                f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}  {','.join(map(str, result['statuses']))}"
+            )
+        self.stdout.write(f"Report written to {options['report']}")
+
+        over_budget = [name for name, result in results.items() if not result['within_budget']]
+        if over_budget:
+            raise CommandError(f"Query budget exceeded: {', '.join(over_budget)}")
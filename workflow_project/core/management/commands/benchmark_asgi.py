@@ -0,0 +1,143 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from core import benchmark
+from core.auth import keycloak
+
+ENDPOINTS = ['/api/pending-approvals/?limit=10', '/api/my-submissions/?limit=10', '/api/transitions/1/']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare throughput of the read endpoints under WSGI (a fixed thread pool) and "
+        "ASGI (one event loop) while a local Keycloak stub answers JWKS requests slowly. "
+        "Each wave forgets one of two signing keys, so a share of requests must refetch keys."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--latency', type=float, default=500, help="Stub JWKS latency in ms.")
+        parser.add_argument('--waves', type=int, default=10)
+        parser.add_argument('--concurrency', type=int, default=100, help="Requests in flight per wave.")
+        parser.add_argument('--threads', type=int, default=8, help="WSGI worker threads.")
+        parser.add_argument('--cold-fraction', type=float, default=0.25,
+                            help="Share of requests signed with the key that must be refetched.")
+        parser.add_argument('--submissions', type=int, default=2000)
+
+    @override_settings(WORKFLOW_THROTTLES={})  # measures the views, not the rate limits
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        store = keycloak.key_store
+        saved = (store.config_url, store.min_refetch_interval)
+        warm = benchmark.TokenFactory('warm', install=False)
+        cold = benchmark.TokenFactory('cold', install=False)
+        stub = benchmark.StubKeycloak([warm.public_jwk, cold.public_jwk], delay=options['latency'] / 1000)
+        try:
+            benchmark.seed(options['submissions'], workflows=5, users=50)
+            store.clear()
+            store.config_url, store.min_refetch_interval = stub.config_url, 0
+
+            requests = self._requests(warm, cold, options)
+            results = {}
+            for mode in ('wsgi', 'asgi'):
+                stub.jwks_requests = 0
+                run = self._wsgi if mode == 'wsgi' else self._asgi
+                results[mode] = self._waves(run, requests, warm, options) + (stub.jwks_requests,)
+        finally:
+            stub.close()
+            store.clear()
+            store.config_url, store.min_refetch_interval = saved
+            keycloak.token_cache.clear()
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(
+            f"{options['waves']} waves x {options['concurrency']} requests, "
+            f"{options['cold_fraction']:.0%} needing a key refetch, JWKS latency {options['latency']:.0f} ms"
+        )
+        self.stdout.write(f"{'mode':<6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'jwks fetches':>13}")
+        for mode, (throughput, p50, p99, fetches) in results.items():
+            self.stdout.write(f"{mode:<6} {throughput:>9.1f} {p50:>9.1f} {p99:>9.1f} {fetches:>13}")
+
+    @staticmethod
+    def _requests(warm, cold, options):
+        count = options['concurrency']
+        cold_every = round(1 / options['cold_fraction']) if options['cold_fraction'] > 0 else 0
+        requests = []
+        for i in range(count):
+            tokens = cold if cold_every and i % cold_every == 0 else warm
+            requests.append((ENDPOINTS[i % len(ENDPOINTS)], tokens.headers(f'user{i % 50}', 'Manager', 'HR')))
+        return requests
+
+    @staticmethod
+    def _waves(run, requests, warm, options):
+        latencies = []
+        elapsed = 0.0
+        for _ in range(options['waves']):
+            # Only the warm key is known; requests signed with the cold key have to refetch.
+            keycloak.key_store.load({'keys': [warm.public_jwk]})
+            keycloak.token_cache.clear()
+            started = time.perf_counter()
+            latencies.extend(run(requests))
+            elapsed += time.perf_counter() - started
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return len(latencies) / elapsed, statistics.median(latencies) * 1000, p99 * 1000
+
+    def _wsgi(self, requests):
+        # Latency is measured from the start of the wave, so time spent queued
+        # for a free thread counts, just as it would for a client.
+        started = time.perf_counter()
+
+        def call(request):
+            path, headers = request
+            response = Client().get(path, **headers)
+            assert response.status_code == 200, response.content
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            return list(pool.map(call, requests))
+
+    def _asgi(self, requests):
+        from workflow_project.asgi import application
+
+        async def call(path, headers):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path.split('?')[0], 'raw_path': path.encode(),
+                'query_string': path.partition('?')[2].encode(),
+                'root_path': '', 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+                'headers': [(b'host', b'testserver'),
+                            (b'authorization', headers['HTTP_AUTHORIZATION'].encode())],
+            }
+            status = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            await application(scope, receive, send)
+            assert status == [200], status
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+
+        async def wave():
+            return await asyncio.gather(*(call(path, headers) for path, headers in requests))
+
+        return asyncio.run(wave())
+
+    def execute(self, *args, **options):
+        self.threads = options.get('threads', 8)
+        return super().execute(*args, **options)
@@ -0,0 +1,61 @@
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.management.base import BaseCommand
+from jose import jwk, jwt
+
+from core.auth import keycloak
+
+
+class Command(BaseCommand):
+    help = "Measure decode_token cost per request with and without the verified-token cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--tokens', type=int, default=10,
+                            help="Distinct bearer tokens cycled through, e.g. one per polling client.")
+
+    def handle(self, *args, **options):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+        public_jwk['kid'] = 'bench'
+        keycloak.key_store.load({'keys': [public_jwk]})
+
+        exp = int(time.time()) + 3600
+        tokens = [
+            jwt.encode({'aud': 'account', 'exp': exp, 'sub': f'user-{i}'}, private_pem,
+                       algorithm='RS256', headers={'kid': 'bench'})
+            for i in range(options['tokens'])
+        ]
+
+        cache = keycloak.token_cache
+        max_size = cache.max_size
+        try:
+            cache.max_size = 0
+            uncached = self._run(tokens, options['requests'])
+            cache.max_size = max_size or 10000
+            cache.clear()
+            cached = self._run(tokens, options['requests'])
+        finally:
+            cache.max_size = max_size
+            cache.clear()
+            keycloak.key_store.clear()
+
+        self.stdout.write(f"requests: {options['requests']}, distinct tokens: {options['tokens']}")
+        self.stdout.write(f"without token cache: {uncached:9.1f} us/request")
+        self.stdout.write(f"with token cache:    {cached:9.1f} us/request")
+        self.stdout.write(f"speedup:             {uncached / cached:9.1f}x")
+
+    @staticmethod
+    def _run(tokens, count):
+        started = time.perf_counter()
+        for i in range(count):
+            keycloak.decode_token(tokens[i % len(tokens)])
+        return (time.perf_counter() - started) / count * 1e6
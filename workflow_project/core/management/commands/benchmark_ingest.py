@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.ingest import ingest_submissions
+from core.models import FormTemplate, Transition, WorkflowDefinition
+from core.state_machine import forget_workflow
+
+
+class Command(BaseCommand):
+    help = "Measure NDJSON submission ingestion throughput. Everything is rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--chunk-size', type=int, nargs='+', default=[100, 500, 2000])
+
+    def handle(self, *args, **options):
+        for chunk_size in options['chunk_size']:
+            with transaction.atomic():
+                template = FormTemplate.objects.create(
+                    name='benchmark-ingest',
+                    schema={'fields': [
+                        {'name': 'employee', 'type': 'text', 'required': True},
+                        {'name': 'amount', 'type': 'number', 'required': True},
+                        {'name': 'note', 'type': 'text'},
+                    ]},
+                )
+                workflow = WorkflowDefinition.objects.create(form_template=template, states=['Submitted', 'Approved'])
+                Transition.objects.create(workflow=workflow, from_state='Submitted', to_state='Approved',
+                                          allowed_roles=['Manager'])
+
+                lines = (
+                    f'{{"form_template": {template.id}, "submitted_by": "user{i % 97}", '
+                    f'"data": {{"employee": "E{i}", "amount": {i % 5000}, "note": "legacy row {i}"}}}}'
+                    for i in range(options['rows'])
+                )
+                report = ingest_submissions(lines, 'benchmark', chunk_size)
+                transaction.set_rollback(True)
+            forget_workflow(template.id)
+
+            self.stdout.write(
+                f"chunk_size={chunk_size:<6} rows={report.rows:<8} "
+                f"{report.elapsed:8.2f}s {report.rows_per_sec:10.0f} rows/sec"
+            )
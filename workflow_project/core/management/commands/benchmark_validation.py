@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.validators import FormValidator
+
+FIELD_TYPES = [
+    {'type': 'text', 'min_length': 1, 'max_length': 200},
+    {'type': 'number', 'min': 0, 'max': 100000},
+    {'type': 'date'},
+    {'type': 'text', 'enum': ['low', 'medium', 'high']},
+    {'type': 'text', 'pattern': r'[A-Z]{3}-\d{4}'},
+]
+SAMPLE_VALUES = ['some text', '1234.5', '2025-06-30', 'medium', 'ABC-1234']
+
+
+class Command(BaseCommand):
+    help = "Measure form validations per second for a synthetic template."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fields', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        fields = []
+        data = {}
+        for i in range(options['fields']):
+            spec = dict(FIELD_TYPES[i % len(FIELD_TYPES)], name=f'field_{i}', required=i % 2 == 0)
+            fields.append(spec)
+            data[spec['name']] = SAMPLE_VALUES[i % len(SAMPLE_VALUES)]
+        schema = {'fields': fields}
+        iterations = options['iterations']
+
+        validator = FormValidator(schema)
+        assert not validator.validate(data)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            validator.validate(data)
+        cached = iterations / (time.perf_counter() - started)
+
+        rebuild_iterations = max(1, iterations // 10)
+        started = time.perf_counter()
+        for _ in range(rebuild_iterations):
+            FormValidator(schema).validate(data)
+        rebuilt = rebuild_iterations / (time.perf_counter() - started)
+
+        self.stdout.write(f"{options['fields']}-field form")
+        self.stdout.write(f"compiled once:        {cached:10.0f} validations/sec")
+        self.stdout.write(f"compiled per request: {rebuilt:10.0f} validations/sec")
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from core.export import EXPORT_FORMATS
+from core.models import WorkflowInstance
+from core.search import SearchError, filter_instances
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream submissions with their workflow state as CSV or NDJSON to a file ('-' for stdout). "
+        "Filters are the query parameters of GET /api/submissions/, e.g. --filter form_template=3 "
+        "--filter data.amount__gt=5000."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--filter', action='append', dest='filters', default=[], metavar='NAME=VALUE')
+        parser.add_argument('--chunk-size', type=int, default=settings.WORKFLOW_EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        params = QueryDict(mutable=True)
+        for item in options['filters']:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f"--filter expects NAME=VALUE, got {item!r}")
+            params.appendlist(name, value)
+        try:
+            instances = filter_instances(WorkflowInstance.objects.all(), params)
+        except SearchError as e:
+            raise CommandError(str(e))
+
+        _, chunks = EXPORT_FORMATS[options['format']]
+        rows = chunks(instances, params.get('form_template'), options['chunk_size'])
+        if options['path'] == '-':
+            for chunk in rows:
+                self.stdout.write(chunk, ending='')
+        else:
+            with open(options['path'], 'w', encoding='utf-8', newline='') as out:
+                for chunk in rows:
+                    out.write(chunk)
+            self.stderr.write(f"Exported to {options['path']}")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.analytics import fold, rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold new instances and transitions into the analytics rollups behind /api/analytics/. "
+        "Run it every few minutes, e.g. from cron; concurrent runs wait for each other."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Instances and events folded per transaction.")
+        parser.add_argument('--rebuild', action='store_true',
+                            help="First recount instances per state from their current state and fold only "
+                                 "newer rows, e.g. when the counts have drifted. Run it while nothing transitions.")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write(f"Counted {rebuild()} instances in their current state")
+        folded = 0
+        while True:
+            count = fold(options['batch_size'])
+            if not count:
+                break
+            folded += count
+        self.stdout.write(self.style.SUCCESS(f"Folded {folded} instances and transitions"))
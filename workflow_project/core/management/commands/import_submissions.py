@@ -0,0 +1,31 @@
+import json
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.ingest import ingest_submissions
+
+
+class Command(BaseCommand):
+    help = "Import form submissions from an NDJSON file (one submission per line, '-' for stdin)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--submitted-by', default='import',
+                            help="Submitter recorded for lines without a 'submitted_by' key.")
+        parser.add_argument('--chunk-size', type=int, default=settings.WORKFLOW_INGEST_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            report = ingest_submissions(sys.stdin, options['submitted_by'], options['chunk_size'])
+        else:
+            with open(options['path'], encoding='utf-8') as lines:
+                report = ingest_submissions(lines, options['submitted_by'], options['chunk_size'])
+
+        for error in report.errors:
+            self.stderr.write(json.dumps(error))
+        self.stdout.write(
+            f"{report.created} of {report.rows} rows imported "
+            f"in {report.elapsed:.2f}s ({report.rows_per_sec:.0f} rows/sec)"
+        )
@@ -0,0 +1,117 @@
+import asyncio
+import resource
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.auth import keycloak
+from core.benchmark import TokenFactory
+from core.notify import InProcessBroker
+from core.sse import STREAM_PATH, event_stream
+
+
+class Command(BaseCommand):
+    help = (
+        "Hold thousands of idle /api/stream/ connections and measure the cost of one "
+        "broadcast. Runs the ASGI handler in-process by default; pass --url and --token "
+        "to open real connections against a running ASGI worker instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=5000)
+        parser.add_argument('--messages', type=int, default=10, help="Broadcasts sent while connected.")
+        parser.add_argument('--url', help="e.g. http://localhost:8000 (server must run workflow_project.asgi)")
+        parser.add_argument('--token', help="Bearer token used for every connection with --url.")
+        parser.add_argument('--hold', type=float, default=10.0, help="Seconds to keep connections open with --url.")
+
+    def handle(self, *args, **options):
+        if options['url']:
+            if not options['token']:
+                raise CommandError("--url needs --token")
+            asyncio.run(self._remote(options))
+        else:
+            try:
+                asyncio.run(self._in_process(options))
+            finally:
+                keycloak.key_store.clear()
+                keycloak.token_cache.clear()
+
+    async def _in_process(self, options):
+        from core import notify
+
+        count = options['connections']
+        broker = notify._broker = InProcessBroker()
+        headers = [(b'authorization', TokenFactory().headers('approver', 'Manager')['HTTP_AUTHORIZATION'].encode())]
+        delivered = {'count': 0, 'target': 0}
+        all_delivered = asyncio.Event()
+        closed = asyncio.Event()
+
+        async def receive():
+            await closed.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message.get('body', b'').startswith(b'id:'):
+                delivered['count'] += 1
+                if delivered['count'] == delivered['target']:
+                    all_delivered.set()
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        tasks = [
+            asyncio.ensure_future(event_stream(
+                {'type': 'http', 'path': STREAM_PATH, 'headers': headers, 'query_string': b''}, receive, send
+            ))
+            for _ in range(count)
+        ]
+        while broker.subscriber_count < count:
+            await asyncio.sleep(0.01)
+        connect_time = time.perf_counter() - started
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        fanout = []
+        for n in range(1, options['messages'] + 1):
+            all_delivered.clear()
+            delivered['target'] = count * n
+            started = time.perf_counter()
+            broker.publish({'type': 'instance', 'submission_id': n, 'submitted_by': 'someone',
+                            'current_state': 'Approved', 'partial_approvals': {},
+                            'old_roles': ['Manager'], 'roles': []})
+            await all_delivered.wait()
+            fanout.append(time.perf_counter() - started)
+
+        closed.set()
+        await asyncio.gather(*tasks)
+        self.stdout.write(f"connections:           {count}")
+        self.stdout.write(f"connect time:          {connect_time:.2f} s")
+        self.stdout.write(f"peak RSS growth:       {(rss_after - rss_before) / 1024:.1f} MB "
+                          f"(~{(rss_after - rss_before) * 1024 / count:.0f} bytes/connection)")
+        self.stdout.write(f"broadcast to all, p50: {sorted(fanout)[len(fanout) // 2] * 1000:.1f} ms, "
+                          f"max: {max(fanout) * 1000:.1f} ms")
+
+    async def _remote(self, options):
+        url = urlsplit(options['url'])
+        request = (
+            f"GET {STREAM_PATH} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+            f"Authorization: Bearer {options['token']}\r\nAccept: text/event-stream\r\n\r\n"
+        ).encode()
+
+        async def connect():
+            reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+            writer.write(request)
+            await writer.drain()
+            status = await reader.readline()
+            return reader, writer, b' 200 ' in status
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(connect() for _ in range(options['connections'])), return_exceptions=True)
+        connections = [r for r in results if not isinstance(r, BaseException)]
+        ok = sum(1 for _, _, accepted in connections if accepted)
+        self.stdout.write(f"opened {ok}/{options['connections']} streams in {time.perf_counter() - started:.2f} s")
+
+        await asyncio.sleep(options['hold'])
+        alive = sum(1 for reader, _, accepted in connections if accepted and not reader.at_eof())
+        for _, writer, _ in connections:
+            writer.close()
+        self.stdout.write(f"{alive} streams still open after {options['hold']:.0f} s")
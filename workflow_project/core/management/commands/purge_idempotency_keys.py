@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired Idempotency-Key records in batches. Run it periodically, e.g. hourly from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows deleted per statement.")
+
+    def handle(self, *args, **options):
+        purged = purge_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} expired idempotency keys"))
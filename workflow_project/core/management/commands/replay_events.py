@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.events import rebuild_instances
+from core.models import WorkflowInstance
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild WorkflowInstance.current_state and partial_approvals from the "
+        "WorkflowEvent log. With --check, only report instances that drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--submission', type=int, action='append', dest='submissions',
+                            help="Only replay this submission (repeatable).")
+        parser.add_argument('--check', action='store_true', help="Report drift without writing.")
+
+    def handle(self, *args, **options):
+        instances = WorkflowInstance.objects.all()
+        if options['submissions']:
+            instances = instances.filter(submission_id__in=options['submissions'])
+        drifted = rebuild_instances(instances, chunk_size=options['batch_size'], save=not options['check'])
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS("Every instance matches its event history"))
+        elif options['check']:
+            raise CommandError(f"{len(drifted)} instances differ from their event history: {drifted[:20]}")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(drifted)} instances from their event history"))
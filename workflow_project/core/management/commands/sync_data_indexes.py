@@ -0,0 +1,58 @@
+import signal
+import threading
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from core.models import FormTemplate
+from core.search import sync_data_indexes
+
+# A template saved in a transaction that commits after a pass started is still
+# picked up by the next pass as long as the transaction took less than this.
+WATCH_OVERLAP = timedelta(minutes=5)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create and drop the PostgreSQL expression indexes on FormSubmission.data "
+        "declared by '\"indexed\": true' template fields, and rebuild those a failed build "
+        "left invalid. A no-op on other databases. Run with --watch next to the web "
+        "workers so templates saved through the API get their indexes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--template', type=int, action='append', dest='templates',
+                            help="Only sync this form template (repeatable).")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--watch', type=float, metavar='SECONDS',
+                            help="Keep running, syncing the templates saved since the last pass every SECONDS.")
+
+    def handle(self, *args, **options):
+        templates = FormTemplate.objects.using(options['database']).order_by('id')
+        if options['templates']:
+            templates = templates.filter(id__in=options['templates'])
+        if not options['watch']:
+            self.sync(templates, options['database'])
+            self.stdout.write(self.style.SUCCESS("Data indexes are in sync"))
+            return
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        self.stdout.write("Watching form templates for indexed fields")
+        since = None
+        while not stop.is_set():
+            started = timezone.now()
+            self.sync(templates if since is None else templates.filter(updated_at__gte=since), options['database'])
+            since = started - WATCH_OVERLAP
+            stop.wait(options['watch'])
+
+    def sync(self, templates, using):
+        for template in templates:
+            created, dropped = sync_data_indexes(template, using=using)
+            for name in dropped:
+                self.stdout.write(f"dropped {name} on template {template.id}")
+            for name in created:
+                self.stdout.write(f"created {name} on template {template.id}")
@@ -0,0 +1,288 @@
+"""Per-request performance metrics, exposed in the Prometheus text format at ``/metrics``.
+
+``MetricsMiddleware`` times every request by endpoint (its URL name), method
+and status. A sampled share of requests (``WORKFLOW_METRICS_SAMPLE_RATE``)
+also records ORM query count and time, token verification time and
+serializer time: queries through an execute wrapper installed on every
+database connection, phases through ``timed()`` blocks in the auth
+decorators and views. Both report to the request's ``RequestStats`` through a
+context variable, so async views' ``sync_to_async`` threads are counted too.
+A sampled request slower than ``WORKFLOW_SLOW_REQUEST_MS`` is logged with its
+slowest SQL.
+
+Metrics are kept per process; scrape every worker.
+"""
+import asyncio
+import bisect
+import contextvars
+import heapq
+import hmac
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+SLOW_SQL_KEPT = 3
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._series.get(labels, 0)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def collect(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in series:
+            lines.append(f'{self.name}{_labels(list(zip(self.labelnames, labels)))} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram; each series is ``[count per bucket..., +Inf count, sum]``."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels):
+        with self._lock:
+            return sum(self._series.get(labels, [0.0])[:-1])
+
+    def total(self, *labels):
+        with self._lock:
+            return self._series.get(labels, [0.0])[-1]
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def collect(self):
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, values in series:
+            pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(pairs + [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(pairs)} {_number(values[-1])}')
+            lines.append(f'{self.name}_count{_labels(pairs)} {cumulative}')
+        return lines
+
+
+REQUESTS = Counter('workflow_http_requests_total', 'Requests handled.', ('endpoint', 'method', 'status'))
+LATENCY = Histogram('workflow_http_request_duration_seconds', 'Time to produce the response.',
+                    ('endpoint', 'method'))
+DB_QUERIES = Histogram('workflow_db_queries_per_request', 'ORM queries per sampled request.',
+                       ('endpoint',), QUERY_COUNT_BUCKETS)
+DB_TIME = Histogram('workflow_db_duration_seconds', 'Time in database queries per sampled request.', ('endpoint',))
+PHASES = {
+    'auth': Histogram('workflow_auth_duration_seconds',
+                      'Token verification (JWT decode and signing key lookup) per sampled request.', ('endpoint',)),
+    'serializer': Histogram('workflow_serializer_duration_seconds',
+                            'Time rendering serializer data per sampled request.', ('endpoint',)),
+}
+ADMISSION_REJECTED = Counter('workflow_admission_rejected_total',
+                             'Requests turned away by rate limits, concurrency caps or load shedding.',
+                             ('endpoint', 'reason'))
+JWKS_FETCH = Histogram('workflow_jwks_fetch_duration_seconds', 'Fetches of the signing keys from Keycloak.',
+                       ('outcome',))
+
+
+def render():
+    """The whole registry in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in REGISTRY:
+        metric.clear()
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_time', 'phases', 'slowest')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.phases = {}
+        self.slowest = []  # min-heap of (seconds, sql), the SLOW_SQL_KEPT slowest queries
+
+    def add_query(self, elapsed, sql):
+        self.queries += 1
+        self.db_time += elapsed
+        if len(self.slowest) < SLOW_SQL_KEPT:
+            heapq.heappush(self.slowest, (elapsed, sql))
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (elapsed, sql))
+
+
+_current = contextvars.ContextVar('workflow_request_stats', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper: time the query for the sampled request, if any."""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(time.perf_counter() - started, sql)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """``connection_created`` receiver that adds ``record_query`` to the connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to ``phase`` of the current sampled request."""
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[phase] = stats.phases.get(phase, 0.0) + time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Outermost middleware: records every request against its endpoint. Sync and async capable."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'WORKFLOW_METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'WORKFLOW_METRICS_SAMPLE_RATE', 1.0)
+        self.slow_seconds = getattr(settings, 'WORKFLOW_SLOW_REQUEST_MS', 1000) / 1000
+        self._async = asyncio.iscoroutinefunction(get_response)
+        if self._async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # how Django detects async middleware
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        started, token = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            stats = _current.get()
+            _current.reset(token)
+        self._record(request, response, time.perf_counter() - started, stats)
+        return response
+
+    async def __acall__(self, request):
+        started, token = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stats = _current.get()
+            _current.reset(token)
+        self._record(request, response, time.perf_counter() - started, stats)
+        return response
+
+    def _start(self):
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        return time.perf_counter(), _current.set(RequestStats() if sampled else None)
+
+    def _record(self, request, response, elapsed, stats):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = (match.url_name or match.route) if match else 'unmatched'
+        method = request.method if request.method in METHODS else 'other'
+        REQUESTS.inc(endpoint, method, str(response.status_code))
+        LATENCY.observe(elapsed, endpoint, method)
+        if stats is None:
+            return
+        DB_QUERIES.observe(stats.queries, endpoint)
+        DB_TIME.observe(stats.db_time, endpoint)
+        for phase, seconds in stats.phases.items():
+            PHASES[phase].observe(seconds, endpoint)
+        if elapsed >= self.slow_seconds:
+            slowest = '; '.join(f'{seconds * 1000:.1f} ms: {sql[:500]}'
+                                for seconds, sql in sorted(stats.slowest, reverse=True))
+            logger.warning(
+                "Slow request %s %s (%s) took %.0f ms: %d queries in %.0f ms, %s. Slowest SQL: %s",
+                request.method, request.path, endpoint, elapsed * 1000, stats.queries, stats.db_time * 1000,
+                ', '.join(f'{phase} {seconds * 1000:.0f} ms' for phase, seconds in stats.phases.items()) or 'no phases',
+                slowest or 'none',
+            )
+
+
+def metrics_view(request):
+    """``GET /metrics``. Requires ``Authorization: Bearer <WORKFLOW_METRICS_TOKEN>`` when that is set."""
+    token = getattr(settings, 'WORKFLOW_METRICS_TOKEN', None)
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
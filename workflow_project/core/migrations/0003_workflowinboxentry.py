@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20250630_0059'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowInboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='workflowinstance',
+            index=models.Index(fields=['-updated_at', '-id'], name='instance_recent_idx'),
+        ),
+        migrations.AddField(
+            model_name='workflowinboxentry',
+            name='instance',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='core.workflowinstance'),
+        ),
+        migrations.AddConstraint(
+            model_name='workflowinboxentry',
+            constraint=models.UniqueConstraint(fields=('role', 'instance'), name='unique_inbox_role_instance'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_workflowinboxentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowdefinition',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
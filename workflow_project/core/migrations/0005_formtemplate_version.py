@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_workflowdefinition_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='formtemplate',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_formtemplate_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='formsubmission',
+            name='submitted_by',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+    ]
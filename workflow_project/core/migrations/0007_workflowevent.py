@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_formsubmission_submitted_by_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('approved', 'Approved'), ('transitioned', 'Transitioned')], max_length=20)),
+                ('actor', models.CharField(max_length=100)),
+                ('roles', models.JSONField(default=list)),
+                ('from_state', models.CharField(max_length=100)),
+                ('to_state', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='core.workflowinstance')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='workflowevent',
+            index=models.Index(fields=['instance', 'id'], name='event_instance_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workflowevent',
+            index=models.Index(fields=['actor', 'created_at'], name='event_actor_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workflowevent',
+            index=models.Index(fields=['created_at'], name='event_time_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_workflowevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='formtemplate',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='workflowdefinition',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:26
+
+from django.db import migrations, models
+
+TRY_NUMERIC = """
+CREATE OR REPLACE FUNCTION workflow_try_numeric(value text) RETURNS numeric AS $$
+BEGIN
+    RETURN value::numeric;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+
+def create_postgres_search(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(TRY_NUMERIC)
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS submission_data_gin ON core_formsubmission USING gin (data jsonb_path_ops)"
+    )
+    # Expression indexes for schema fields marked "indexed" on existing templates.
+    from core.search import sync_data_indexes
+    for template in apps.get_model('core', 'FormTemplate').objects.all():
+        sync_data_indexes(template, using=schema_editor.connection.alias)
+
+
+def drop_postgres_search(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE indexname LIKE %s", [r'fs\_data\_t%'])
+        names = [name for name, in cursor.fetchall()]
+    for name in names + ['submission_data_gin']:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {schema_editor.quote_name(name)}')
+    schema_editor.execute("DROP FUNCTION IF EXISTS workflow_try_numeric(text)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_updated_at_stamps'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='formsubmission',
+            index=models.Index(fields=['form_template', 'submitted_at'], name='submission_template_time_idx'),
+        ),
+        migrations.RunPython(create_postgres_search, drop_postgres_search),
+    ]
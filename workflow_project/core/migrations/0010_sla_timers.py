@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_submission_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transition',
+            name='escalate_to',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='transition',
+            name='sla_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transition',
+            name='timeout_action',
+            field=models.CharField(choices=[('notify', 'Notify'), ('escalate', 'Escalate'), ('transition', 'Auto-transition')], default='notify', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='workflowinstance',
+            name='escalations',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AlterField(
+            model_name='workflowevent',
+            name='kind',
+            field=models.CharField(choices=[('approved', 'Approved'), ('transitioned', 'Transitioned'), ('escalated', 'Escalated'), ('overdue', 'Overdue')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='WorkflowTimer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(max_length=100)),
+                ('entered_at', models.DateTimeField()),
+                ('step', models.PositiveSmallIntegerField(default=0)),
+                ('due_at', models.DateTimeField(db_index=True)),
+                ('lease', models.CharField(blank=True, default='', max_length=32)),
+                ('instance', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='timer', to='core.workflowinstance')),
+            ],
+        ),
+    ]
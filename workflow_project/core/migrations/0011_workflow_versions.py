@@ -0,0 +1,60 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def snapshot_definitions(apps, schema_editor):
+    # Every definition's current states and transitions become its first version,
+    # and every instance is pinned to the version of its template's workflow.
+    WorkflowDefinition = apps.get_model('core', 'WorkflowDefinition')
+    WorkflowVersion = apps.get_model('core', 'WorkflowVersion')
+    Transition = apps.get_model('core', 'Transition')
+    WorkflowInstance = apps.get_model('core', 'WorkflowInstance')
+    for workflow in WorkflowDefinition.objects.iterator():
+        version = WorkflowVersion.objects.create(workflow=workflow, number=workflow.version, states=workflow.states)
+        Transition.objects.filter(workflow=workflow).update(version=version)
+        WorkflowDefinition.objects.filter(id=workflow.id).update(current_version=version)
+        WorkflowInstance.objects.filter(submission__form_template_id=workflow.form_template_id).update(
+            workflow_version=version
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_sla_timers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('states', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='core.workflowdefinition')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transition',
+            name='version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='transitions', to='core.workflowversion'),
+        ),
+        migrations.AddField(
+            model_name='workflowdefinition',
+            name='current_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.workflowversion'),
+        ),
+        migrations.AddField(
+            model_name='workflowinstance',
+            name='workflow_version',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='instances', to='core.workflowversion'),
+        ),
+        migrations.AddConstraint(
+            model_name='workflowversion',
+            constraint=models.UniqueConstraint(fields=('workflow', 'number'), name='unique_workflow_version'),
+        ),
+        migrations.RunPython(snapshot_definitions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def close_finished_instances(apps, schema_editor):
+    # Instances already in a terminal state (no transitions out of it) are closed.
+    WorkflowVersion = apps.get_model('core', 'WorkflowVersion')
+    Transition = apps.get_model('core', 'Transition')
+    WorkflowInstance = apps.get_model('core', 'WorkflowInstance')
+    for version in WorkflowVersion.objects.iterator():
+        sources = Transition.objects.filter(version=version).values_list('from_state', flat=True)
+        terminal = set(version.states) - set(sources)
+        if terminal:
+            WorkflowInstance.objects.filter(workflow_version=version, current_state__in=terminal).update(is_open=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_workflow_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedEvent',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('approved', 'Approved'), ('transitioned', 'Transitioned'), ('escalated', 'Escalated'), ('overdue', 'Overdue')], max_length=20)),
+                ('actor', models.CharField(max_length=100)),
+                ('roles', models.JSONField(default=list)),
+                ('from_state', models.CharField(max_length=100)),
+                ('to_state', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedInstance',
+            fields=[
+                ('submission_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('instance_id', models.BigIntegerField()),
+                ('submitted_by', models.CharField(max_length=100)),
+                ('data', models.JSONField()),
+                ('submitted_at', models.DateTimeField()),
+                ('current_state', models.CharField(max_length=100)),
+                ('partial_approvals', models.JSONField(default=dict)),
+                ('escalations', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='workflowinstance',
+            name='is_open',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='workflowinstance',
+            index=models.Index(condition=models.Q(('is_open', False)), fields=['updated_at', 'id'], name='instance_closed_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedinstance',
+            name='form_template',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.formtemplate'),
+        ),
+        migrations.AddField(
+            model_name='archivedinstance',
+            name='workflow_version',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='archived_instances', to='core.workflowversion'),
+        ),
+        migrations.AddField(
+            model_name='archivedevent',
+            name='instance',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='core.archivedinstance'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedinstance',
+            index=models.Index(fields=['submitted_by', '-updated_at'], name='archived_submitter_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedevent',
+            index=models.Index(fields=['instance', 'id'], name='archived_event_instance_idx'),
+        ),
+        migrations.RunPython(close_finished_instances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seed_state_counts(apps, schema_editor):
+    # Count existing instances where they are now (those that moved before
+    # the event log existed have no events to fold) and start folding after
+    # the last existing instance and event, like analytics.rebuild.
+    WorkflowInstance = apps.get_model('core', 'WorkflowInstance')
+    ArchivedInstance = apps.get_model('core', 'ArchivedInstance')
+    WorkflowEvent = apps.get_model('core', 'WorkflowEvent')
+    ArchivedEvent = apps.get_model('core', 'ArchivedEvent')
+    StateCount = apps.get_model('core', 'StateCount')
+    AnalyticsWatermark = apps.get_model('core', 'AnalyticsWatermark')
+    counts = {}
+    for queryset, template in ((WorkflowInstance.objects, 'submission__form_template_id'),
+                               (ArchivedInstance.objects, 'form_template_id')):
+        rows = (queryset.filter(workflow_version__isnull=False).order_by()
+                .values_list(template, 'current_state').annotate(n=models.Count('pk')))
+        for template_id, state, n in rows:
+            counts[template_id, state] = counts.get((template_id, state), 0) + n
+    StateCount.objects.bulk_create([
+        StateCount(form_template_id=template_id, state=state, count=n) for (template_id, state), n in counts.items()
+    ])
+    AnalyticsWatermark.objects.create(
+        id=1,
+        last_instance_id=max(WorkflowInstance.objects.aggregate(top=models.Max('id'))['top'] or 0,
+                             ArchivedInstance.objects.aggregate(top=models.Max('instance_id'))['top'] or 0),
+        last_event_id=max(WorkflowEvent.objects.aggregate(top=models.Max('id'))['top'] or 0,
+                          ArchivedEvent.objects.aggregate(top=models.Max('id'))['top'] or 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_instance_id', models.BigIntegerField(default=0)),
+                ('last_event_id', models.BigIntegerField(default=0)),
+                ('folded_until', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TransitionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_state', models.CharField(max_length=100)),
+                ('to_state', models.CharField(max_length=100)),
+                ('hour', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+                ('sketch', models.JSONField(default=dict)),
+                ('form_template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.formtemplate')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StateCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(max_length=100)),
+                ('count', models.IntegerField(default=0)),
+                ('form_template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.formtemplate')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='transitionrollup',
+            index=models.Index(fields=['hour'], name='transition_rollup_hour_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='transitionrollup',
+            constraint=models.UniqueConstraint(fields=('form_template', 'from_state', 'to_state', 'hour'), name='unique_transition_rollup'),
+        ),
+        migrations.AddConstraint(
+            model_name='statecount',
+            constraint=models.UniqueConstraint(fields=('form_template', 'state'), name='unique_state_count'),
+        ),
+        migrations.RunPython(seed_state_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_roles(apps, schema_editor):
+    WorkflowVersion = apps.get_model('core', 'WorkflowVersion')
+    WorkflowVersionRole = apps.get_model('core', 'WorkflowVersionRole')
+    for version in WorkflowVersion.objects.iterator():
+        roles = {role for allowed in version.transitions.values_list('allowed_roles', flat=True) for role in allowed}
+        WorkflowVersionRole.objects.bulk_create([WorkflowVersionRole(version=version, role=role) for role in roles])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowVersionRole',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(max_length=100)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='roles', to='core.workflowversion')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='workflowversionrole',
+            constraint=models.UniqueConstraint(fields=('role', 'version'), name='unique_version_role'),
+        ),
+        migrations.RunPython(record_roles, migrations.RunPython.noop),
+    ]
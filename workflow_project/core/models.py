@@ -1,44 +1,263 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import Q
 
 class FormTemplate(models.Model):
     name = models.CharField(max_length=100, unique=True)
     schema = models.JSONField()
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # ETag stamp, see etags
+    version = models.PositiveIntegerField(default=1)  # bumped on every edit, see validators
 
     def __str__(self):
         return self.name
 
 class WorkflowDefinition(models.Model):
     form_template = models.OneToOneField(FormTemplate, on_delete=models.CASCADE)
-    states = models.JSONField()
+    states = models.JSONField()  # of the current version
+    version = models.PositiveIntegerField(default=1)  # number of the current version, see state_machine
+    current_version = models.ForeignKey('WorkflowVersion', on_delete=models.SET_NULL, null=True, blank=True,
+                                        related_name='+')  # None until first published
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # ETag stamp, see etags
 
     def __str__(self):
         return f"Workflow for {self.form_template.name}"
 
+    @property
+    def current_transitions(self):
+        # Transitions of the current version; before the first publish, the ones not yet in a version.
+        if self.current_version_id is None:
+            return self.transitions.filter(version__isnull=True)
+        return self.current_version.transitions.all()
+
+class WorkflowVersion(models.Model):
+    # Immutable snapshot of a definition's states and transitions. Edits add a
+    # version instead of rewriting transitions; instances keep the version they
+    # started on, see state_machine.create_version.
+    workflow = models.ForeignKey(WorkflowDefinition, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    states = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['workflow', 'number'], name='unique_workflow_version')]
+
+    def __str__(self):
+        return f"{self.workflow} v{self.number}"
+
+class WorkflowVersionRole(models.Model):
+    # Denormalized "who takes part in this version": one row per role allowed on
+    # any of its transitions, so search can find the workflows a user has a role
+    # in with one indexed subquery, see search.visible_to.
+    version = models.ForeignKey(WorkflowVersion, on_delete=models.CASCADE, related_name='roles')
+    role = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['role', 'version'], name='unique_version_role')]
+
+    def __str__(self):
+        return f"{self.role} → {self.version_id}"
+
 class Transition(models.Model):
     workflow = models.ForeignKey(WorkflowDefinition, on_delete=models.CASCADE, related_name='transitions')
+    version = models.ForeignKey(WorkflowVersion, on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='transitions')
     from_state = models.CharField(max_length=100)
     to_state = models.CharField(max_length=100)
     allowed_roles = models.JSONField()
     logical_type = models.CharField(max_length=10, default="OR")  # NEW FIELD
+    # SLA: seconds an instance may wait in from_state before timeout_action fires, see core.sla
+    NOTIFY, ESCALATE, AUTO_TRANSITION = 'notify', 'escalate', 'transition'
+    TIMEOUT_ACTIONS = [(NOTIFY, 'Notify'), (ESCALATE, 'Escalate'), (AUTO_TRANSITION, 'Auto-transition')]
+    sla_seconds = models.PositiveIntegerField(null=True, blank=True)
+    timeout_action = models.CharField(max_length=20, choices=TIMEOUT_ACTIONS, default=NOTIFY)
+    escalate_to = models.JSONField(default=list, blank=True)  # roles that may also approve once escalated
 
     def __str__(self):
         return f"{self.from_state} → {self.to_state}"
 
 class FormSubmission(models.Model):
     form_template = models.ForeignKey(FormTemplate, on_delete=models.CASCADE)
-    submitted_by = models.CharField(max_length=100)
+    submitted_by = models.CharField(max_length=100, db_index=True)
     data = models.JSONField()
     submitted_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # data also has a GIN index and per-field expression indexes on PostgreSQL, see core.search
+        indexes = [models.Index(fields=['form_template', 'submitted_at'], name='submission_template_time_idx')]
+
     def __str__(self):
         return f"{self.form_template.name} by {self.submitted_by}"
 
 class WorkflowInstance(models.Model):
     submission = models.OneToOneField(FormSubmission, on_delete=models.CASCADE)
+    # The definition version the instance runs on, for life. None only for instances
+    # whose template had no workflow when versions were introduced.
+    workflow_version = models.ForeignKey(WorkflowVersion, on_delete=models.PROTECT, null=True,
+                                         related_name='instances')
     current_state = models.CharField(max_length=100)
     partial_approvals = models.JSONField(default=dict)  # NEW FIELD
+    escalations = models.JSONField(default=dict)  # {to_state: [roles]} added by SLA escalation until the state changes
+    # False once the instance reaches a terminal state (one without outgoing transitions);
+    # closed instances are moved to ArchivedInstance after a while, see core.archive.
+    is_open = models.BooleanField(default=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-updated_at', '-id'], name='instance_recent_idx'),
+            models.Index(fields=['updated_at', 'id'], condition=Q(is_open=False), name='instance_closed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.submission.form_template.name} - {self.current_state}"
+
+class WorkflowInboxEntry(models.Model):
+    # Denormalized "who can act on this instance right now": one row per role
+    # allowed on any transition out of the instance's current state.
+    instance = models.ForeignKey(WorkflowInstance, on_delete=models.CASCADE, related_name='inbox_entries')
+    role = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['role', 'instance'], name='unique_inbox_role_instance')]
+
+    def __str__(self):
+        return f"{self.role} → {self.instance_id}"
+
+class WorkflowEvent(models.Model):
+    # Append-only history of every approval. WorkflowInstance.current_state and
+    # partial_approvals can be rebuilt from these rows, see core.events.replay.
+    APPROVED = 'approved'          # partial approval of an AND transition
+    TRANSITIONED = 'transitioned'  # approval (or SLA auto-transition) that moved the instance
+    ESCALATED = 'escalated'        # SLA breach that let ``roles`` approve ``to_state`` too
+    OVERDUE = 'overdue'            # SLA breach that only notified
+    KIND_CHOICES = [(APPROVED, 'Approved'), (TRANSITIONED, 'Transitioned'),
+                    (ESCALATED, 'Escalated'), (OVERDUE, 'Overdue')]
+
+    instance = models.ForeignKey(WorkflowInstance, on_delete=models.CASCADE, related_name='events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    actor = models.CharField(max_length=100)
+    roles = models.JSONField(default=list)  # the actor's roles that allowed the transition
+    from_state = models.CharField(max_length=100)
+    to_state = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['instance', 'id'], name='event_instance_idx'),
+            models.Index(fields=['actor', 'created_at'], name='event_actor_time_idx'),
+            models.Index(fields=['created_at'], name='event_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.actor}: {self.from_state} → {self.to_state}"
+
+class WorkflowTimer(models.Model):
+    # The next SLA deadline of an instance, one row per instance whose current
+    # state has outgoing transitions with sla_seconds. Workers claim due rows
+    # by pushing due_at forward by a lease, see core.sla.
+    instance = models.OneToOneField(WorkflowInstance, on_delete=models.CASCADE, related_name='timer')
+    state = models.CharField(max_length=100)  # the state the deadlines count from
+    entered_at = models.DateTimeField()
+    step = models.PositiveSmallIntegerField(default=0)  # index into the state's deadlines, earliest first
+    due_at = models.DateTimeField(db_index=True)
+    lease = models.CharField(max_length=32, blank=True, default='')
+
+    def __str__(self):
+        return f"{self.instance_id} due {self.due_at}"
+
+class ArchivedInstance(models.Model):
+    # A closed WorkflowInstance and its FormSubmission, moved out of the live
+    # tables by ``manage.py archive_instances``. Keeps the submission id, so the
+    # history endpoint still finds it.
+    submission_id = models.BigIntegerField(primary_key=True)
+    instance_id = models.BigIntegerField()
+    form_template = models.ForeignKey(FormTemplate, on_delete=models.CASCADE, related_name='+')
+    workflow_version = models.ForeignKey(WorkflowVersion, on_delete=models.PROTECT, null=True,
+                                         related_name='archived_instances')
+    submitted_by = models.CharField(max_length=100)
+    data = models.JSONField()
+    submitted_at = models.DateTimeField()
+    current_state = models.CharField(max_length=100)
+    partial_approvals = models.JSONField(default=dict)
+    escalations = models.JSONField(default=dict)
+    updated_at = models.DateTimeField()  # when the instance closed
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['submitted_by', '-updated_at'], name='archived_submitter_idx')]
+
+    def __str__(self):
+        return f"{self.submission_id} - {self.current_state} (archived)"
+
+class ArchivedEvent(models.Model):
+    # WorkflowEvent of an archived instance, with its original id.
+    id = models.BigIntegerField(primary_key=True)
+    instance = models.ForeignKey(ArchivedInstance, on_delete=models.CASCADE, related_name='events')
+    kind = models.CharField(max_length=20, choices=WorkflowEvent.KIND_CHOICES)
+    actor = models.CharField(max_length=100)
+    roles = models.JSONField(default=list)
+    from_state = models.CharField(max_length=100)
+    to_state = models.CharField(max_length=100)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['instance', 'id'], name='archived_event_instance_idx')]
+
+    def __str__(self):
+        return f"{self.actor}: {self.from_state} → {self.to_state}"
+
+class StateCount(models.Model):
+    # Instances per template and state, folded in from new instances and
+    # transition events by core.analytics; archived instances stay counted.
+    form_template = models.ForeignKey(FormTemplate, on_delete=models.CASCADE, related_name='+')
+    state = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['form_template', 'state'], name='unique_state_count')]
+
+    def __str__(self):
+        return f"{self.form_template_id} {self.state}: {self.count}"
+
+class TransitionRollup(models.Model):
+    # Transitions made in one hour: how many, and a mergeable sketch of the
+    # time instances had spent in from_state, see core.analytics.DurationSketch.
+    form_template = models.ForeignKey(FormTemplate, on_delete=models.CASCADE, related_name='+')
+    from_state = models.CharField(max_length=100)
+    to_state = models.CharField(max_length=100)
+    hour = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+    sketch = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['form_template', 'from_state', 'to_state', 'hour'],
+                                               name='unique_transition_rollup')]
+        indexes = [models.Index(fields=['hour'], name='transition_rollup_hour_idx')]
+
+    def __str__(self):
+        return f"{self.from_state} → {self.to_state} at {self.hour}: {self.count}"
+
+class AnalyticsWatermark(models.Model):
+    # Single row: how far the instances and events have been folded into the rollups.
+    last_instance_id = models.BigIntegerField(default=0)
+    last_event_id = models.BigIntegerField(default=0)
+    folded_until = models.DateTimeField(null=True)
+
+class IdempotencyKey(models.Model):
+    # An Idempotency-Key sent with a POST or PUT and the response it got; the
+    # row is inserted before the request runs, see core.idempotency.
+    username = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)  # None while the first request is running
+    response = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['username', 'key'], name='unique_idempotency_key')]
+
     def __str__(self):
-        return f"{self.submission.form_template.name} - {self.current_state}"
\ No newline at end of file
+        return f"{self.username}: {self.key}"
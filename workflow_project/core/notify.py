@@ -0,0 +1,221 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class Subscription:
+    """One connected stream. Messages are delivered on the subscriber's event loop."""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # A client this far behind refetches instead of getting every delta.
+            self.overflowed = True
+
+
+class InProcessBroker:
+    """Fans workflow notifications out to the streams connected to this process.
+
+    ``publish`` may be called from any thread; delivery is scheduled onto each
+    subscriber's event loop. The last ``history`` messages are kept so a client
+    reconnecting with ``Last-Event-ID`` gets what it missed. Event ids are
+    ``<epoch>-<seq>``; ids from another process or an older epoch are unknown
+    and the client is told to reset.
+    """
+
+    def __init__(self, history=1000, queue_size=100):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.queue_size = queue_size
+        self._seq = itertools.count(1)
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, message):
+        with self._lock:
+            seq = next(self._seq)
+            self._history.append((seq, message))
+            subscribers = list(self._subscribers)
+        by_loop = {}
+        for subscription in subscribers:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(self._deliver, subscriptions, (seq, message))
+            except RuntimeError:  # loop already closed
+                with self._lock:
+                    self._subscribers.difference_update(subscriptions)
+
+    @staticmethod
+    def _deliver(subscriptions, item):
+        for subscription in subscriptions:
+            subscription._put(item)
+
+    def subscribe(self):
+        subscription = Subscription(asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def since(self, last_event_id):
+        """Messages after ``last_event_id`` as ``[(seq, message)]``, or None if it is unknown."""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            history = list(self._history)
+        if history and seq < history[0][0] - 1:
+            return None  # fell out of the buffer
+        return [item for item in history if item[0] > seq]
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+class PostgresBroker(InProcessBroker):
+    """Relays notifications between processes with Postgres LISTEN/NOTIFY.
+
+    ``publish`` sends ``pg_notify``; a listener thread started on first
+    subscribe feeds received payloads to this process's subscribers. Requires
+    psycopg2 and the ``default`` database to be PostgreSQL.
+    """
+
+    channel = 'workflow_events'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._listener = None
+
+    def publish(self, message):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.channel, json.dumps(message)])
+
+    def subscribe(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='workflow-notify', daemon=True)
+                self._listener.start()
+        return super().subscribe()
+
+    def _listen(self):
+        import select
+
+        import psycopg2
+
+        db = settings.DATABASES['default']
+        while True:
+            try:
+                conn = psycopg2.connect(
+                    dbname=db['NAME'], user=db.get('USER'), password=db.get('PASSWORD'),
+                    host=db.get('HOST') or None, port=db.get('PORT') or None,
+                )
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                # Anything sent while we were disconnected is lost; tell clients to refetch.
+                super().publish({'type': 'reset'})
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        super().publish(json.loads(conn.notifies.pop(0).payload))
+            except Exception:
+                logger.exception("Workflow notification listener failed, reconnecting")
+                threading.Event().wait(5)
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.WORKFLOW_NOTIFY_BROKER)()
+    return _broker
+
+
+def _publish_on_commit(messages):
+    transaction.on_commit(lambda: [get_broker().publish(message) for message in messages])
+
+
+def instance_message(instance, submitted_by, old_roles, roles):
+    return {
+        'type': 'instance',
+        'submission_id': instance.submission_id,
+        'submitted_by': submitted_by,
+        'current_state': instance.current_state,
+        'partial_approvals': dict(instance.partial_approvals),
+        'old_roles': sorted(old_roles),
+        'roles': sorted(roles),
+    }
+
+
+def notify_instances(messages):
+    """Publish ``instance_message`` dicts once the current transaction commits."""
+    messages = list(messages)
+    if messages:
+        _publish_on_commit(messages)
+
+
+def notify_reset():
+    """Tell every connected client to refetch, e.g. after a workflow definition changed."""
+    _publish_on_commit([{'type': 'reset'}])
+
+
+def render_for(message, username, user_roles):
+    """The SSE events ``message`` produces for one user, as ``[(event, data)]``.
+
+    The submitter gets a ``submission`` status update; users holding a role that
+    could act on the instance before or after the change get an ``inbox``
+    delta with ``action`` added / removed / updated.
+    """
+    if message['type'] == 'reset':
+        return [('reset', {})]
+    events = []
+    if message['submitted_by'] == username:
+        events.append(('submission', {
+            'submission_id': message['submission_id'],
+            'current_state': message['current_state'],
+            'partial_approvals': message['partial_approvals'],
+        }))
+    was_actionable = any(role in user_roles for role in message['old_roles'])
+    is_actionable = any(role in user_roles for role in message['roles'])
+    if was_actionable or is_actionable:
+        action = 'updated' if was_actionable and is_actionable else 'added' if is_actionable else 'removed'
+        data = {
+            'submission_id': message['submission_id'],
+            'action': action,
+            'current_state': message['current_state'],
+        }
+        if message.get('overdue'):
+            data['overdue'] = message['overdue']  # SLA breached on the transition to this state
+        events.append(('inbox', data))
+    return events
@@ -0,0 +1,95 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination over a fixed, unique ordering.
+
+    Unlike OFFSET pagination each page is a single indexed range scan, so deep
+    pages cost the same as the first one. The response body stays a plain list;
+    the next page is advertised through the ``Link`` and ``X-Next-Cursor``
+    headers.
+    """
+    ordering = ('-updated_at', '-id')
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+
+    def __init__(self, ordering=None):
+        if ordering is not None:
+            self.ordering = ordering
+        self.next_cursor = None
+        self.request = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self._after(queryset.model, self.decode_cursor(cursor)))
+
+        page = list(queryset[:limit + 1])
+        if len(page) > limit:
+            page = page[:limit]
+            self.next_cursor = self.encode_cursor(page[-1])
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(data, headers=self.get_paginated_headers())
+
+    def get_paginated_headers(self):
+        headers = {}
+        if self.next_cursor:
+            url = replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+            headers['Link'] = f'<{url}>; rel="next"'
+            headers['X-Next-Cursor'] = self.next_cursor
+        return headers
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            size = self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, obj):
+        values = []
+        for field in self.ordering:
+            # Pages of .values() rows are dicts.
+            value = obj[field.lstrip('-')] if isinstance(obj, dict) else getattr(obj, field.lstrip('-'))
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise NotFound("Invalid cursor")
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound("Invalid cursor")
+        return values
+
+    def _after(self, model, values):
+        # (a, b) < (x, y)  ==  a < x OR (a = x AND b < y), for each ordering prefix.
+        names = [field.lstrip('-') for field in self.ordering]
+        try:
+            values = [model._meta.get_field(name).to_python(value) for name, value in zip(names, values)]
+        except Exception:
+            raise NotFound("Invalid cursor")
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            clause = Q(**{f'{names[i]}__{lookup}': values[i]})
+            for name, value in zip(names[:i], values[:i]):
+                clause &= Q(**{name: value})
+            condition |= clause
+        return condition
@@ -0,0 +1,54 @@
+"""JSON rendering through orjson, when it is installed.
+
+``FastJSONRenderer`` is a drop-in ``JSONRenderer``: for the payloads the API
+returns it produces the same bytes, several times faster. It hands back to
+the stdlib encoder whenever the two could differ:
+
+* indented output was asked for, or ``UNICODE_JSON`` or ``COMPACT_JSON`` is off;
+* the data holds something orjson refuses (non-string keys, integers beyond
+  64 bits, objects DRF's encoder cannot handle);
+* a float needs an exponent, which orjson writes as ``1e16`` where Python
+  writes ``1e+16``.
+
+Dates, times, decimals and the like still go through DRF's ``JSONEncoder``,
+so they keep its formats. One difference remains: NaN and infinities, which
+``JSONRenderer`` refuses under ``STRICT_JSON``, come out as ``null``.
+Without orjson this is plain ``JSONRenderer``.
+"""
+import re
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+_EXPONENT = re.compile(rb'\de[-\d]')  # also matches some strings, which merely costs a stdlib pass
+
+
+class FastJSONRenderer(JSONRenderer):
+    def __init__(self):
+        self._default = self.encoder_class().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {})):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data, default=self._default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS,
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if _EXPONENT.search(ret):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Like JSONRenderer, escape the two characters that are valid JSON but end a JavaScript line.
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+def render_json(data):
+    """``data`` as JSON bytes, through the first of ``DEFAULT_RENDERER_CLASSES``."""
+    return api_settings.DEFAULT_RENDERER_CLASSES[0]().render(data)
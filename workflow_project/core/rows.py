@@ -0,0 +1,128 @@
+"""Serializer output built straight from ``.values()`` rows.
+
+Instantiating a ``ModelSerializer`` and walking it per object costs far more
+than the data it produces. ``row_serializer`` looks at a serializer's fields
+once (per ``fields`` / ``expand`` projection) and compiles them into a map
+from ``values()`` columns to output keys, nesting included. Serializing a
+page is then a dict build per row, with the same output as the serializer:
+leaves are passed through as read, except dates, formatted like
+``DateTimeField`` does.
+
+Serializers with anything else (method fields, lists, custom fields) are not
+compiled; callers fall back to the serializer for those.
+"""
+from functools import lru_cache
+from operator import itemgetter
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+# Fields whose to_representation returns what .values() already holds.
+_PLAIN = (
+    serializers.IntegerField, serializers.CharField, serializers.BooleanField, serializers.FloatField,
+    serializers.PrimaryKeyRelatedField,
+)
+
+
+class RowSerializer:
+    """``serialize(rows)`` turns ``queryset.values(*columns)`` rows into the serializer's data."""
+
+    def __init__(self, columns, make):
+        self.columns = columns
+        self._make = make
+
+    def serialize(self, rows):
+        build = self._make(timezone.get_current_timezone() if settings.USE_TZ else None)
+        return [build(row) for row in rows]
+
+
+def _datetime(field, path, tz):
+    to_representation = field.to_representation
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if tz is None or hasattr(field, 'timezone') or output_format is None or output_format.lower() != ISO_8601:
+        return lambda row: None if row[path] is None else to_representation(row[path])
+
+    def get(row):
+        # DateTimeField.to_representation, with the current timezone looked up once per page.
+        value = row[path]
+        if value is None or value.utcoffset() is None:
+            return None if value is None else to_representation(value)
+        try:
+            value = value.astimezone(tz).isoformat()
+        except OverflowError:
+            return to_representation(row[path])
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return get
+
+
+def _leaf(field, path):
+    if type(field) in _PLAIN and getattr(field, 'pk_field', None) is None:
+        return lambda tz: itemgetter(path)
+    if type(field) is serializers.JSONField and not field.binary:
+        return lambda tz: itemgetter(path)
+    if type(field) is serializers.DateTimeField:
+        return lambda tz: _datetime(field, path, tz)
+    return None
+
+
+def _nested(make, path):
+    def make_getter(tz):
+        build = make(tz)
+        return lambda row: None if row[path] is None else build(row)
+    return make_getter
+
+
+def _compile(serializer, prefix, columns):
+    """A function of the current timezone returning the row builder for ``serializer``, or None."""
+    makers = []
+    for field in serializer._readable_fields:
+        if field.source == '*':
+            path = prefix
+        else:
+            path = '__'.join(filter(None, [prefix, *field.source_attrs]))
+        if isinstance(field, serializers.BaseSerializer):
+            if not isinstance(field, serializers.Serializer):
+                return None  # many=True
+            make = _compile(field, path, columns)
+            if make is None:
+                return None
+            if path != prefix:
+                columns.add(path)  # the relation's key: None when there is no related row
+                make = _nested(make, path)
+            makers.append((field.field_name, make))
+        elif field.source == '*':
+            return None
+        else:
+            make = _leaf(field, path)
+            if make is None:
+                return None
+            columns.add(path)
+            makers.append((field.field_name, make))
+
+    def make(tz):
+        getters = [(name, make_getter(tz)) for name, make_getter in makers]
+        return lambda row: {name: get(row) for name, get in getters}
+    return make
+
+
+@lru_cache(maxsize=256)
+def _row_serializer(serializer_class, fields, expand):
+    kwargs = {}
+    if fields is not None:
+        kwargs['fields'] = set(fields)
+    if expand is not None:
+        kwargs['expand'] = set(expand)
+    columns = set()
+    make = _compile(serializer_class(**kwargs), '', columns)
+    return RowSerializer(sorted(columns), make) if make is not None else None
+
+
+def row_serializer(serializer_class, fields=None, expand=None):
+    """The compiled ``RowSerializer`` for ``serializer_class(fields=..., expand=...)``, or None."""
+    return _row_serializer(
+        serializer_class,
+        frozenset(fields) if fields is not None else None,
+        frozenset(expand) if expand is not None else None,
+    )
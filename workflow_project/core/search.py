@@ -0,0 +1,263 @@
+"""Server-side filtering of workflow instances by template, state, submitter,
+dates and submitted form data.
+
+Every parameter is optional and they combine with AND::
+
+    form_template=<id>            state=<a>,<b>           submitted_by=<username>
+    submitted_after=<iso>         submitted_before=<iso>  open=true|false
+    data={"department": "IT"}     JSON containment
+    data.<path>[__<op>]=<value>   op: eq (default), ne, gt, gte, lt, lte, in, icontains
+
+A path comparison is numeric when the template's schema declares the field
+``number`` or ``integer`` (without ``form_template``: when a range operator
+gets a number), textual otherwise.
+
+On PostgreSQL containment is served by a GIN ``jsonb_path_ops`` index on
+``FormSubmission.data`` and path comparisons by partial expression indexes,
+one per template field marked ``"indexed": true`` in the schema, built by
+``manage.py sync_data_indexes`` (see ``sync_data_indexes``); those only
+apply when ``form_template`` is given.
+"""
+import datetime
+import hashlib
+import json
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import DecimalField, Func, Q, TextField
+from django.db.models.fields.json import KeyTextTransform, KeyTransform
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import FormSubmission, FormTemplate, WorkflowVersionRole
+
+NUMERIC, TEXT = 'numeric', 'text'
+NUMERIC_TYPES = {'number', 'integer'}
+RANGE_OPERATORS = {'gt', 'gte', 'lt', 'lte'}
+OPERATORS = {'eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'icontains'}
+PATH_RE = re.compile(r'^[\w-]+(\.[\w-]+)*$')
+
+# IMMUTABLE wrapper around ``::numeric`` that yields NULL instead of failing,
+# so an old row holding "n/a" cannot break an index build. Created in 0009.
+TRY_NUMERIC = 'workflow_try_numeric'
+
+
+class SearchError(ValueError):
+    """A filter that cannot be applied; the message is returned to the client."""
+
+
+class JsonNumber(Func):
+    """Numeric value of a JSON text expression, NULL where it does not parse.
+
+    On PostgreSQL this compiles to the expression the per-field indexes are built on.
+    """
+    output_field = DecimalField()
+    template = 'CAST(%(expressions)s AS REAL)'
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template=f'{TRY_NUMERIC}(%(expressions)s)', **extra_context)
+
+
+class JsonText(Func):
+    """Text of a JSON key. SQLite's JSON_EXTRACT keeps numbers numeric, so cast there."""
+    output_field = TextField()
+    template = 'CAST(%(expressions)s AS TEXT)'
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='%(expressions)s', **extra_context)
+
+
+def field_kind(field_type):
+    return NUMERIC if field_type in NUMERIC_TYPES else TEXT
+
+
+def field_kinds(schema, indexed_only=False):
+    """``{field name: 'numeric' | 'text'}`` for the fields of a FormTemplate schema."""
+    fields = schema.get('fields', []) if isinstance(schema, dict) else []
+    return {
+        spec['name']: field_kind(spec.get('type', 'text'))
+        for spec in fields
+        if isinstance(spec, dict) and isinstance(spec.get('name'), str) and (spec.get('indexed') or not indexed_only)
+    }
+
+
+def indexed_fields(schema):
+    """The ``field_kinds`` of schema fields marked ``"indexed": true``."""
+    return field_kinds(schema, indexed_only=True)
+
+
+def _parse_moment(param, value):
+    try:
+        moment = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise SearchError(f"'{param}' must be an ISO 8601 date or datetime.")
+    if not isinstance(moment, datetime.datetime):
+        moment = datetime.datetime.combine(moment, datetime.time.min)
+    return moment if timezone.is_aware(moment) else timezone.make_aware(moment)
+
+
+def _looks_numeric(value):
+    try:
+        return Decimal(value).is_finite()
+    except InvalidOperation:
+        return False
+
+
+def _number(param, value):
+    if not _looks_numeric(value):
+        raise SearchError(f"'{param}' must be a number.")
+    return Decimal(value)
+
+
+def _containment(prefix, value, path=()):
+    """``data @> value`` as key lookups, for backends without JSON containment."""
+    if isinstance(value, dict):
+        condition = Q()
+        for key, item in value.items():
+            condition &= _containment(prefix, item, path + (key,))
+        return condition
+    if isinstance(value, list):
+        raise SearchError("Containment of arrays needs PostgreSQL.")
+    return Q(**{'__'.join((prefix,) + path): value})
+
+
+def _key_text(prefix, path):
+    *parents, last = path
+    expression = prefix
+    for key in parents:
+        expression = KeyTransform(key, expression)
+    return KeyTextTransform(last, expression)
+
+
+def filter_instances(queryset, params, prefix='submission__'):
+    """Apply the filters in ``params`` (a QueryDict) to a WorkflowInstance queryset.
+
+    Raises SearchError for a parameter that does not parse.
+    """
+    data = f'{prefix}data'
+    form_template = params.get('form_template')
+    if form_template:
+        if not form_template.isdigit():
+            raise SearchError("'form_template' must be an id.")
+        queryset = queryset.filter(**{f'{prefix}form_template_id': int(form_template)})
+    state = params.get('state')
+    if state:
+        queryset = queryset.filter(current_state__in=[s.strip() for s in state.split(',') if s.strip()])
+    is_open = params.get('open')
+    if is_open:
+        if is_open not in ('true', 'false'):
+            raise SearchError("'open' must be true or false.")
+        queryset = queryset.filter(is_open=is_open == 'true')
+    submitted_by = params.get('submitted_by')
+    if submitted_by:
+        queryset = queryset.filter(**{f'{prefix}submitted_by': submitted_by})
+    for param, lookup in (('submitted_after', 'gte'), ('submitted_before', 'lt')):
+        value = params.get(param)
+        if value:
+            queryset = queryset.filter(**{f'{prefix}submitted_at__{lookup}': _parse_moment(param, value)})
+
+    contains = params.get('data')
+    if contains:
+        try:
+            contains = json.loads(contains)
+        except ValueError:
+            raise SearchError("'data' must be a JSON object.")
+        if not isinstance(contains, dict):
+            raise SearchError("'data' must be a JSON object.")
+        if connections[queryset.db].features.supports_json_field_contains:
+            queryset = queryset.filter(**{f'{data}__contains': contains})
+        else:
+            queryset = queryset.filter(_containment(data, contains))
+
+    comparisons = [(param, value) for param, value in params.items() if param.startswith('data.')]
+    kinds = {}
+    if comparisons and form_template:
+        kinds = field_kinds(FormTemplate.objects.filter(id=form_template).values_list('schema', flat=True).first())
+    for n, (param, value) in enumerate(comparisons):
+        path, _, op = param[len('data.'):].rpartition('__')
+        if op not in OPERATORS:
+            path, op = param[len('data.'):], 'eq'
+        if not PATH_RE.match(path):
+            raise SearchError(f"'{param}' is not a valid data path.")
+        path = path.split('.')
+        values = value.split(',') if op == 'in' else [value]
+
+        kind = kinds.get(path[0]) if len(path) == 1 else None
+        if kind is None:
+            kind = NUMERIC if op in RANGE_OPERATORS and all(map(_looks_numeric, values)) else TEXT
+        if kind == NUMERIC and op != 'icontains':
+            expression = JsonNumber(_key_text(data, path))
+            values = [_number(param, v) for v in values]
+        else:
+            expression = JsonText(_key_text(data, path))
+
+        alias = f'_data_{n}'
+        queryset = queryset.alias(**{alias: expression})
+        if op == 'eq':
+            queryset = queryset.filter(**{alias: values[0]})
+        elif op == 'ne':
+            queryset = queryset.exclude(**{alias: values[0]})
+        elif op == 'in':
+            queryset = queryset.filter(**{f'{alias}__in': values})
+        else:
+            queryset = queryset.filter(**{f'{alias}__{op}': values[0]})
+    return queryset
+
+
+def visible_to(username, user_roles):
+    """Instances a non-Admin may search: their own, plus every instance of a
+    workflow in which they hold a role (the same rule as submission history).
+    """
+    versions = WorkflowVersionRole.objects.filter(role__in=user_roles).values('version_id')
+    return Q(submission__submitted_by=username) | Q(workflow_version_id__in=versions)
+
+
+def _index_name(template_id, field, kind):
+    digest = hashlib.sha1(f'{field}:{kind}'.encode()).hexdigest()[:10]
+    return f'fs_data_t{template_id}_{digest}'
+
+
+def sync_data_indexes(template, using=DEFAULT_DB_ALIAS):
+    """Create and drop the partial expression indexes ``template.schema`` declares.
+
+    PostgreSQL only; elsewhere this is a no-op. Outside a transaction the
+    indexes are built ``CONCURRENTLY`` so submissions keep flowing, which can
+    take minutes, so this runs from ``manage.py sync_data_indexes`` rather than
+    in requests. An index left INVALID by a failed concurrent build is dropped
+    and built again. Returns the created and dropped index names.
+    """
+    db = connections[using]
+    if db.vendor != 'postgresql':
+        return [], []
+    quote = db.ops.quote_name
+    table = FormSubmission._meta.db_table
+    prefix = f'fs_data_t{template.id}_'
+    wanted = {_index_name(template.id, field, kind): (field, kind)
+              for field, kind in indexed_fields(template.schema).items()}
+    concurrently = '' if db.in_atomic_block else 'CONCURRENTLY '
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT idx.relname, pg_index.indisvalid FROM pg_index "
+            "JOIN pg_class idx ON idx.oid = pg_index.indexrelid "
+            "JOIN pg_class tbl ON tbl.oid = pg_index.indrelid "
+            "WHERE tbl.relname = %s AND idx.relname LIKE %s",
+            [table, prefix.replace('_', r'\_') + '%'],
+        )
+        existing = dict(cursor.fetchall())
+        invalid = {name for name, valid in existing.items() if not valid and name in wanted}
+        created = sorted(set(wanted) - set(existing) | invalid)
+        dropped = sorted(set(existing) - set(wanted) | invalid)
+        for name in dropped:
+            cursor.execute(f'DROP INDEX {concurrently}IF EXISTS {quote(name)}')
+        for name in created:
+            field, kind = wanted[name]
+            expression = f'{TRY_NUMERIC}(data ->> %s)' if kind == NUMERIC else '(data ->> %s)'
+            cursor.execute(
+                f'CREATE INDEX {concurrently}IF NOT EXISTS {quote(name)} ON {quote(table)} (({expression})) '
+                f'WHERE form_template_id = %s',
+                [field, template.id],
+            )
+    return created, dropped
@@ -1,28 +1,64 @@
+from django.db import transaction
 from rest_framework import serializers
-from .models import FormTemplate, WorkflowDefinition, Transition, FormSubmission, WorkflowInstance
+from .models import (
+    FormTemplate, WorkflowDefinition, Transition, FormSubmission, WorkflowInstance, WorkflowEvent, ArchivedInstance
+)
+from .state_machine import create_version
+from .validators import FormValidator, SchemaError
 
-class FormTemplateSerializer(serializers.ModelSerializer):
+class DynamicFieldsMixin:
+    """Accepts ``fields=[...]`` to drop every other top-level field from the output.
+
+    ``Meta.optional_fields`` are only output when ``fields`` asks for them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        keep = set(fields) if fields is not None else set(self.fields) - set(getattr(self.Meta, 'optional_fields', ()))
+        for name in set(self.fields) - keep:
+            self.fields.pop(name)
+
+class FormTemplateSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = FormTemplate
-        fields = ['id', 'name', 'schema', 'created_at']
+        fields = ['id', 'name', 'schema', 'created_at', 'version']
+        read_only_fields = ['version']
+        optional_fields = ['version']  # ?fields=...,version
+
+    def validate_schema(self, schema):
+        try:
+            FormValidator(schema, strict=True)
+        except SchemaError as e:
+            raise serializers.ValidationError(str(e))
+        return schema
 
 class TransitionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transition
-        fields = ['id', 'from_state', 'to_state', 'allowed_roles', 'logical_type']  # added logical_type
+        fields = ['id', 'from_state', 'to_state', 'allowed_roles', 'logical_type',  # added logical_type
+                  'sla_seconds', 'timeout_action', 'escalate_to']
+
+    def validate(self, attrs):
+        if attrs.get('timeout_action') == Transition.ESCALATE and not attrs.get('escalate_to'):
+            raise serializers.ValidationError({'escalate_to': "Escalation needs at least one role."})
+        return attrs
 
-class WorkflowDefinitionSerializer(serializers.ModelSerializer):
-    transitions = TransitionSerializer(many=True)
+class WorkflowDefinitionSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    # Reads show the current version's transitions; writes add a version, see state_machine.create_version.
+    transitions = TransitionSerializer(many=True, source='current_transitions')
 
     class Meta:
         model = WorkflowDefinition
-        fields = ['id', 'form_template', 'states', 'transitions']
+        fields = ['id', 'form_template', 'states', 'version', 'transitions']
+        read_only_fields = ['version']
+        optional_fields = ['version']
 
     def create(self, validated_data):
-        transitions_data = validated_data.pop('transitions')
-        workflow = WorkflowDefinition.objects.create(**validated_data)
-        for trans_data in transitions_data:
-            Transition.objects.create(workflow=workflow, **trans_data)
+        transitions_data = validated_data.pop('current_transitions')
+        with transaction.atomic():
+            workflow = WorkflowDefinition.objects.create(**validated_data)
+            create_version(workflow, transitions=transitions_data)
         return workflow
 
 class FormSubmissionSerializer(serializers.ModelSerializer):
@@ -33,9 +69,51 @@ class FormSubmissionSerializer(serializers.ModelSerializer):
         model = FormSubmission
         fields = ['id', 'form_template', 'form_template_details', 'submitted_by', 'data', 'submitted_at']
 
-class WorkflowInstanceSerializer(serializers.ModelSerializer):
+class FormSubmissionReferenceSerializer(serializers.ModelSerializer):
+    # Read-only variant that refers to the template by id instead of embedding it.
+    class Meta:
+        model = FormSubmission
+        fields = ['id', 'form_template', 'submitted_by', 'data', 'submitted_at']
+
+class WorkflowInstanceSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     submission = FormSubmissionSerializer()
 
     class Meta:
         model = WorkflowInstance
-        fields = ['id', 'submission', 'current_state', 'partial_approvals', 'updated_at']
\ No newline at end of file
+        fields = ['id', 'submission', 'current_state', 'partial_approvals', 'escalations', 'updated_at']
+        optional_fields = ['escalations']  # ?fields=...,escalations
+
+    def __init__(self, *args, **kwargs):
+        expand = kwargs.pop('expand', None)
+        super().__init__(*args, **kwargs)
+        if expand is not None and 'form_template' not in expand and 'submission' in self.fields:
+            self.fields['submission'] = FormSubmissionReferenceSerializer(read_only=True)
+
+class ArchivedSubmissionSerializer(serializers.Serializer):
+    # Same shape as FormSubmissionReferenceSerializer, read off the ArchivedInstance.
+    id = serializers.IntegerField(source='submission_id')
+    form_template = serializers.IntegerField(source='form_template_id')
+    submitted_by = serializers.CharField()
+    data = serializers.JSONField()
+    submitted_at = serializers.DateTimeField()
+
+class ArchivedInstanceSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    id = serializers.IntegerField(source='instance_id')
+    submission = ArchivedSubmissionSerializer(source='*')
+
+    class Meta:
+        model = ArchivedInstance
+        fields = ['id', 'submission', 'current_state', 'partial_approvals', 'escalations', 'updated_at',
+                  'archived_at']
+        optional_fields = ['escalations']
+
+    def __init__(self, *args, **kwargs):
+        kwargs.pop('expand', None)  # archived submissions always reference their template by id
+        super().__init__(*args, **kwargs)
+
+class WorkflowEventSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    submission_id = serializers.IntegerField(source='instance.submission_id', read_only=True)
+
+    class Meta:
+        model = WorkflowEvent
+        fields = ['id', 'submission_id', 'kind', 'actor', 'roles', 'from_state', 'to_state', 'created_at']
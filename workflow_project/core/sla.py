@@ -0,0 +1,241 @@
+"""SLA deadlines on workflow states and the scheduler that fires them.
+
+A transition may set ``sla_seconds``: how long an instance may wait in the
+transition's ``from_state`` before its ``timeout_action`` fires:
+
+* ``notify`` logs an ``overdue`` event and tells the approvers over the stream;
+* ``escalate`` also lets the ``escalate_to`` roles approve the transition;
+* ``transition`` moves the instance to ``to_state`` as ``SYSTEM_ACTOR``.
+
+An instance's next deadline is a single ``WorkflowTimer`` row, armed whenever
+the instance enters a state. Workers (``manage.py run_sla_scheduler``) keep
+the soonest deadlines in a min-heap, sleep until the top one is due, and
+claim due timers in batches by pushing ``due_at`` forward by a lease with a
+conditional UPDATE: exactly one worker's UPDATE matches a row, and the rows
+of a worker that dies come due again when its lease runs out. Workers only
+ever read the front of the ``due_at`` index, never the whole table.
+"""
+import heapq
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .inbox import escalated_roles, replace_inbox
+from .models import Transition, WorkflowDefinition, WorkflowEvent, WorkflowInstance, WorkflowTimer
+from .notify import instance_message, notify_instances
+from .state_machine import get_compiled_version
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_ACTOR = 'system:sla'
+
+
+def _timer(instance_id, workflow, state, entered_at, step=0):
+    deadlines = workflow.deadlines.get(state, ())
+    if step >= len(deadlines):
+        return None
+    return WorkflowTimer(
+        instance_id=instance_id, state=state, entered_at=entered_at, step=step,
+        due_at=entered_at + timedelta(seconds=deadlines[step].sla_seconds),
+    )
+
+
+def arm_timers(states, entered_at=None, replace=True):
+    """Start the SLA clock for instances that just entered a state.
+
+    ``states`` maps instance id to ``(compiled workflow, state)``. Their old
+    timers are dropped first unless ``replace`` is false (new instances).
+    """
+    entered_at = entered_at or timezone.now()
+    if replace and states:
+        WorkflowTimer.objects.filter(instance_id__in=list(states)).delete()
+    timers = [timer for timer in (_timer(instance_id, workflow, state, entered_at)
+                                  for instance_id, (workflow, state) in states.items()) if timer]
+    if timers:
+        WorkflowTimer.objects.bulk_create(timers)
+
+
+def rebuild_timers(instances):
+    """Re-arm the timers of a queryset of instances, e.g. ones created before SLA timers existed.
+
+    Time already spent in the current state is kept: it counts from the old
+    timer, or from ``updated_at`` for instances that had none.
+    """
+    rows = list(instances.values_list(
+        'id', 'workflow_version_id', 'current_state', 'updated_at',
+        'timer__state', 'timer__entered_at', 'timer__step',
+    ))
+    WorkflowTimer.objects.filter(instance_id__in=[row[0] for row in rows]).delete()
+    timers = []
+    for instance_id, version_id, state, updated_at, timer_state, timer_entered_at, timer_step in rows:
+        try:
+            workflow = get_compiled_version(version_id)
+        except WorkflowDefinition.DoesNotExist:
+            continue
+        if timer_state == state:
+            timer = _timer(instance_id, workflow, state, timer_entered_at, timer_step)
+        else:
+            timer = _timer(instance_id, workflow, state, updated_at)
+        if timer:
+            timers.append(timer)
+    WorkflowTimer.objects.bulk_create(timers, batch_size=1000)
+    return len(timers)
+
+
+def fire(token, now=None):
+    """Apply the timeout actions of every timer leased under ``token``.
+
+    One transaction for the whole batch: instances are locked and loaded with
+    one query and written back with ``bulk_update``, events go in one insert.
+    Each timer then moves to the state's next deadline, or is removed.
+    Returns the number of timeouts applied.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        timers = {timer.instance_id: timer for timer in WorkflowTimer.objects.filter(lease=token)}
+        instances = WorkflowInstance.objects.select_for_update(of=('self',)).select_related('submission').filter(
+            id__in=list(timers)
+        ).order_by('id')
+        changed, events, messages = [], [], []
+        inbox, entered, finished, rescheduled = {}, {}, [], []
+        for instance in instances:
+            timer = timers[instance.id]
+            try:
+                workflow = get_compiled_version(instance.workflow_version_id)
+            except WorkflowDefinition.DoesNotExist:
+                finished.append(timer.id)
+                continue
+            deadlines = workflow.deadlines.get(instance.current_state, ())
+            if timer.state != instance.current_state or timer.step >= len(deadlines):
+                finished.append(timer.id)  # the instance moved on; its new state was armed separately
+                continue
+
+            transition = deadlines[timer.step]
+            from_state = instance.current_state
+            old_roles = workflow.actionable_roles(from_state) | escalated_roles(instance.escalations)
+            roles = old_roles
+            if transition.timeout_action == Transition.AUTO_TRANSITION:
+                kind = WorkflowEvent.TRANSITIONED
+                partial_approvals = dict(instance.partial_approvals)
+                partial_approvals.pop(transition.to_state, None)
+                instance.partial_approvals = partial_approvals
+                instance.current_state = transition.to_state
+                instance.escalations = {}
+                instance.is_open = not workflow.is_terminal(transition.to_state)
+                roles = inbox[instance.id] = workflow.actionable_roles(transition.to_state)
+                entered[instance.id] = (workflow, transition.to_state)
+            elif transition.timeout_action == Transition.ESCALATE:
+                kind = WorkflowEvent.ESCALATED
+                escalations = dict(instance.escalations)
+                escalations[transition.to_state] = sorted(
+                    set(escalations.get(transition.to_state, ())) | set(transition.escalate_to)
+                )
+                instance.escalations = escalations
+                roles = inbox[instance.id] = old_roles | set(transition.escalate_to)
+            else:
+                kind = WorkflowEvent.OVERDUE
+
+            events.append(WorkflowEvent(
+                instance=instance, kind=kind, actor=SYSTEM_ACTOR,
+                roles=list(transition.escalate_to) if kind == WorkflowEvent.ESCALATED else [],
+                from_state=from_state, to_state=transition.to_state,
+            ))
+            message = instance_message(instance, instance.submission.submitted_by, old_roles, roles)
+            message['overdue'] = transition.to_state
+            messages.append(message)
+            if kind != WorkflowEvent.OVERDUE:
+                instance.updated_at = now
+                changed.append(instance)
+            if instance.id not in entered:
+                following = _timer(instance.id, workflow, from_state, timer.entered_at, timer.step + 1)
+                if following:
+                    timer.step, timer.due_at, timer.lease = following.step, following.due_at, ''
+                    rescheduled.append(timer)
+                else:
+                    finished.append(timer.id)
+
+        WorkflowInstance.objects.bulk_update(
+            changed, ['current_state', 'partial_approvals', 'escalations', 'is_open', 'updated_at']
+        )
+        WorkflowEvent.objects.bulk_create(events)
+        if inbox:
+            replace_inbox(inbox)
+        if finished:
+            WorkflowTimer.objects.filter(id__in=finished).delete()
+        WorkflowTimer.objects.bulk_update(rescheduled, ['step', 'due_at', 'lease'])
+        arm_timers(entered, now)
+        notify_instances(messages)
+    return len(events)
+
+
+class Scheduler:
+    """Fires due SLA timers. Run one per worker process; any number may share a database.
+
+    ``heap`` holds ``(due_at, timer id)`` for the soonest deadlines, refilled
+    from the front of the ``due_at`` index every ``poll_interval`` seconds (or
+    when it runs dry), so timers armed meanwhile fire at most that late.
+    """
+
+    def __init__(self, batch_size=500, lease_seconds=60, horizon=60, poll_interval=5):
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.horizon = timedelta(seconds=horizon)
+        self.poll_interval = timedelta(seconds=poll_interval)
+        self.heap = []
+        self.refilled_at = None
+
+    def refill(self, now):
+        self.heap = list(
+            WorkflowTimer.objects.filter(due_at__lte=now + self.horizon)
+            .order_by('due_at').values_list('due_at', 'id')[:self.batch_size * 4]
+        )
+        heapq.heapify(self.heap)
+        self.refilled_at = now
+
+    def claim(self, timer_ids, now):
+        """Lease the given timers that are still due; returns ``(token, number claimed)``."""
+        token = uuid.uuid4().hex
+        claimed = WorkflowTimer.objects.filter(id__in=timer_ids, due_at__lte=now).update(
+            due_at=now + self.lease, lease=token,
+        )
+        return token, claimed
+
+    def run_once(self, now=None):
+        """Claim and fire, batch by batch, every timer due at ``now``. Returns the number fired."""
+        now = now or timezone.now()
+        if not self.heap or self.refilled_at is None or now - self.refilled_at >= self.poll_interval:
+            self.refill(now)
+        fired = 0
+        while self.heap and self.heap[0][0] <= now:
+            batch = []
+            while self.heap and self.heap[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self.heap)[1])
+            token, claimed = self.claim(batch, now)
+            if claimed:
+                fired += fire(token, now)
+            if not self.heap:
+                self.refill(now)  # a backlog longer than the heap
+        return fired
+
+    def seconds_until_due(self, now=None):
+        now = now or timezone.now()
+        wait = self.poll_interval
+        if self.heap:
+            wait = min(wait, self.heap[0][0] - now)
+        return max(wait.total_seconds(), 0)
+
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                fired = self.run_once()
+            except Exception:
+                logger.exception("SLA scheduler pass failed")
+                fired = 0
+            if fired:
+                logger.info("Fired %d SLA timeouts", fired)
+            stop.wait(self.seconds_until_due())
@@ -0,0 +1,202 @@
+"""Server-Sent Events stream of workflow changes, served directly over ASGI.
+
+Django 3.2 iterates streaming responses synchronously, so a long-lived stream
+would pin a thread per client. ``event_stream`` is a plain ASGI coroutine
+mounted next to Django in ``workflow_project/asgi.py``; an idle connection is
+just a parked task waiting on its queue.
+"""
+import asyncio
+import json
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+from django.conf import settings
+from django.core import signing
+
+from .auth.keycloak import adecode_token
+from .engine import user_roles_of
+from .notify import get_broker, render_for
+
+STREAM_PATH = '/api/stream/'
+TICKET_SALT = 'core.sse.stream-ticket'
+
+
+def issue_ticket(claims):
+    """A signed ticket that opens ``claims``' stream as ``?ticket=`` (EventSource cannot set headers).
+
+    It is accepted by nothing but the stream, and only for
+    ``WORKFLOW_STREAM_TICKET_TTL`` seconds, so unlike the access token it is
+    of no use once it lands in a proxy log.
+    """
+    payload = {'u': claims.get('preferred_username'), 'r': list(user_roles_of(claims)), 'exp': claims.get('exp')}
+    return signing.dumps(payload, salt=TICKET_SALT, compress=True)
+
+
+def _redeem(ticket):
+    """The claims a ticket was issued for, or None when it is forged or expired."""
+    try:
+        payload = signing.loads(ticket, salt=TICKET_SALT, max_age=settings.WORKFLOW_STREAM_TICKET_TTL)
+    except signing.BadSignature:
+        return None
+    return {'preferred_username': payload['u'], 'realm_access': {'roles': payload['r']}, 'exp': payload['exp']}
+
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def _cors_headers(request_headers):
+    origin = request_headers.get('origin')
+    if origin and origin in settings.CORS_ALLOWED_ORIGINS:
+        headers = [(b'access-control-allow-origin', origin.encode()), (b'vary', b'Origin')]
+        if settings.CORS_ALLOW_CREDENTIALS:
+            headers.append((b'access-control-allow-credentials', b'true'))
+        return headers
+    return []
+
+
+async def _reject(send, status, detail, extra_headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')] + extra_headers})
+    await send({'type': 'http.response.body', 'body': json.dumps({'detail': detail}).encode()})
+
+
+def _frame(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data)}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+async def event_stream(scope, receive, send):
+    """Stream ``inbox``, ``submission`` and ``reset`` events to one user.
+
+    Clients authenticate with ``Authorization: Bearer``, or, as EventSource
+    cannot set headers, with ``?ticket=`` from ``POST /api/stream/ticket/``.
+    Access tokens are refused in the URL. ``Last-Event-ID`` (header or
+    ``?last_event_id=``) resumes from the broker's buffer, or sends ``reset``
+    when it is too old. The stream ends when the token expires; clients
+    reconnect with a fresh ticket.
+    """
+    request_headers = _headers(scope)
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    cors = _cors_headers(request_headers)
+
+    if 'access_token' in query:
+        return await _reject(send, 400, "Do not put the access token in the URL; use a ticket from "
+                                        "POST /api/stream/ticket/", cors)
+    auth_header = request_headers.get('authorization', '')
+    if auth_header.startswith('Bearer '):
+        try:
+            claims = await adecode_token(auth_header.split()[1])
+        except Exception as e:
+            return await _reject(send, 401, f"Token error: {e}", cors)
+    elif 'ticket' in query:
+        claims = _redeem(query['ticket'][0])
+        if claims is None:
+            return await _reject(send, 401, "Invalid or expired ticket", cors)
+    else:
+        return await _reject(send, 401, "Missing or invalid token", cors)
+
+    username = claims.get('preferred_username')
+    user_roles = set(user_roles_of(claims))
+    deadline = claims.get('exp', time.time() + 3600)
+    last_event_id = request_headers.get('last-event-id') or query.get('last_event_id', [None])[0]
+
+    broker = get_broker()
+    subscription = broker.subscribe()
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ] + cors})
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+
+        delivered = 0
+        if last_event_id:
+            backlog = broker.since(last_event_id)
+            if backlog is None:
+                await send({'type': 'http.response.body', 'body': _frame('reset', {}), 'more_body': True})
+            else:
+                for seq, message in backlog:
+                    delivered = seq
+                    for event, data in render_for(message, username, user_roles):
+                        frame = _frame(event, data, broker.event_id(seq))
+                        await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+
+        # A disconnect cancels this task wherever it is waiting.
+        stream_task = asyncio.current_task()
+
+        def cancel_stream(_):
+            stream_task.cancel()
+
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        disconnect.add_done_callback(cancel_stream)
+        try:
+            while True:
+                timeout = min(settings.WORKFLOW_STREAM_HEARTBEAT, deadline - time.time())
+                if timeout <= 0:
+                    break
+                try:
+                    seq, message = await asyncio.wait_for(subscription.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                    continue
+
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    while not subscription.queue.empty():
+                        seq, _ = subscription.queue.get_nowait()
+                    delivered = seq
+                    frames = [('reset', {})]
+                elif seq <= delivered:
+                    continue  # already sent from the resume backlog
+                else:
+                    delivered = seq
+                    frames = render_for(message, username, user_roles)
+                for event, data in frames:
+                    frame = _frame(event, data, broker.event_id(seq))
+                    await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+        except asyncio.CancelledError:
+            if not disconnect.done():
+                raise
+            return  # client went away
+        disconnect.remove_done_callback(cancel_stream)
+        disconnect.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+class _ThreadedWsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs WSGI apps on the one thread shared by every sync view; an
+    # export can take minutes, so give each its own thread.
+    run_wsgi_app = sync_to_async(vars(WsgiToAsgiInstance)['run_wsgi_app'].func, thread_sensitive=False)
+
+
+def route(django_application, wsgi_application=None, wsgi_prefixes=()):
+    """Wrap Django's ASGI application so ``STREAM_PATH`` is served by ``event_stream``.
+
+    Requests under ``wsgi_prefixes`` go to ``wsgi_application`` in a worker
+    thread instead: Django 3.2's ASGI handler iterates streaming responses on
+    the event loop, where generators that query the database cannot run.
+    """
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+            return await event_stream(scope, receive, send)
+        if scope['type'] == 'http' and scope['path'].startswith(tuple(wsgi_prefixes)):
+            return await _ThreadedWsgiInstance(wsgi_application)(scope, receive, send)
+        return await django_application(scope, receive, send)
+    return application
@@ -0,0 +1,247 @@
+from typing import NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from django.utils import timezone
+
+from .models import Transition, WorkflowDefinition, WorkflowVersion, WorkflowVersionRole
+
+# Compiled workflows keyed by WorkflowVersion id. Versions never change, so a
+# compiled version stays valid forever, in each worker and in the shared cache.
+# Only the pointer from a form template to its current version is looked up
+# per call. It expires after WORKFLOW_CURRENT_VERSION_TTL seconds, so with a
+# per-process cache a version published through one worker reaches the others
+# within that delay; paths that create instances read it from the database.
+_compiled = {}
+
+# Transition fields carried into a new version.
+TRANSITION_FIELDS = ('from_state', 'to_state', 'allowed_roles', 'logical_type',
+                     'sla_seconds', 'timeout_action', 'escalate_to')
+
+
+class CompiledTransition(NamedTuple):
+    from_state: str
+    to_state: str
+    allowed_roles: Tuple[str, ...]
+    logical_type: str
+    sla_seconds: Optional[int] = None
+    timeout_action: str = 'notify'
+    escalate_to: Tuple[str, ...] = ()
+
+    def allows(self, user_roles):
+        return any(role in user_roles for role in self.allowed_roles)
+
+    def as_dict(self):
+        return {
+            'from_state': self.from_state,
+            'to_state': self.to_state,
+            'allowed_roles': list(self.allowed_roles),
+            'logical_type': self.logical_type,
+        }
+
+
+class CompiledWorkflow:
+    """Immutable, query-free view of one WorkflowVersion and its transitions."""
+
+    def __init__(self, workflow_id, form_template_id, version, states, transitions, version_id=None):
+        self.workflow_id = workflow_id
+        self.version_id = version_id
+        self.form_template_id = form_template_id
+        self.version = version
+        self.states = tuple(states or ())
+        self.initial_state = self.states[0] if self.states else "Draft"
+        self.transitions = {}
+        outgoing = {}
+        by_role = {}
+        for transition in transitions:
+            self.transitions[(transition.from_state, transition.to_state)] = transition
+            outgoing.setdefault(transition.from_state, []).append(transition)
+            for role in transition.allowed_roles:
+                by_role.setdefault(role, []).append(transition)
+        self.outgoing = {state: tuple(edges) for state, edges in outgoing.items()}
+        # Transitions with an SLA per state, earliest deadline first.
+        self.deadlines = {
+            state: tuple(sorted((t for t in edges if t.sla_seconds is not None),
+                                key=lambda t: (t.sla_seconds, t.to_state)))
+            for state, edges in outgoing.items()
+        }
+        self.by_role = {role: tuple(edges) for role, edges in by_role.items()}
+        # States without outgoing transitions: an instance that reaches one is closed.
+        self.terminal_states = frozenset(state for state in self.states if state not in self.outgoing)
+
+    @classmethod
+    def from_version(cls, version, transitions, form_template_id):
+        transitions = [
+            CompiledTransition(t.from_state, t.to_state, tuple(t.allowed_roles), t.logical_type.upper(),
+                               t.sla_seconds, t.timeout_action, tuple(t.escalate_to or ()))
+            for t in transitions
+        ]
+        return cls(version.workflow_id, form_template_id, version.number, version.states, transitions, version.id)
+
+    def get_transition(self, from_state, to_state):
+        return self.transitions.get((from_state, to_state))
+
+    def available_transitions(self, state, user_roles):
+        return [t for t in self.outgoing.get(state, ()) if t.allows(user_roles)]
+
+    def is_terminal(self, state):
+        return state not in self.outgoing
+
+    def actionable_roles(self, state):
+        roles = set()
+        for transition in self.outgoing.get(state, ()):
+            roles.update(transition.allowed_roles)
+        return roles
+
+
+def _current_key(form_template_id):
+    return f'workflow:{form_template_id}:current'
+
+
+def _version_key(version_id):
+    # The trailing format number changes whenever CompiledWorkflow gains attributes.
+    return f'workflow-version:{version_id}:4'
+
+
+def _publish(compiled):
+    cache.set(_version_key(compiled.version_id), compiled, timeout=None)
+    cache.set(_current_key(compiled.form_template_id), compiled.version_id,
+              timeout=getattr(settings, 'WORKFLOW_CURRENT_VERSION_TTL', 5))
+    _compiled[compiled.version_id] = compiled
+    return compiled
+
+
+def _record_roles(version, allowed_roles):
+    roles = {role for allowed in allowed_roles for role in allowed}
+    WorkflowVersionRole.objects.bulk_create([WorkflowVersionRole(version=version, role=role) for role in sorted(roles)])
+
+
+def create_version(workflow, states=None, transitions=None):
+    """Add the next immutable version of ``workflow`` and make it current.
+
+    ``transitions`` are dicts of ``TRANSITION_FIELDS``; by default the current
+    version's transitions are carried over, and ``states`` likewise. Nothing is
+    rewritten in place: the version row and its ``bulk_create``d transitions
+    are inserted and the definition repointed in one transaction, so readers
+    see the old version or the new one, never a partial transition set.
+    Instances already running keep their version. The version becomes the
+    template's current one for every worker once the transaction commits.
+    Returns the compiled version.
+    """
+    with transaction.atomic(savepoint=False):
+        head = WorkflowDefinition.objects.select_for_update().get(pk=workflow.pk)
+        number = head.version + 1 if head.current_version_id else head.version
+        states = head.states if states is None else states
+        if transitions is None:
+            if head.current_version_id is None:
+                transitions = head.transitions.filter(version__isnull=True)
+            else:
+                transitions = Transition.objects.filter(version_id=head.current_version_id)
+            transitions = transitions.values(*TRANSITION_FIELDS)
+        version = WorkflowVersion.objects.create(workflow=head, number=number, states=states)
+        rows = Transition.objects.bulk_create([
+            Transition(workflow=head, version=version, **{name: data[name] for name in TRANSITION_FIELDS if name in data})
+            for data in transitions
+        ])
+        _record_roles(version, (row.allowed_roles for row in rows))
+        WorkflowDefinition.objects.filter(pk=head.pk).update(
+            states=states, version=number, current_version=version, updated_at=timezone.now()
+        )
+    workflow.states, workflow.version, workflow.current_version = states, number, version
+    compiled = CompiledWorkflow.from_version(version, rows, head.form_template_id)
+    transaction.on_commit(lambda: _publish(compiled))
+    return compiled
+
+
+def publish_workflow(workflow):
+    """Make ``workflow``'s current version the one every worker resolves its template to.
+
+    A definition that was never published (created with plain ORM calls) gets
+    its first version from its states and the transitions not yet in a version.
+    """
+    if workflow.current_version_id is None:
+        with transaction.atomic():
+            head = WorkflowDefinition.objects.select_for_update().get(pk=workflow.pk)
+            if head.current_version_id is None:
+                version = WorkflowVersion.objects.create(workflow=head, number=head.version, states=head.states)
+                head.transitions.filter(version__isnull=True).update(version=version)
+                _record_roles(version, version.transitions.values_list('allowed_roles', flat=True))
+                WorkflowDefinition.objects.filter(pk=head.pk).update(current_version=version)
+                head.current_version = version
+        workflow.current_version = head.current_version
+    return _publish(get_compiled_version(workflow.current_version_id))
+
+
+def get_compiled_version(version_id):
+    """Return the compiled form of a WorkflowVersion, e.g. ``instance.workflow_version_id``.
+
+    Versions are immutable, so after the first call in a worker this costs no
+    cache lookup and no query. Raises ``WorkflowDefinition.DoesNotExist`` for
+    an unknown version or ``None``.
+    """
+    compiled = _compiled.get(version_id)
+    if compiled is not None:
+        return compiled
+    if version_id is None:
+        raise WorkflowDefinition.DoesNotExist("Instance has no workflow version.")
+    compiled = cache.get(_version_key(version_id))
+    if compiled is None:
+        try:
+            version = WorkflowVersion.objects.select_related('workflow').get(id=version_id)
+        except WorkflowVersion.DoesNotExist:
+            raise WorkflowDefinition.DoesNotExist(f"No workflow version {version_id}.")
+        compiled = CompiledWorkflow.from_version(version, version.transitions.all(), version.workflow.form_template_id)
+        cache.set(_version_key(version_id), compiled, timeout=None)
+    _compiled[version_id] = compiled
+    return compiled
+
+
+def with_current_version(templates):
+    """Annotate a FormTemplate queryset with its workflow's ``current_version_id``."""
+    return templates.annotate(current_version_id=F('workflowdefinition__current_version'))
+
+
+def get_compiled_workflow(form_template_id, current_version_id=None):
+    """Return the current compiled version of a form template's workflow.
+
+    On the hot path this costs one cache lookup for the current version id and
+    no database queries; the id is re-read from the database once it expires.
+    Code creating instances passes the ``current_version_id`` it loaded with
+    the template (see ``with_current_version``) instead, so new instances
+    start on the version the database holds whatever the cache says.
+    Raises ``WorkflowDefinition.DoesNotExist``.
+    """
+    version_id = current_version_id or cache.get(_current_key(form_template_id))
+    if version_id is not None:
+        return get_compiled_version(version_id)
+    workflow = WorkflowDefinition.objects.get(form_template_id=form_template_id)
+    return publish_workflow(workflow)
+
+
+def get_compiled_workflow_or_404(form_template_id, current_version_id=None):
+    try:
+        return get_compiled_workflow(form_template_id, current_version_id)
+    except WorkflowDefinition.DoesNotExist:
+        raise Http404("No WorkflowDefinition matches the given query.")
+
+
+def get_compiled_version_or_404(version_id):
+    try:
+        return get_compiled_version(version_id)
+    except WorkflowDefinition.DoesNotExist:
+        raise Http404("No WorkflowDefinition matches the given query.")
+
+
+def forget_workflow(form_template_id):
+    """Drop every cached version of a template's workflow, e.g. after the transaction that created it rolled back."""
+    stale = [version_id for version_id, compiled in _compiled.items() if compiled.form_template_id == form_template_id]
+    cache.delete_many([_current_key(form_template_id)] + [_version_key(version_id) for version_id in stale])
+    for version_id in stale:
+        del _compiled[version_id]
+
+
+def clear_compiled_workflows():
+    _compiled.clear()
@@ -1,3 +1,1951 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import DatabaseError, close_old_connections, connection, connections
+from django.http import HttpResponse
+from django.test import (
+    AsyncClient, Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+    skipUnlessDBFeature,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from jose import jwk, jwt
+from jose.exceptions import JWTError
+from rest_framework.decorators import api_view
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from . import analytics, benchmark, db, idempotency, metrics, notify, renderers, sla, throttling
+from .auth import keycloak
+from .auth.decorators import keycloak_required
+from .auth.keycloak import JWKSKeyStore
+from .auth.token_cache import VerifiedTokenCache
+from .events import rebuild_instances
+from .models import (
+    ArchivedInstance, FormSubmission, FormTemplate, IdempotencyKey, StateCount, Transition, TransitionRollup, WorkflowDefinition,
+    WorkflowEvent, WorkflowInboxEntry, WorkflowInstance, WorkflowTimer
+)
+from .notify import InProcessBroker
+from .rows import row_serializer
+from .search import indexed_fields, sync_data_indexes
+from .serializers import ArchivedInstanceSerializer, WorkflowDefinitionSerializer, WorkflowInstanceSerializer
+from .sse import STREAM_PATH, event_stream
+from .urls import urlpatterns
+from .state_machine import clear_compiled_workflows, get_compiled_version, get_compiled_workflow, publish_workflow
+from .validators import FormValidator, SchemaError, clear_validators, get_validator
+
+
+def make_signing_key(kid):
+    """Return ``(private_pem, public_jwk)`` for a fresh RS256 key pair."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+    public_jwk.update(kid=kid, use='sig')
+    return private_pem, public_jwk
+
+
+def make_token(private_pem, kid, **claims):
+    payload = {'aud': 'account', 'exp': int(time.time()) + 300, 'sub': 'user-1'}
+    payload.update(claims)
+    return jwt.encode(payload, private_pem, algorithm='RS256', headers={'kid': kid})
+
+
+class FakeKeycloak:
+    """Minimal OIDC discovery + JWKS server running on a local port."""
+
+    def __init__(self, keys, delay=0):
+        self.keys = list(keys)
+        self.jwks_requests = 0
+        self.fail = False
+        self.delay = delay
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if fake.fail:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                if self.path.endswith('/openid-configuration'):
+                    body = {'jwks_uri': f'{fake.base_url}/certs'}
+                else:
+                    fake.jwks_requests += 1
+                    time.sleep(fake.delay)
+                    body = {'keys': fake.keys}
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.config_url = f'{self.base_url}/.well-known/openid-configuration'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JWKSKeyStoreTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pem_a, cls.jwk_a = make_signing_key('key-a')
+        cls.pem_b, cls.jwk_b = make_signing_key('key-b')
+
+    def setUp(self):
+        self.keycloak = FakeKeycloak([self.jwk_a])
+        self.addCleanup(self.keycloak.close)
+
+    def decode(self, store, token):
+        key = store.get_key(jwt.get_unverified_header(token)['kid'])
+        return jwt.decode(token, key, algorithms=['RS256'], audience='account')
+
+    def test_keys_are_fetched_once_and_served_from_memory(self):
+        fetches = metrics.JWKS_FETCH.count('ok')
+        store = JWKSKeyStore(self.keycloak.config_url)
+        token = make_token(self.pem_a, 'key-a')
+        for _ in range(20):
+            self.assertEqual(self.decode(store, token)['sub'], 'user-1')
+
+        self.assertEqual(self.keycloak.jwks_requests, 1)
+        self.assertEqual(metrics.JWKS_FETCH.count('ok'), fetches + 1)
+        stats = store.stats()
+        self.assertEqual(stats['hits'], 20)
+        self.assertEqual(stats['refreshes'], 1)
+
+    def test_key_is_selected_by_kid(self):
+        self.keycloak.keys = [self.jwk_a, self.jwk_b]
+        store = JWKSKeyStore(self.keycloak.config_url)
+        token = make_token(self.pem_b, 'key-b', sub='user-b')
+        self.assertEqual(self.decode(store, token)['sub'], 'user-b')
+
+    def test_unknown_kid_triggers_single_refetch(self):
+        store = JWKSKeyStore(self.keycloak.config_url, min_refetch_interval=0)
+        self.decode(store, make_token(self.pem_a, 'key-a'))
+
+        self.keycloak.keys = [self.jwk_a, self.jwk_b]
+        self.assertEqual(self.decode(store, make_token(self.pem_b, 'key-b'))['sub'], 'user-1')
+        self.assertEqual(self.keycloak.jwks_requests, 2)
+        self.assertEqual(store.stats()['misses'], 1)
+
+    def test_unknown_kid_refetch_is_throttled(self):
+        store = JWKSKeyStore(self.keycloak.config_url, min_refetch_interval=60)
+        self.decode(store, make_token(self.pem_a, 'key-a'))
+        for _ in range(5):
+            with self.assertRaises(JWTError):
+                store.get_key('no-such-kid')
+        self.assertEqual(self.keycloak.jwks_requests, 1)
+
+    def test_stale_keys_are_served_while_keycloak_is_down(self):
+        store = JWKSKeyStore(self.keycloak.config_url, ttl=0, min_refetch_interval=0)
+        token = make_token(self.pem_a, 'key-a')
+        self.decode(store, token)
+
+        self.keycloak.fail = True
+        store.refresh()
+        self.assertEqual(self.decode(store, token)['sub'], 'user-1')
+        self.assertGreaterEqual(store.stats()['refresh_errors'], 1)
+
+    def test_expired_keys_are_refreshed_in_background(self):
+        store = JWKSKeyStore(self.keycloak.config_url, ttl=0.05, min_refetch_interval=0)
+        store.get_key('key-a')
+        time.sleep(0.1)
+        self.keycloak.keys = [self.jwk_a, self.jwk_b]
+
+        self.assertIsNotNone(store.get_key('key-a'))
+        deadline = time.monotonic() + 5
+        while store.stats()['refreshes'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(store.stats()['refreshes'], 2)
+        self.assertIsNotNone(store.get_key('key-b'))
+
+    def test_concurrent_async_misses_share_one_fetch(self):
+        self.keycloak.delay = 0.2
+        store = JWKSKeyStore(self.keycloak.config_url, min_refetch_interval=0)
+
+        async def fetch_many():
+            return await asyncio.gather(*(store.aget_key('key-a') for _ in range(20)))
+
+        keys = asyncio.run(fetch_many())
+        self.assertEqual(len({id(key) for key in keys}), 1)
+        self.assertEqual(self.keycloak.jwks_requests, 1)
+        self.assertEqual(asyncio.run(store.aget_key('key-a')), keys[0])
+
+    def test_first_fetch_failure_raises(self):
+        self.keycloak.fail = True
+        store = JWKSKeyStore(self.keycloak.config_url)
+        with self.assertRaises(JWTError):
+            store.get_key('key-a')
+
+
+class VerifiedTokenCacheTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pem, cls.jwk = make_signing_key('key-a')
+
+    def setUp(self):
+        keycloak.key_store.load({'keys': [self.jwk]})
+        keycloak.token_cache.clear()
+        self.addCleanup(keycloak.key_store.clear)
+        self.addCleanup(keycloak.token_cache.clear)
+
+    def test_repeat_token_skips_signature_verification(self):
+        token = make_token(self.pem, 'key-a')
+        with mock.patch('core.auth.keycloak.jwt.decode', wraps=jwt.decode) as decode:
+            for _ in range(10):
+                self.assertEqual(keycloak.decode_token(token)['sub'], 'user-1')
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(keycloak.token_cache.stats()['hits'], 9)
+
+    def test_entries_expire_at_token_exp(self):
+        cache = VerifiedTokenCache(max_size=10, max_age=300)
+        cache.set('expired', {'exp': time.time() - 1})
+        cache.set('live', {'exp': time.time() + 60})
+        self.assertIsNone(cache.get('expired'))
+        self.assertIsNotNone(cache.get('live'))
+
+    def test_max_age_caps_entry_lifetime(self):
+        cache = VerifiedTokenCache(max_size=10, max_age=0)
+        cache.set('token', {'exp': time.time() + 60})
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = VerifiedTokenCache(max_size=2)
+        cache.set('a', {})
+        cache.set('b', {})
+        cache.get('a')
+        cache.set('c', {})
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_roles_are_enforced_on_cache_hit(self):
+        @api_view(['GET'])
+        @keycloak_required(required_roles=['Admin'])
+        def admin_only(request):
+            return Response({'ok': True})
+
+        token = make_token(self.pem, 'key-a', realm_access={'roles': ['Employee']})
+        factory = RequestFactory()
+        for _ in range(2):
+            response = admin_only(factory.get('/', HTTP_AUTHORIZATION=f'Bearer {token}'))
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(keycloak.token_cache.stats()['hits'], 1)
+
+
+class APITestMixin:
+    """Signs tokens with a local key pair installed in the process-wide key store."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.signing_pem, signing_jwk = make_signing_key('test-key')
+        keycloak.key_store.load({'keys': [signing_jwk]})
+
+    @classmethod
+    def tearDownClass(cls):
+        keycloak.key_store.clear()
+        keycloak.token_cache.clear()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        clear_compiled_workflows()
+        clear_validators()
+        idempotency.completed.clear()
+
+    def auth(self, username, *roles):
+        token = make_token(
+            self.signing_pem, 'test-key', sub=username, preferred_username=username,
+            realm_access={'roles': list(roles)},
+        )
+        return {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def create_workflow(self, name='Leave', states=('Submitted', 'Approved', 'Done'), transitions=None):
+        template = FormTemplate.objects.create(
+            name=name, schema={'fields': [{'name': 'reason', 'type': 'text', 'required': True}]}
+        )
+        workflow = WorkflowDefinition.objects.create(form_template=template, states=list(states))
+        if transitions is None:
+            transitions = [
+                ('Submitted', 'Approved', ['Manager'], 'OR'),
+                ('Approved', 'Done', ['HR'], 'OR'),
+            ]
+        for from_state, to_state, roles, logical_type in transitions:
+            Transition.objects.create(
+                workflow=workflow, from_state=from_state, to_state=to_state,
+                allowed_roles=roles, logical_type=logical_type,
+            )
+        publish_workflow(workflow)
+        return template, workflow
+
+    def submit(self, template, username='alice', **data):
+        response = self.client.post(
+            '/api/submit-form/', {'form_template': template.id, 'data': data or {'reason': 'holiday'}},
+            content_type='application/json', **self.auth(username, 'Employee'),
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['submission_id']
+
+    def transition(self, submission_id, next_state, username, *roles, **extra):
+        return self.client.post(
+            '/api/transition/', {'submission_id': submission_id, 'next_state': next_state, **extra},
+            content_type='application/json', **self.auth(username, *roles),
+        )
+
+
+class APITestCase(APITestMixin, TestCase):
+    pass
+
+
+class PendingApprovalsTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow()
+
+    def pending(self, username, *roles, **params):
+        return self.client.get('/api/pending-approvals/', params, **self.auth(username, *roles))
+
+    def test_inbox_follows_instance_state(self):
+        submission_id = self.submit(self.template)
+        self.assertEqual(len(self.pending('mary', 'Manager').json()), 1)
+        self.assertEqual(self.pending('harry', 'HR').json(), [])
+
+        self.assertEqual(self.transition(submission_id, 'Approved', 'mary', 'Manager').status_code, 200)
+        self.assertEqual(self.pending('mary', 'Manager').json(), [])
+        self.assertEqual([i['submission']['id'] for i in self.pending('harry', 'HR').json()], [submission_id])
+
+        self.transition(submission_id, 'Done', 'harry', 'HR')
+        self.assertFalse(WorkflowInboxEntry.objects.exists())
+
+    def test_query_count_does_not_grow_with_instances(self):
+        for _ in range(3):
+            self.submit(self.template)
+        self.pending('mary', 'Manager')
+        with self.assertNumQueries(2):  # ETag stamp + page
+            self.assertEqual(len(self.pending('mary', 'Manager').json()), 3)
+        for _ in range(10):
+            self.submit(self.template)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.pending('mary', 'Manager').json()), 13)
+
+    def test_pages_follow_the_next_cursor(self):
+        submitted = [self.submit(self.template) for _ in range(5)]
+        seen = []
+        response = self.pending('mary', 'Manager', limit=2)
+        while True:
+            seen.extend(i['submission']['id'] for i in response.json())
+            if 'X-Next-Cursor' not in response:
+                break
+            response = self.pending('mary', 'Manager', limit=2, cursor=response['X-Next-Cursor'])
+        self.assertEqual(sorted(seen), sorted(submitted))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.pending('mary', 'Manager', cursor='bogus').status_code, 404)
+
+    async def test_read_endpoints_are_served_async(self):
+        from .views import get_available_transitions, list_pending_approvals, list_user_submissions
+        for view in (get_available_transitions, list_pending_approvals, list_user_submissions):
+            self.assertTrue(asyncio.iscoroutinefunction(view))
+
+        submission_id = await sync_to_async(self.submit)(self.template)
+        client = AsyncClient()
+        # AsyncClient (Django 3.2) takes raw header names rather than META keys.
+        manager = {'Authorization': self.auth('mary', 'Manager')['HTTP_AUTHORIZATION']}
+        response = await client.get('/api/pending-approvals/', **manager)
+        self.assertEqual([i['submission']['id'] for i in response.json()], [submission_id])
+        response = await client.get(f'/api/transitions/{submission_id}/', **manager)
+        self.assertEqual([t['to_state'] for t in response.json()], ['Approved'])
+        alice = {'Authorization': self.auth('alice')['HTTP_AUTHORIZATION']}
+        response = await client.get('/api/my-submissions/?fields=current_state', **alice)
+        self.assertEqual(response.json(), [{'current_state': 'Submitted'}])
+
+        self.assertEqual((await client.get('/api/transitions/999999/', **manager)).status_code, 404)
+        self.assertEqual((await client.post('/api/pending-approvals/', **manager)).status_code, 405)
+        self.assertEqual((await client.get('/api/pending-approvals/')).status_code, 401)
+
+    def test_backfill_rebuilds_missing_entries(self):
+        submission_id = self.submit(self.template)
+        WorkflowInboxEntry.objects.all().delete()
+        call_command('backfill_inbox', batch_size=1, stdout=open(os.devnull, 'w'))
+        instance = WorkflowInstance.objects.get(submission_id=submission_id)
+        self.assertEqual(list(instance.inbox_entries.values_list('role', flat=True)), ['Manager'])
+
+
+class CompiledWorkflowTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow(transitions=[
+            ('Submitted', 'Approved', ['Manager'], 'OR'),
+            ('Submitted', 'Rejected', ['Manager', 'HR'], 'or'),
+            ('Approved', 'Done', ['HR', 'Finance'], 'AND'),
+        ])
+
+    def test_compiled_indexes(self):
+        workflow = get_compiled_workflow(self.template.id)
+        self.assertEqual(workflow.initial_state, 'Submitted')
+        self.assertEqual(workflow.get_transition('Approved', 'Done').logical_type, 'AND')
+        self.assertIsNone(workflow.get_transition('Submitted', 'Done'))
+        self.assertEqual([t.to_state for t in workflow.outgoing['Submitted']], ['Approved', 'Rejected'])
+        self.assertEqual([t.to_state for t in workflow.by_role['HR']], ['Rejected', 'Done'])
+        self.assertEqual(workflow.actionable_roles('Approved'), {'HR', 'Finance'})
+
+    def test_resolving_a_workflow_is_query_free_once_compiled(self):
+        get_compiled_workflow(self.template.id)
+        with self.assertNumQueries(0):
+            get_compiled_workflow(self.template.id)
+        clear_compiled_workflows()  # a fresh worker still finds it in the shared cache
+        with self.assertNumQueries(0):
+            get_compiled_workflow(self.template.id)
+
+    def test_available_transitions_only_query_the_instance(self):
+        submission_id = self.submit(self.template)
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/transitions/{submission_id}/', **self.auth('harry', 'HR'))
+        self.assertEqual([t['to_state'] for t in response.json()], ['Rejected'])
+
+    def test_update_publishes_a_new_version(self):
+        stale = get_compiled_workflow(self.template.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                f'/api/workflow-definition/{self.workflow.id}/',
+                {'transitions': [{'from_state': 'Submitted', 'to_state': 'Done', 'allowed_roles': ['HR']}]},
+                content_type='application/json', **self.auth('root', 'Admin'),
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertNotIn('version', response.json())
+
+        current = get_compiled_workflow(self.template.id)
+        self.assertEqual(current.version, stale.version + 1)
+        self.assertIsNotNone(current.get_transition('Submitted', 'Done'))
+        self.assertIsNone(current.get_transition('Submitted', 'Approved'))
+
+    def test_running_instances_keep_their_version(self):
+        before = self.submit(self.template)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f'/api/workflow-definition/{self.workflow.id}/',
+                {'states': ['Submitted', 'Done'],
+                 'transitions': [{'from_state': 'Submitted', 'to_state': 'Done', 'allowed_roles': ['HR']}]},
+                content_type='application/json', **self.auth('root', 'Admin'),
+            )
+        after = self.submit(self.template)
+        self.assertEqual(Transition.objects.filter(workflow=self.workflow).count(), 4)  # nothing rewritten
+
+        response = self.client.get(f'/api/transitions/{before}/', **self.auth('harry', 'HR'))
+        self.assertEqual([t['to_state'] for t in response.json()], ['Rejected'])
+        self.assertEqual(self.transition(before, 'Approved', 'mary', 'Manager').status_code, 200)
+        self.assertEqual(self.transition(after, 'Approved', 'mary', 'Manager').status_code, 400)
+        self.assertEqual(self.transition(after, 'Done', 'harry', 'HR').status_code, 200)
+
+    def test_new_submissions_use_a_version_published_by_another_worker(self):
+        get_compiled_workflow(self.template.id)  # this worker now points the template at version 1
+        with mock.patch('core.state_machine.cache', LocMemCache('other-worker', {})), \
+                self.captureOnCommitCallbacks(execute=True):
+            clear_compiled_workflows()
+            response = self.client.put(
+                f'/api/workflow-definition/{self.workflow.id}/',
+                {'states': ['Submitted', 'Done'],
+                 'transitions': [{'from_state': 'Submitted', 'to_state': 'Done', 'allowed_roles': ['HR']}]},
+                content_type='application/json', **self.auth('root', 'Admin'),
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        clear_compiled_workflows()
+
+        submission_id = self.submit(self.template)
+        instance = WorkflowInstance.objects.get(submission_id=submission_id)
+        self.workflow.refresh_from_db()
+        self.assertEqual(instance.workflow_version_id, self.workflow.current_version_id)
+        self.assertEqual(self.transition(submission_id, 'Done', 'harry', 'HR').status_code, 200)
+
+    def test_compiled_versions_need_no_cache_lookup(self):
+        submission_id = self.submit(self.template)
+        version_id = WorkflowInstance.objects.get(submission_id=submission_id).workflow_version_id
+        get_compiled_version(version_id)
+        with mock.patch.object(cache, 'get') as cache_get, self.assertNumQueries(0):
+            self.assertEqual(get_compiled_version(version_id).version_id, version_id)
+        cache_get.assert_not_called()
+
+    def test_invalid_transitions_are_rejected_before_a_version_is_added(self):
+        response = self.client.put(f'/api/workflow-definition/{self.workflow.id}/',
+                                   {'transitions': [{'from_state': 'Submitted'}]},
+                                   content_type='application/json', **self.auth('root', 'Admin'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('transitions', response.json())
+        self.assertEqual(self.workflow.versions.count(), 1)
+
+
+class TransitionEngineTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow(transitions=[
+            ('Submitted', 'Approved', ['Manager', 'HR'], 'AND'),
+            ('Approved', 'Done', ['Finance'], 'OR'),
+        ])
+        self.submission_id = self.submit(self.template)
+
+    def state(self):
+        return WorkflowInstance.objects.get(submission_id=self.submission_id)
+
+    def test_and_transition_waits_for_every_approval(self):
+        self.assertEqual(self.transition(self.submission_id, 'Approved', 'mary', 'Manager').status_code, 200)
+        self.assertEqual(self.state().partial_approvals, {'Approved': ['mary']})
+        self.assertEqual(self.transition(self.submission_id, 'Approved', 'mary', 'Manager').json()['message'],
+                         'You have already approved this transition.')
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        instance = self.state()
+        self.assertEqual(instance.current_state, 'Approved')
+        self.assertEqual(instance.partial_approvals, {})
+
+    def test_stale_expected_state_is_a_conflict(self):
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager')
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        response = self.transition(self.submission_id, 'Done', 'fred', 'Finance', expected_state='Submitted')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['current_state'], 'Approved')
+        self.assertEqual(self.state().current_state, 'Approved')
+
+    def test_racing_approvers_get_one_success_and_one_conflict(self):
+        # What the row lock serialises on PostgreSQL (see ConcurrentTransitionTests), on any backend:
+        # two approvers both saw 'Submitted', the second one's request arrives after the first moved it.
+        template, _ = self.create_workflow(name='Either',
+                                           transitions=[('Submitted', 'Approved', ['Manager', 'HR'], 'OR')])
+        submission_id = self.submit(template)
+        statuses = [
+            self.transition(submission_id, 'Approved', username, role, expected_state='Submitted').status_code
+            for username, role in (('mary', 'Manager'), ('harry', 'HR'))
+        ]
+        self.assertEqual(statuses, [200, 409])
+        instance = WorkflowInstance.objects.get(submission_id=submission_id)
+        self.assertEqual((instance.current_state, instance.partial_approvals), ('Approved', {}))
+        self.assertEqual(WorkflowEvent.objects.filter(instance=instance, kind=WorkflowEvent.TRANSITIONED).count(), 1)
+
+    def test_retried_transition_is_a_conflict(self):
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager')
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        response = self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        self.assertEqual(response.status_code, 409)
+
+    def test_role_and_edge_checks(self):
+        self.assertEqual(self.transition(self.submission_id, 'Approved', 'eve', 'Employee').status_code, 403)
+        self.assertEqual(self.transition(self.submission_id, 'Done', 'fred', 'Finance').status_code, 400)
+        self.assertEqual(self.transition(999999, 'Done', 'fred', 'Finance').status_code, 404)
+
+
+class WorkflowEventTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow(transitions=[
+            ('Submitted', 'Approved', ['Manager', 'HR'], 'AND'),
+            ('Approved', 'Done', ['Finance'], 'OR'),
+        ])
+        self.submission_id = self.submit(self.template)
+
+    def history(self, username, *roles, **params):
+        return self.client.get(f'/api/submissions/{self.submission_id}/history/', params,
+                               **self.auth(username, *roles))
+
+    def test_every_approval_is_logged(self):
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager', 'offline_access')
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager')  # repeat, not logged
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        self.transition(self.submission_id, 'Done', 'eve', 'Employee')  # forbidden, not logged
+        events = list(WorkflowEvent.objects.order_by('id').values_list('kind', 'actor', 'roles', 'from_state', 'to_state'))
+        self.assertEqual(events, [
+            ('approved', 'mary', ['Manager'], 'Submitted', 'Approved'),
+            ('transitioned', 'harry', ['HR'], 'Submitted', 'Approved'),
+        ])
+
+    def test_bulk_transitions_are_logged(self):
+        other = self.submit(self.template)
+        self.client.post('/api/transitions/bulk/', [
+            {'submission_id': self.submission_id, 'next_state': 'Approved'},
+            {'submission_id': other, 'next_state': 'Approved'},
+            {'submission_id': other, 'next_state': 'Done'},
+        ], content_type='application/json', **self.auth('mary', 'Manager'))
+        self.assertEqual(
+            sorted(WorkflowEvent.objects.values_list('instance__submission_id', 'kind')),
+            sorted([(self.submission_id, 'approved'), (other, 'approved')]),
+        )
+
+    def test_history_is_paginated_and_restricted(self):
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager')
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        self.transition(self.submission_id, 'Done', 'fred', 'Finance')
+
+        first = self.history('alice', 'Employee', limit=2)
+        self.assertEqual([e['actor'] for e in first.json()], ['mary', 'harry'])
+        self.assertEqual(first.json()[0]['submission_id'], self.submission_id)
+        second = self.history('alice', 'Employee', cursor=first['X-Next-Cursor'])
+        self.assertEqual([e['to_state'] for e in second.json()], ['Done'])
+
+        self.assertEqual(self.history('fred', 'Finance').status_code, 200)
+        self.assertEqual(self.history('bob', 'Employee').status_code, 403)
+
+    def test_events_filter_by_actor_and_time(self):
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager')
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        admin = self.auth('root', 'Admin')
+        response = self.client.get('/api/events/', {'actor': 'harry'}, **admin)
+        self.assertEqual([e['actor'] for e in response.json()], ['harry'])
+        response = self.client.get('/api/events/', {'since': '2999-01-01T00:00:00Z'}, **admin)
+        self.assertEqual(response.json(), [])
+        self.assertEqual(self.client.get('/api/events/', {'until': 'yesterday'}, **admin).status_code, 400)
+        self.assertEqual(self.client.get('/api/events/', **self.auth('mary', 'Manager')).status_code, 403)
+
+    def test_state_can_be_rebuilt_from_events(self):
+        self.transition(self.submission_id, 'Approved', 'mary', 'Manager')
+        self.transition(self.submission_id, 'Approved', 'harry', 'HR')
+        self.transition(self.submission_id, 'Done', 'fred', 'Finance')
+        second = self.submit(self.template)
+        self.transition(second, 'Approved', 'mary', 'Manager')
+        untouched = self.submit(self.template)
+
+        WorkflowInstance.objects.update(current_state='Submitted', partial_approvals={})
+        drifted = rebuild_instances(WorkflowInstance.objects.all())
+        self.assertEqual(len(drifted), 2)
+        states = dict(WorkflowInstance.objects.values_list('submission_id', 'current_state'))
+        self.assertEqual(states, {self.submission_id: 'Done', second: 'Submitted', untouched: 'Submitted'})
+        self.assertEqual(WorkflowInstance.objects.get(submission_id=second).partial_approvals,
+                         {'Approved': ['mary']})
+        self.assertFalse(WorkflowInboxEntry.objects.filter(instance__submission_id=self.submission_id).exists())
+        self.assertEqual(rebuild_instances(WorkflowInstance.objects.all(), save=False), [])
+
+
+class EventStreamTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.broker = InProcessBroker()
+        patcher = mock.patch.object(notify, '_broker', self.broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.template, _ = self.create_workflow()
+
+    def published(self):
+        return [message for _, message in self.broker.since(f'{self.broker.epoch}-0')]
+
+    def stream(self, users, publish=(), last_event_id=None, ticket=False):
+        """Connect one stream per ``(username, roles)``, publish ``publish`` and
+        return ``{username: [(event, data, id)]}`` once every stream is idle.
+        With ``ticket`` the streams authenticate like EventSource does, with a stream ticket."""
+        scopes = {}
+        for username, roles in users:
+            headers, query_string = [], b''
+            if ticket:
+                response = self.client.post('/api/stream/ticket/', **self.auth(username, *roles))
+                self.assertEqual(response.status_code, 201, response.content)
+                query_string = f"ticket={response.json()['ticket']}".encode()
+            else:
+                headers.append((b'authorization', self.auth(username, *roles)['HTTP_AUTHORIZATION'].encode()))
+            if last_event_id:
+                headers.append((b'last-event-id', last_event_id.encode()))
+            scopes[username] = {'type': 'http', 'path': STREAM_PATH, 'headers': headers, 'query_string': query_string}
+
+        async def run():
+            closed = asyncio.Event()
+            bodies = {username: [] for username, _ in users}
+            starts = {}
+
+            async def receive():
+                await closed.wait()
+                return {'type': 'http.disconnect'}
+
+            def sender(username):
+                async def send(message):
+                    if message['type'] == 'http.response.start':
+                        starts[username] = message['status']
+                    else:
+                        bodies[username].append(message.get('body', b''))
+                return send
+
+            tasks = [asyncio.ensure_future(event_stream(scope, receive, sender(username)))
+                     for username, scope in scopes.items()]
+            while self.broker.subscriber_count < len(users):
+                await asyncio.sleep(0.01)
+            for message in publish:
+                self.broker.publish(message)
+            await asyncio.sleep(0.05)
+            closed.set()
+            await asyncio.gather(*tasks)
+            return starts, bodies
+
+        starts, bodies = asyncio.run(run())
+        self.assertEqual(set(starts.values()), {200})
+        events = {}
+        for username, chunks in bodies.items():
+            events[username] = []
+            for block in b''.join(chunks).decode().split('\n\n'):
+                fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line)
+                if 'event' in fields:
+                    events[username].append((fields['event'], json.loads(fields['data']), fields.get('id')))
+        return events
+
+    def test_changes_are_published_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            submission_id = self.submit(self.template)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.transition(submission_id, 'Approved', 'mary', 'Manager')
+        self.assertEqual(len(self.published()), 1)
+        for callback in callbacks:
+            callback()
+
+        submitted, approved = self.published()
+        self.assertEqual((submitted['old_roles'], submitted['roles']), ([], ['Manager']))
+        self.assertEqual((approved['old_roles'], approved['roles'], approved['current_state']),
+                         (['Manager'], ['HR'], 'Approved'))
+        self.assertEqual(approved['submitted_by'], 'alice')
+
+    def test_events_are_filtered_per_user(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            submission_id = self.submit(self.template)
+            self.transition(submission_id, 'Approved', 'mary', 'Manager')
+        events = self.stream(
+            [('alice', ['Employee']), ('mary', ['Manager']), ('harry', ['HR']), ('fred', ['Finance'])],
+            publish=self.published(),
+        )
+        self.assertEqual([(e, d['current_state']) for e, d, _ in events['alice']],
+                         [('submission', 'Submitted'), ('submission', 'Approved')])
+        self.assertEqual([d['action'] for _, d, _ in events['mary']], ['added', 'removed'])
+        self.assertEqual([(e, d['action']) for e, d, _ in events['harry']], [('inbox', 'added')])
+        self.assertEqual(events['fred'], [])
+
+    def test_resume_from_last_event_id(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            submission_id = self.submit(self.template)
+            self.transition(submission_id, 'Approved', 'mary', 'Manager')
+        events = self.stream([('alice', ['Employee'])], last_event_id=f'{self.broker.epoch}-1')
+        self.assertEqual([(d['current_state'], i) for _, d, i in events['alice']],
+                         [('Approved', f'{self.broker.epoch}-2')])
+
+        events = self.stream([('alice', ['Employee'])], last_event_id='stale-1')
+        self.assertEqual([e for e, _, _ in events['alice']], ['reset'])
+
+    def rejected(self, query_string=b''):
+        sent = []
+
+        async def receive():
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(event_stream({'type': 'http', 'path': STREAM_PATH, 'headers': [], 'query_string': query_string},
+                                 receive, send))
+        self.assertEqual(self.broker.subscriber_count, 0)
+        return sent[0]['status']
+
+    def test_stream_requires_a_token(self):
+        self.assertEqual(self.rejected(), 401)
+
+    def test_stream_opens_with_a_ticket(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.submit(self.template)
+        events = self.stream([('alice', ['Employee']), ('mary', ['Manager'])], publish=self.published(), ticket=True)
+        self.assertEqual([e for e, _, _ in events['alice']], ['submission'])
+        self.assertEqual([(e, d['action']) for e, d, _ in events['mary']], [('inbox', 'added')])
+
+    def test_tickets_expire_and_access_tokens_stay_out_of_urls(self):
+        ticket = self.client.post('/api/stream/ticket/', **self.auth('mary', 'Manager')).json()['ticket']
+        with override_settings(WORKFLOW_STREAM_TICKET_TTL=-1):
+            self.assertEqual(self.rejected(f'ticket={ticket}'.encode()), 401)
+        self.assertEqual(self.rejected(f'ticket={ticket[:-1]}x'.encode()), 401)
+        token = self.auth('mary', 'Manager')['HTTP_AUTHORIZATION'].split()[1]
+        self.assertEqual(self.rejected(f'access_token={token}'.encode()), 400)
+
+
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+
+    def close(self, submission_id):
+        self.assertEqual(self.transition(submission_id, 'Approved', 'mary', 'Manager').status_code, 200)
+        self.assertEqual(self.transition(submission_id, 'Done', 'hank', 'HR').status_code, 200)
+
+    def test_instances_close_in_terminal_states(self):
+        self.assertEqual(get_compiled_workflow(self.template.id).terminal_states, {'Done'})
+        open_id, closed_id = self.submit(self.template), self.submit(self.template)
+        self.close(closed_id)
+
+        self.assertTrue(WorkflowInstance.objects.get(submission_id=open_id).is_open)
+        self.assertFalse(WorkflowInstance.objects.get(submission_id=closed_id).is_open)
+        response = self.client.get('/api/submissions/?open=true', **self.auth('root', 'Admin'))
+        self.assertEqual([item['submission']['id'] for item in response.json()], [open_id])
+        response = self.client.get('/api/submissions/?open=maybe', **self.auth('root', 'Admin'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_archived_submissions_stay_readable(self):
+        open_id, old_id, recent_id = (self.submit(self.template) for _ in range(3))
+        self.close(old_id)
+        self.close(recent_id)
+        WorkflowInstance.objects.filter(submission_id=old_id).update(updated_at=timezone.now() - timedelta(days=40))
+
+        out = io.StringIO()
+        call_command('archive_instances', days=30, batch_size=1, stdout=out)
+        self.assertIn('Archived 1 instances', out.getvalue())
+        self.assertFalse(FormSubmission.objects.filter(id=old_id).exists())
+        self.assertFalse(WorkflowEvent.objects.filter(instance__submission_id=old_id).exists())
+        self.assertCountEqual(WorkflowInstance.objects.values_list('submission_id', flat=True), [open_id, recent_id])
+        archived = ArchivedInstance.objects.get()
+        self.assertEqual((archived.submission_id, archived.current_state), (old_id, 'Done'))
+
+        response = self.client.get(f'/api/submissions/{old_id}/history/', **self.auth('alice', 'Employee'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(e['submission_id'], e['to_state']) for e in response.json()],
+                         [(old_id, 'Approved'), (old_id, 'Done')])
+        response = self.client.get(f'/api/submissions/{old_id}/history/', **self.auth('bob', 'Employee'))
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get('/api/my-submissions/?archived=true', **self.auth('alice', 'Employee'))
+        self.assertEqual(response.status_code, 200)
+        [item] = response.json()
+        self.assertEqual((item['submission']['id'], item['submission']['data']), (old_id, {'reason': 'holiday'}))
+        self.assertEqual(len(self.client.get('/api/my-submissions/', **self.auth('alice', 'Employee')).json()), 2)
+
+
+class DurationSketchTests(SimpleTestCase):
+    def test_quantiles_are_within_the_relative_error_and_sketches_merge(self):
+        rng = random.Random(7)
+        durations = sorted(rng.lognormvariate(8, 2) for _ in range(5000))
+        first, second, whole = analytics.DurationSketch(), analytics.DurationSketch(), analytics.DurationSketch()
+        for n, seconds in enumerate(durations):
+            (first if n % 2 else second).add(seconds)
+            whole.add(seconds)
+        first.merge(analytics.DurationSketch(second.to_json()))
+
+        self.assertEqual(first.buckets, whole.buckets)
+        for q in analytics.QUANTILES:
+            exact = durations[round(q * (len(durations) - 1))]
+            self.assertAlmostEqual(whole.quantile(q) / exact, 1, delta=analytics.ALPHA)
+        self.assertIsNone(analytics.DurationSketch().quantile(0.5))
+
+
+class AnalyticsTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+        self.started = timezone.now() - timedelta(hours=3)
+
+    def later(self):
+        return timezone.now() + timedelta(minutes=5)  # past the fold lag
+
+    def states(self):
+        return dict(StateCount.objects.filter(form_template=self.template).values_list('state', 'count'))
+
+    def test_fold_counts_states_and_times_transitions(self):
+        first, second = self.submit(self.template), self.submit(self.template)
+        FormSubmission.objects.update(submitted_at=self.started)
+        self.transition(first, 'Approved', 'mary', 'Manager')
+        WorkflowEvent.objects.update(created_at=self.started + timedelta(hours=2))
+
+        self.assertEqual(analytics.fold(now=self.later()), 3)
+        self.assertEqual(analytics.fold(now=self.later()), 0)
+        self.assertEqual(self.states(), {'Submitted': 1, 'Approved': 1})
+        rollup = TransitionRollup.objects.get()
+        self.assertEqual((rollup.from_state, rollup.to_state, rollup.count), ('Submitted', 'Approved', 1))
+        self.assertAlmostEqual(rollup.total_seconds, 7200, delta=1)
+
+        self.transition(first, 'Done', 'hank', 'HR')
+        self.transition(second, 'Approved', 'mary', 'Manager')
+        WorkflowEvent.objects.filter(to_state='Done').update(created_at=self.started + timedelta(hours=2, minutes=30))
+        self.assertEqual(analytics.fold(batch_size=1, now=self.later()), 1)  # resumes from its watermark
+        self.assertEqual(analytics.fold(now=self.later()), 1)
+        self.assertEqual(self.states(), {'Submitted': 0, 'Approved': 1, 'Done': 1})
+        done = TransitionRollup.objects.get(to_state='Done')
+        self.assertAlmostEqual(done.total_seconds, 1800, delta=1)  # since the instance entered Approved
+
+    def test_unversioned_instances_are_left_out_of_state_counts(self):
+        first, second = self.submit(self.template), self.submit(self.template)
+        FormSubmission.objects.update(submitted_at=self.started)
+        self.transition(first, 'Approved', 'mary', 'Manager')
+        self.transition(second, 'Approved', 'mary', 'Manager')
+        WorkflowInstance.objects.filter(submission_id=second).update(workflow_version=None)  # predates versions
+
+        analytics.fold(now=self.later())
+        self.assertEqual(self.states(), {'Approved': 1})
+        self.assertEqual(TransitionRollup.objects.get().count, 2)  # its transition is still timed
+
+    def test_rebuild_counts_instances_that_moved_before_the_event_log(self):
+        legacy, moved = self.submit(self.template), self.submit(self.template)
+        WorkflowInstance.objects.filter(submission_id=moved).update(current_state='Approved')  # no events
+        FormSubmission.objects.update(submitted_at=self.started)
+
+        call_command('fold_analytics', rebuild=True, stdout=io.StringIO())
+        self.assertEqual(self.states(), {'Submitted': 1, 'Approved': 1})
+
+        self.transition(legacy, 'Approved', 'mary', 'Manager')
+        self.transition(moved, 'Done', 'hank', 'HR')
+        WorkflowEvent.objects.update(created_at=self.started)
+        self.assertEqual(analytics.fold(now=self.later()), 2)
+        self.assertEqual(self.states(), {'Submitted': 0, 'Approved': 1, 'Done': 1})
+
+    def test_rows_younger_than_the_lag_wait_for_the_next_fold(self):
+        self.submit(self.template)
+        self.assertEqual(analytics.fold(), 0)
+        self.assertEqual(self.states(), {})
+        self.assertEqual(analytics.fold(now=self.later()), 1)
+
+    def test_endpoint_reports_counts_and_percentiles(self):
+        submission_id = self.submit(self.template)
+        FormSubmission.objects.update(submitted_at=self.started)
+        self.transition(submission_id, 'Approved', 'mary', 'Manager')
+        analytics.fold(now=self.later())
+
+        response = self.client.get(f'/api/analytics/?form_template={self.template.id}', **self.auth('mary', 'Manager'))
+        self.assertEqual(response.status_code, 200)
+        [entry] = response.json()['templates']
+        self.assertEqual(entry['states'], {'Approved': 1})
+        [edge] = entry['transitions']
+        self.assertEqual((edge['from_state'], edge['to_state'], edge['count']), ('Submitted', 'Approved', 1))
+        self.assertAlmostEqual(edge['p50_seconds'] / edge['mean_seconds'], 1, delta=analytics.ALPHA)
+        self.assertIsNotNone(response.json()['as_of'])
+
+        self.assertEqual(self.client.get('/api/analytics/', **self.auth('alice', 'Employee')).status_code, 403)
+        response = self.client.get('/api/analytics/?since=yesterday', **self.auth('root', 'Admin'))
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+        self.body = {'form_template': self.template.id, 'data': {'reason': 'holiday'}}
+
+    def post(self, key, body=None, path='/api/submit-form/', username='alice'):
+        return self.client.post(path, body or self.body, content_type='application/json',
+                                HTTP_IDEMPOTENCY_KEY=key, **self.auth(username, 'Employee', 'Manager'))
+
+    def in_flight(self, key, body=None, path='/api/submit-form/', age=0):
+        created_at = timezone.now() - timedelta(seconds=age)
+        request_hash = hashlib.sha256(f'POST {path}\n{json.dumps(body or self.body)}'.encode()).hexdigest()
+        return IdempotencyKey.objects.create(username='alice', key=key, request_hash=request_hash,
+                                             created_at=created_at, expires_at=created_at + timedelta(days=1))
+
+    def test_retries_take_effect_once(self):
+        first = self.post('k1')
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', first)
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.post('k1')
+        self.assertEqual(len(queries), 0)  # served from the in-memory front cache
+        idempotency.completed.clear()
+        from_table = self.post('k1')
+
+        for response in (retry, from_table):
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response['Idempotent-Replayed'], 'true')
+            self.assertEqual(response.json(), first.json())
+        self.assertEqual(FormSubmission.objects.count(), 1)
+        self.assertEqual(self.post('k1', username='bob').status_code, 201)  # keys are per user
+        self.assertEqual(FormSubmission.objects.count(), 2)
+
+    def test_retried_transition_is_not_approved_twice(self):
+        submission_id = self.submit(self.template)
+        body = {'submission_id': submission_id, 'next_state': 'Approved'}
+        for _ in range(2):
+            self.assertEqual(self.post('t1', body, path='/api/transition/').status_code, 200)
+        self.assertEqual(WorkflowEvent.objects.filter(instance__submission_id=submission_id).count(), 1)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.post('k2')
+        response = self.post('k2', {'form_template': self.template.id, 'data': {'reason': 'other'}})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(FormSubmission.objects.count(), 1)
+        self.assertEqual(self.post('k2', path='/api/submit-form/?dry_run=1').status_code, 422)
+
+    def test_streamed_bodies_are_hashed_as_read(self):
+        def bulk(reason):
+            line = json.dumps({'form_template': self.template.id, 'data': {'reason': reason}})
+            return self.client.post('/api/submissions/bulk/', line, content_type='application/x-ndjson',
+                                    HTTP_IDEMPOTENCY_KEY='b1', **self.auth('root', 'Admin'))
+
+        self.assertEqual(bulk('aaa').status_code, 200)
+        self.assertEqual(bulk('aaa')['Idempotent-Replayed'], 'true')
+        idempotency.completed.clear()  # a worker without the response in memory
+        self.assertEqual(bulk('aaa')['Idempotent-Replayed'], 'true')
+        self.assertEqual(bulk('bbb').status_code, 422)  # same length, other body
+        self.assertEqual(FormSubmission.objects.count(), 1)
+
+    @override_settings(WORKFLOW_IDEMPOTENCY_WAIT_SECONDS=0.1)
+    def test_duplicate_of_a_running_request_gets_409(self):
+        self.in_flight('k3')
+        response = self.post('k3')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(FormSubmission.objects.exists())
+
+    def test_key_of_a_dead_request_is_taken_over(self):
+        self.in_flight('k4', age=3600)
+        self.assertEqual(self.post('k4').status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get(key='k4').status_code, 201)
+
+    def test_failed_request_gives_up_its_key(self):
+        with mock.patch('core.views.get_validator', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.post('k5')
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.post('k5').status_code, 201)
+
+    def test_expired_keys_are_purged_in_batches(self):
+        for n in range(5):
+            self.in_flight(f'old{n}', age=2 * 86400)
+        self.in_flight('fresh')
+        out = io.StringIO()
+        call_command('purge_idempotency_keys', batch_size=2, stdout=out)
+        self.assertIn('Purged 5', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['fresh'])
+
+
+class RowSerializerTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+        self.submitted = [self.submit(self.template, reason='holiday'),
+                          self.submit(self.template, reason='caf\u00e9 \u2028 \U0001f600', days=1.5),
+                          self.submit(self.template, reason='big', days=1e16)]
+        WorkflowInstance.objects.filter(submission_id=self.submitted[0]).update(
+            escalations={'Approved': ['Director']}, partial_approvals={'Approved': ['Manager']},
+        )
+
+    def assertSameBytes(self, serializer_class, queryset, **kwargs):
+        rows = row_serializer(serializer_class, **kwargs)
+        expected = JSONRenderer().render(serializer_class(queryset, many=True, **kwargs).data)
+        actual = renderers.FastJSONRenderer().render(rows.serialize(queryset.values(*rows.columns)))
+        self.assertEqual(actual, expected)
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(renderers.FastJSONRenderer().render(rows.serialize(queryset.values(*rows.columns))),
+                             expected)
+
+    def test_rows_render_like_the_serializer(self):
+        instances = WorkflowInstance.objects.order_by('id')
+        for kwargs in ({}, {'expand': set()}, {'expand': {'form_template'}}, {'fields': {'id', 'updated_at'}},
+                       {'fields': {'submission', 'current_state'}, 'expand': set()},
+                       {'fields': {'id', 'escalations'}}):
+            with self.subTest(**kwargs):
+                self.assertSameBytes(WorkflowInstanceSerializer, instances, **kwargs)
+
+    def test_archived_rows_render_like_the_serializer(self):
+        for submission_id in self.submitted:
+            self.assertEqual(self.transition(submission_id, 'Approved', 'mary', 'Manager').status_code, 200)
+            self.assertEqual(self.transition(submission_id, 'Done', 'hank', 'HR').status_code, 200)
+        call_command('archive_instances', days=0, stdout=io.StringIO())
+        self.assertSameBytes(ArchivedInstanceSerializer, ArchivedInstance.objects.order_by('submission_id'))
+
+    def test_list_endpoint_serves_serializer_bytes(self):
+        instances = WorkflowInstance.objects.order_by('-updated_at', '-id')
+        response = self.client.get('/api/my-submissions/', {'limit': 2}, **self.auth('alice', 'Employee'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        expected = WorkflowInstanceSerializer(instances[:2], many=True).data
+        self.assertEqual(response.content, JSONRenderer().render(expected))
+        self.assertIn('X-Next-Cursor', response)
+
+    def test_unsupported_serializers_are_not_compiled(self):
+        self.assertIsNone(row_serializer(WorkflowDefinitionSerializer))  # nested many=True transitions
+
+
+class AdmissionControlTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+
+    @override_settings(WORKFLOW_THROTTLES={
+        'list_pending_approvals': {'*': {'rate': '2/m'}, 'Admin': {'rate': '100/m'}},
+    })
+    def test_rate_limits_are_per_user_and_role(self):
+        mary = self.auth('mary', 'Manager')
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/pending-approvals/', **mary).status_code, 200)
+        response = self.client.get('/api/pending-approvals/', **mary)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+
+        self.assertEqual(self.client.get('/api/pending-approvals/', **self.auth('maria', 'Manager')).status_code, 200)
+        for _ in range(3):
+            response = self.client.get('/api/pending-approvals/', **self.auth('root', 'Manager', 'Admin'))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/my-submissions/', **mary).status_code, 200)
+
+    @override_settings(WORKFLOW_THROTTLES={'transition_workflow': {'*': {'concurrency': 1}}})
+    def test_concurrent_requests_are_capped(self):
+        submission_id = self.submit(self.template)
+        request = RequestFactory().post('/api/transition/')
+        request.resolver_match = resolve('/api/transition/')
+        retry_after, release = throttling.admit(request, {'sub': 'mary', 'realm_access': {'roles': ['Manager']}})
+        self.assertIsNone(retry_after)
+
+        response = self.transition(submission_id, 'Approved', 'mary', 'Manager')
+        self.assertEqual((response.status_code, response['Retry-After']), (429, '1'))
+        self.assertEqual(self.transition(submission_id, 'Done', 'hank', 'HR').status_code, 400)  # not throttled
+        release()
+        self.assertEqual(self.transition(submission_id, 'Approved', 'mary', 'Manager').status_code, 200)
+
+    @override_settings(WORKFLOW_THROTTLES={'export_submissions': {'*': {'concurrency': 1}}})
+    def test_streamed_responses_hold_their_slot_until_closed(self):
+        self.submit(self.template)
+        admin = self.auth('root', 'Admin')
+        export = self.client.get('/api/submissions/export.csv', **admin)
+        self.assertEqual(export.status_code, 200)
+        self.assertEqual(self.client.get('/api/submissions/export.csv', **admin).status_code, 429)
+        b''.join(export.streaming_content)  # the server closes the response once it is sent
+        self.assertEqual(self.client.get('/api/submissions/export.csv', **admin).status_code, 200)
+
+    @override_settings(WORKFLOW_SHED_P99_MS=100, WORKFLOW_SHED_WINDOW_SECONDS=10)
+    def test_load_shedding_drops_reads_before_writes(self):
+        factory = RequestFactory()
+        shedder = throttling.LoadSheddingMiddleware(lambda request: HttpResponse('ok'))
+        for _ in range(20):
+            shedder.window.add(0.15)
+        response = shedder(factory.get('/api/pending-approvals/'))
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '10'))
+        self.assertEqual(shedder(factory.post('/api/transition/')).status_code, 200)
+        self.assertEqual(shedder(factory.get('/metrics')).status_code, 200)
+
+        shedder = throttling.LoadSheddingMiddleware(lambda request: HttpResponse('ok'))
+        for _ in range(20):
+            shedder.window.add(0.25)
+        self.assertEqual(shedder(factory.post('/api/transition/')).status_code, 503)
+
+        shedder = throttling.LoadSheddingMiddleware(lambda request: HttpResponse('ok'))
+        for _ in range(20):
+            shedder.window.add(0.25, now=time.monotonic() - 11)  # slow requests that have left the window
+        self.assertEqual(shedder(factory.get('/api/pending-approvals/')).status_code, 200)
+
+
+class SlaTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow(
+            states=('Submitted', 'Approved', 'Rejected'),
+            transitions=[('Submitted', 'Approved', ['Manager'], 'OR'), ('Submitted', 'Rejected', ['Manager'], 'OR')],
+        )
+
+    def set_sla(self, to_state, seconds, action, escalate_to=()):
+        Transition.objects.filter(workflow=self.workflow, to_state=to_state).update(
+            sla_seconds=seconds, timeout_action=action, escalate_to=list(escalate_to),
+        )
+        clear_compiled_workflows()
+        cache.clear()
+
+    def later(self, seconds):
+        return timezone.now() + timedelta(seconds=seconds)
+
+    def test_entering_a_state_arms_its_earliest_deadline(self):
+        self.set_sla('Approved', 600, 'notify')
+        self.set_sla('Rejected', 60, 'notify')
+        submission_id = self.submit(self.template)
+        timer = WorkflowTimer.objects.get(instance__submission_id=submission_id)
+        self.assertEqual((timer.state, timer.step), ('Submitted', 0))
+        self.assertAlmostEqual((timer.due_at - timer.entered_at).total_seconds(), 60)
+
+        self.transition(submission_id, 'Approved', 'mary', 'Manager')
+        self.assertFalse(WorkflowTimer.objects.filter(instance__submission_id=submission_id).exists())
+
+    def test_notify_then_auto_transition(self):
+        self.set_sla('Approved', 60, 'notify')
+        self.set_sla('Rejected', 120, 'transition')
+        submission_id = self.submit(self.template)
+        scheduler = sla.Scheduler()
+
+        self.assertEqual(scheduler.run_once(self.later(30)), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(scheduler.run_once(self.later(61)), 1)
+        instance = WorkflowInstance.objects.get(submission_id=submission_id)
+        self.assertEqual(instance.current_state, 'Submitted')
+        self.assertEqual(instance.timer.step, 1)
+
+        self.assertEqual(scheduler.run_once(self.later(121)), 1)
+        instance.refresh_from_db()
+        self.assertEqual(instance.current_state, 'Rejected')
+        self.assertFalse(WorkflowTimer.objects.filter(instance=instance).exists())
+        self.assertFalse(WorkflowInboxEntry.objects.filter(instance=instance).exists())
+        self.assertEqual(
+            list(instance.events.values_list('kind', 'actor', 'to_state')),
+            [('overdue', sla.SYSTEM_ACTOR, 'Approved'), ('transitioned', sla.SYSTEM_ACTOR, 'Rejected')],
+        )
+        self.assertEqual(rebuild_instances(WorkflowInstance.objects.all(), save=False), [])
+
+    def test_escalation_lets_extra_roles_approve(self):
+        self.set_sla('Approved', 60, 'escalate', ['Director'])
+        submission_id = self.submit(self.template)
+        self.assertEqual(self.transition(submission_id, 'Approved', 'dora', 'Director').status_code, 403)
+
+        self.assertEqual(sla.Scheduler().run_once(self.later(61)), 1)
+        pending = self.client.get('/api/pending-approvals/', **self.auth('dora', 'Director')).json()
+        self.assertEqual([item['submission']['id'] for item in pending], [submission_id])
+        self.assertNotIn('escalations', pending[0])  # only on request, the default payload is unchanged
+        pending = self.client.get('/api/pending-approvals/', {'fields': 'submission,escalations'},
+                                  **self.auth('dora', 'Director')).json()
+        self.assertEqual(pending[0]['escalations'], {'Approved': ['Director']})
+        transitions = self.client.get(f'/api/transitions/{submission_id}/', **self.auth('dora', 'Director')).json()
+        self.assertEqual([t['to_state'] for t in transitions], ['Approved'])
+
+        self.assertEqual(self.transition(submission_id, 'Approved', 'dora', 'Director').status_code, 200)
+        instance = WorkflowInstance.objects.get(submission_id=submission_id)
+        self.assertEqual((instance.current_state, instance.escalations), ('Approved', {}))
+        self.assertEqual(instance.events.latest('id').roles, ['Director'])
+
+    def test_leases_keep_workers_from_double_firing(self):
+        self.set_sla('Approved', 60, 'notify')
+        self.submit(self.template)
+        first, second = sla.Scheduler(lease_seconds=30), sla.Scheduler(lease_seconds=30)
+        timer_id = WorkflowTimer.objects.get().id
+        now = self.later(61)
+
+        token, claimed = first.claim([timer_id], now)
+        self.assertEqual(claimed, 1)
+        self.assertEqual(second.claim([timer_id], now)[1], 0)
+        self.assertEqual(second.run_once(now), 0)
+        # The first worker died holding the lease; the timer comes due again when it runs out.
+        self.assertEqual(second.run_once(now + timedelta(seconds=31)), 1)
+        self.assertEqual(sla.fire(token), 0)
+        self.assertEqual(WorkflowEvent.objects.filter(kind='overdue').count(), 1)
+
+    def test_idle_pass_reads_only_the_front_of_the_due_index(self):
+        self.set_sla('Approved', 86400, 'notify')
+        for _ in range(5):
+            self.submit(self.template)
+        scheduler = sla.Scheduler(batch_size=2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(scheduler.run_once(), 0)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('ORDER BY "core_workflowtimer"."due_at" ASC LIMIT 8', queries[0]['sql'])
+
+    def test_new_slas_apply_to_instances_started_on_the_new_version(self):
+        self.submit(self.template)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(f'/api/workflow-definition/{self.workflow.id}/', {'transitions': [
+                {'from_state': 'Submitted', 'to_state': 'Approved', 'allowed_roles': ['Manager'], 'sla_seconds': 60},
+            ]}, content_type='application/json', **self.auth('root', 'Admin'))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['transitions'][0]['sla_seconds'], 60)
+        self.assertFalse(WorkflowTimer.objects.exists())
+
+        submission_id = self.submit(self.template)
+        self.assertEqual(WorkflowTimer.objects.get().instance.submission_id, submission_id)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentTransitionTests(APITestMixin, TransactionTestCase):
+    """Fires approvals from many threads at once; needs a database with row locks."""
+
+    approvers = 12
+
+    def test_parallel_approvals_are_not_lost(self):
+        roles = [f'Role{i}' for i in range(self.approvers + 1)]
+        template, _ = self.create_workflow(transitions=[('Submitted', 'Approved', roles, 'AND')])
+        submission_id = self.submit(template)
+        barrier = threading.Barrier(self.approvers)
+        statuses = []
+
+        def approve(i):
+            try:
+                client = Client()
+                barrier.wait()
+                response = client.post(
+                    '/api/transition/', {'submission_id': submission_id, 'next_state': 'Approved'},
+                    content_type='application/json', **self.auth(f'user{i}', roles[i]),
+                )
+                statuses.append(response.status_code)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=approve, args=(i,)) for i in range(self.approvers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        instance = WorkflowInstance.objects.get(submission_id=submission_id)
+        self.assertEqual(statuses, [200] * self.approvers)
+        self.assertEqual(instance.current_state, 'Submitted')
+        self.assertCountEqual(instance.partial_approvals['Approved'], [f'user{i}' for i in range(self.approvers)])
+
+
+class BulkTransitionTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow()
+
+    def bulk(self, items, username='mary', *roles):
+        return self.client.post(
+            '/api/transitions/bulk/', items, content_type='application/json',
+            **self.auth(username, *(roles or ('Manager',))),
+        )
+
+    def test_each_item_gets_its_own_result(self):
+        ok, stale, done = (self.submit(self.template) for _ in range(3))
+        self.transition(done, 'Approved', 'mary', 'Manager')
+        response = self.bulk([
+            {'submission_id': ok, 'next_state': 'Approved', 'expected_state': 'Submitted'},
+            {'submission_id': stale, 'next_state': 'Approved', 'expected_state': 'Approved'},
+            {'submission_id': done, 'next_state': 'Done'},
+            {'submission_id': ok, 'next_state': 'Nowhere'},
+            {'submission_id': 999999, 'next_state': 'Approved'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [r['status'] for r in response.json()['results']],
+            ['ok', 'conflict', 'forbidden', 'invalid', 'invalid'],
+        )
+        self.assertEqual(WorkflowInstance.objects.get(submission_id=ok).current_state, 'Approved')
+        self.assertEqual(WorkflowInstance.objects.get(submission_id=stale).current_state, 'Submitted')
+        self.assertEqual(
+            list(WorkflowInboxEntry.objects.filter(instance__submission_id=ok).values_list('role', flat=True)),
+            ['HR'],
+        )
+
+    def test_query_count_is_independent_of_batch_size(self):
+        def run(count):
+            items = [{'submission_id': self.submit(self.template), 'next_state': 'Approved'} for _ in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.bulk(items)
+            self.assertTrue(all(r['status'] == 'ok' for r in response.json()['results']))
+            return len(queries)
+
+        self.assertEqual(run(2), run(20))
+
+    def test_malformed_body_is_rejected(self):
+        self.assertEqual(self.bulk({'items': 'nope'}).status_code, 400)
+        self.assertEqual(self.bulk([{'next_state': 'Approved'}]).status_code, 400)
+
+
+class BulkSubmissionTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow()
+
+    def test_valid_rows_are_created_and_bad_lines_reported(self):
+        lines = [
+            json.dumps({'form_template': self.template.id, 'data': {'reason': 'a'}}),
+            '{not json',
+            json.dumps({'form_template': self.template.id, 'data': {}}),
+            '',
+            json.dumps({'form_template': 424242, 'data': {'reason': 'b'}}),
+            json.dumps({'form_template': self.template.id, 'data': {'reason': 'c'}, 'submitted_by': 'legacy'}),
+        ]
+        response = self.client.post(
+            '/api/submissions/bulk/', '\n'.join(lines), content_type='application/x-ndjson',
+            **self.auth('root', 'Admin'),
+        )
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['rows'], report['created'], report['failed']), (5, 2, 3))
+        self.assertEqual([e['line'] for e in report['errors']], [2, 3, 5])
+
+        instances = WorkflowInstance.objects.order_by('id')
+        self.assertEqual([i.submission.submitted_by for i in instances], ['root', 'legacy'])
+        self.assertEqual({i.current_state for i in instances}, {'Submitted'})
+        self.assertEqual(WorkflowInboxEntry.objects.filter(role='Manager').count(), 2)
+
+    @override_settings(WORKFLOW_INGEST_CHUNK_SIZE=2)
+    def test_a_failed_chunk_is_reported_and_the_rest_imported(self):
+        lines = [json.dumps({'form_template': self.template.id, 'data': {'reason': f'r{i}'}}) for i in range(5)]
+        with mock.patch('core.ingest.arm_timers', side_effect=[None, DatabaseError('deadlock detected'), None]), \
+                self.assertLogs('core.ingest', 'ERROR'):
+            response = self.client.post('/api/submissions/bulk/', '\n'.join(lines),
+                                        content_type='application/x-ndjson', **self.auth('root', 'Admin'))
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['rows'], report['created'], report['failed']), (5, 3, 2))
+        self.assertEqual([e['line'] for e in report['errors']], [3, 4])
+        self.assertIn('deadlock detected', report['errors'][0]['error'])
+        self.assertEqual(sorted(FormSubmission.objects.values_list('data__reason', flat=True)), ['r0', 'r1', 'r4'])
+        self.assertEqual(WorkflowInstance.objects.count(), 3)
+
+    def test_requires_admin(self):
+        response = self.client.post('/api/submissions/bulk/', '', content_type='application/x-ndjson',
+                                    **self.auth('alice', 'Employee'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_import_command_reads_a_file_in_chunks(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as f:
+            for i in range(7):
+                f.write(json.dumps({'form_template': self.template.id, 'data': {'reason': f'r{i}'}}) + '\n')
+        self.addCleanup(os.unlink, f.name)
+        out = io.StringIO()
+        call_command('import_submissions', f.name, chunk_size=3, submitted_by='hr-import', stdout=out)
+        self.assertIn('7 of 7 rows imported', out.getvalue())
+        self.assertEqual(WorkflowInstance.objects.filter(submission__submitted_by='hr-import').count(), 7)
+
+
+class FormValidatorTests(SimpleTestCase):
+    validator = FormValidator({'fields': [
+        {'name': 'title', 'type': 'text', 'required': True, 'max_length': 5},
+        {'name': 'amount', 'type': 'number', 'min': 1, 'max': 100},
+        {'name': 'when', 'type': 'date'},
+        {'name': 'priority', 'type': 'text', 'enum': ['low', 'high']},
+        {'name': 'code', 'type': 'text', 'pattern': r'[A-Z]{2}\d'},
+    ]})
+
+    def test_valid_data(self):
+        data = {'title': 'Trip', 'amount': '42', 'when': '2025-06-30', 'priority': 'low', 'code': 'AB1'}
+        self.assertEqual(self.validator.validate(data), {})
+
+    def test_all_errors_are_collected_in_one_pass(self):
+        errors = self.validator.validate(
+            {'amount': 'lots', 'when': '30/06/2025', 'priority': 'urgent', 'code': 'ab1'}
+        )
+        self.assertEqual(set(errors), {'title', 'amount', 'when', 'priority', 'code'})
+        self.assertEqual(self.validator.validate({'title': 'Too long', 'amount': 500}),
+                         {'title': ['must be at most 5 characters'], 'amount': ['must be at most 100']})
+
+    def test_optional_fields_may_be_omitted(self):
+        self.assertEqual(self.validator.validate({'title': 'x', 'amount': ''}), {})
+
+    def test_zero_and_false_are_not_missing(self):
+        # Only None, '' and empty lists / objects count as missing; the old check also rejected 0 and False.
+        validator = FormValidator({'fields': [{'name': 'days', 'type': 'number', 'required': True},
+                                              {'name': 'agreed', 'type': 'boolean', 'required': True}]})
+        self.assertEqual(validator.validate({'days': 0, 'agreed': False}), {})
+        self.assertEqual(validator.validate({'days': None, 'agreed': []}),
+                         {'days': ['This field is required.'], 'agreed': ['This field is required.']})
+
+    def test_invalid_schemas_are_rejected_when_saved(self):
+        for schema in ({'fields': [{'type': 'text'}]},
+                       {'fields': [{'name': 'a', 'pattern': '('}]},
+                       {'fields': [{'name': 'a', 'type': 'text', 'min': 1}]},
+                       {'fields': [{'name': 'a', 'type': 'number', 'max': '10'}]}):
+            with self.assertRaises(SchemaError):
+                FormValidator(schema, strict=True)
+
+    def test_stored_schemas_skip_constraints_that_cannot_apply(self):
+        with self.assertLogs('core.validators', 'WARNING'):
+            validator = FormValidator({'fields': [
+                {'name': 'a', 'type': 'text', 'min': 1, 'required': True},
+                {'name': 'b', 'pattern': '(', 'max_length': 3},
+            ]})
+        self.assertEqual(validator.validate({'a': 'x', 'b': 'y'}), {})
+        self.assertEqual(validator.validate({'b': 'long'}), {'a': ['This field is required.'],
+                                                             'b': ['must be at most 3 characters']})
+
+
+class SubmitFormValidationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+
+    def test_type_errors_are_reported_per_field(self):
+        self.template.schema = {'fields': [
+            {'name': 'reason', 'type': 'text', 'required': True},
+            {'name': 'days', 'type': 'number', 'required': True},
+        ]}
+        self.template.save()
+        response = self.client.post(
+            '/api/submit-form/', {'form_template': self.template.id, 'data': {'days': 'three'}},
+            content_type='application/json', **self.auth('alice', 'Employee'),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['fields'], {'reason': ['This field is required.'],
+                                                     'days': ['must be a number']})
+        self.assertEqual(response.json()['error'], 'Missing required fields: reason. Invalid fields: days must be a number')
+
+    def test_validator_is_compiled_once_and_recompiled_after_update(self):
+        first = get_validator(self.template)
+        self.assertIs(get_validator(FormTemplate.objects.get(id=self.template.id)), first)
+
+        response = self.client.put(
+            f'/api/form-template/{self.template.id}/',
+            {'schema': {'fields': [{'name': 'reason', 'type': 'text', 'required': True, 'max_length': 3}]}},
+            content_type='application/json', **self.auth('root', 'Admin'),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FormTemplate.objects.get(id=self.template.id).version, 2)
+        self.assertIsNot(get_validator(FormTemplate.objects.get(id=self.template.id)), first)
+        submit = self.client.post(
+            '/api/submit-form/', {'form_template': self.template.id, 'data': {'reason': 'holiday'}},
+            content_type='application/json', **self.auth('alice', 'Employee'),
+        )
+        self.assertEqual(submit.status_code, 400)
+
+    def test_template_with_invalid_schema_cannot_be_created(self):
+        response = self.client.post(
+            '/api/form-template/', {'name': 'Broken', 'schema': {'fields': [{'name': 'x', 'pattern': '['}]}},
+            content_type='application/json', **self.auth('root', 'Admin'),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('schema', response.json())
+
+
+class ListEndpointTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow()
+
+    def get(self, url, *roles, **params):
+        return self.client.get(url, params, **self.auth('alice', *(roles or ('Employee',))))
+
+    def test_list_queries_stay_constant(self):
+        for i in range(3):
+            self.create_workflow(name=f'Extra {i}')
+        for _ in range(4):
+            self.submit(self.template)
+        # form-templates and workflows spend one extra query on their ETag stamp.
+        for url, roles, queries in (('/api/my-submissions/', (), 1),
+                                    ('/api/form-templates/', (), 2),
+                                    ('/api/workflows/', ('Admin',), 3)):
+            with self.assertNumQueries(queries):
+                self.assertEqual(len(self.get(url, *roles).json()), 4)
+
+    def test_my_submissions_are_paginated_by_cursor(self):
+        submitted = [self.submit(self.template) for _ in range(5)]
+        first = self.get('/api/my-submissions/', limit=3)
+        self.assertEqual([i['submission']['id'] for i in first.json()], submitted[::-1][:3])
+        self.assertIn('rel="next"', first['Link'])
+        second = self.get('/api/my-submissions/', limit=3, cursor=first['X-Next-Cursor'])
+        self.assertEqual([i['submission']['id'] for i in second.json()], submitted[::-1][3:])
+        self.assertNotIn('X-Next-Cursor', second)
+
+    def test_templates_can_be_referenced_instead_of_embedded(self):
+        self.submit(self.template)
+        embedded = self.get('/api/my-submissions/').json()[0]['submission']
+        self.assertEqual(embedded['form_template_details']['name'], 'Leave')
+        self.assertNotIn('version', embedded['form_template_details'])
+
+        referenced = self.get('/api/my-submissions/', expand='').json()[0]['submission']
+        self.assertEqual(referenced['form_template'], self.template.id)
+        self.assertNotIn('form_template_details', referenced)
+
+    def test_fields_projection(self):
+        self.submit(self.template)
+        self.assertEqual(list(self.get('/api/my-submissions/', fields='id,current_state').json()[0]),
+                         ['id', 'current_state'])
+        self.assertEqual(list(self.get('/api/form-templates/', fields='id,name').json()[0]), ['id', 'name'])
+        self.assertEqual(self.get('/api/form-templates/', fields='id,version').json()[0],
+                         {'id': self.template.id, 'version': 1})
+
+
+    def test_async_endpoints_answer_head_and_options(self):
+        submission_id = self.submit(self.template)
+        alice = self.auth('alice', 'Employee')
+        for url in ('/api/my-submissions/', '/api/pending-approvals/', f'/api/transitions/{submission_id}/'):
+            with self.subTest(url=url):
+                body = self.client.get(url, **alice).content
+                head = self.client.head(url, **alice)
+                self.assertEqual((head.status_code, head.content), (200, b''))
+                self.assertEqual(int(head['Content-Length']), len(body))
+                options = self.client.options(url, **alice)
+                self.assertEqual((options.status_code, options['Allow']), (200, 'GET, HEAD, OPTIONS'))
+                self.assertEqual(self.client.delete(url, **alice).status_code, 405)
+
+class SubmissionSearchTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow(name='Expenses')
+        self.template.schema = {'fields': [
+            {'name': 'amount', 'type': 'number', 'indexed': True},
+            {'name': 'department', 'type': 'text', 'indexed': True},
+        ]}
+        self.template.save()
+        self.other, self.other_workflow = self.create_workflow(
+            name='Other', transitions=[('Submitted', 'Approved', ['Legal'], 'OR')])
+        self.ids = {
+            'big_it': self.submit(self.template, 'alice', amount=7500, department='IT'),
+            'big_hr': self.submit(self.template, 'bob', amount='6000', department='HR'),
+            'small_it': self.submit(self.template, 'alice', amount=900, department='IT'),
+            'other': self.submit(self.other, 'carol', amount=9000, department='IT', reason='x'),
+        }
+
+    def search(self, *roles, username='root', **params):
+        return self.client.get('/api/submissions/', params, **self.auth(username, *(roles or ('Admin',))))
+
+    def found(self, *roles, **params):
+        response = self.search(*roles, **params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return {item['submission']['id'] for item in response.json()}
+
+    def test_numeric_path_comparison_uses_schema_type(self):
+        ids = self.ids
+        self.assertEqual(self.found(**{'form_template': self.template.id, 'data.amount__gt': '5000'}),
+                         {ids['big_it'], ids['big_hr']})
+        self.assertEqual(self.found(**{'form_template': self.template.id, 'data.amount__lte': '900'}),
+                         {ids['small_it']})
+        # Without a template the number in a range filter decides.
+        self.assertEqual(self.found(**{'data.amount__gte': '7500'}), {ids['big_it'], ids['other']})
+
+    def test_expense_claims_over_threshold_from_department(self):
+        params = {'form_template': self.template.id, 'data.amount__gt': '5000', 'data': '{"department": "IT"}'}
+        self.assertEqual(self.found(**params), {self.ids['big_it']})
+        self.assertEqual(self.found(**{'data.department__in': 'HR,Sales'}), {self.ids['big_hr']})
+        self.assertEqual(self.found(**{'data.department__ne': 'IT'}), {self.ids['big_hr']})
+
+    def test_instance_and_submission_filters(self):
+        self.transition(self.ids['small_it'], 'Approved', 'mary', 'Manager')
+        self.assertEqual(self.found(state='Approved'), {self.ids['small_it']})
+        self.assertEqual(self.found(submitted_by='alice', state='Submitted,Approved'),
+                         {self.ids['big_it'], self.ids['small_it']})
+        self.assertEqual(self.found(submitted_after='2000-01-01', submitted_before='2000-01-02'), set())
+        self.assertEqual(len(self.found(submitted_after='2000-01-01')), 4)
+
+    def test_non_admins_see_their_own_and_their_workflows(self):
+        self.assertEqual(self.found('Employee', username='alice'), {self.ids['big_it'], self.ids['small_it']})
+        self.assertEqual(self.found('Legal', username='lee'), {self.ids['other']})
+
+    def test_visibility_follows_the_roles_of_each_version(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                f'/api/workflow-definition/{self.other_workflow.id}/',
+                {'transitions': [{'from_state': 'Submitted', 'to_state': 'Approved', 'allowed_roles': ['Audit']}]},
+                content_type='application/json', **self.auth('root', 'Admin'),
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        later = self.submit(self.other, 'carol', amount=1, department='IT', reason='y')
+        self.assertEqual(self.found('Audit', username='ann'), {later})
+        self.assertEqual(self.found('Legal', username='lee'), {self.ids['other']})
+
+    def test_bad_filters_are_rejected(self):
+        for params in ({'data': '[1]'}, {'data': 'nope'}, {'form_template': 'x'},
+                       {'submitted_after': 'yesterday'}, {'data.a b': '1'},
+                       {'form_template': self.template.id, 'data.amount__gt': 'lots'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.search(**params).status_code, 400)
+
+    def test_indexed_fields_come_from_the_schema(self):
+        self.assertEqual(indexed_fields(self.template.schema), {'amount': 'numeric', 'department': 'text'})
+        self.assertEqual(sync_data_indexes(self.template), ([], []))  # no-op off PostgreSQL
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow(name='Expenses')
+        self.template.schema = {'fields': [{'name': 'amount', 'type': 'number'}, {'name': 'note', 'type': 'text'}]}
+        self.template.save()
+        self.first = self.submit(self.template, amount=7500, note='=HYPERLINK("x")')
+        self.second = self.submit(self.template, 'bob', amount=100, note='taxi')
+
+    def export(self, export_format, *roles, **params):
+        return self.client.get(f'/api/submissions/export.{export_format}', params,
+                               **self.auth('root', *(roles or ('Admin',))))
+
+    def test_csv_flattens_schema_fields(self):
+        self.transition(self.second, 'Approved', 'mary', 'Manager')
+        response = self.export('csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['submission_id'] for row in rows], [str(self.first), str(self.second)])
+        self.assertEqual(rows[0]['data.amount'], '7500')
+        self.assertEqual(rows[0]['data.note'], '\'=HYPERLINK("x")')
+        self.assertEqual(rows[1]['current_state'], 'Approved')
+        self.assertEqual(rows[1]['form_template'], 'Expenses')
+        self.assertNotIn('data.reason', rows[0])
+
+    def test_ndjson_keeps_data_and_takes_search_filters(self):
+        response = self.export('ndjson', **{'form_template': self.template.id, 'data.amount__gt': '1000'})
+        records = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([r['submission_id'] for r in records], [self.first])
+        self.assertEqual(records[0]['data']['amount'], 7500)
+        self.assertEqual(records[0]['current_state'], 'Submitted')
+
+    def test_admin_only_and_known_formats(self):
+        self.assertEqual(self.export('csv', 'Employee').status_code, 403)
+        self.assertEqual(self.export('xlsx').status_code, 404)
+        self.assertEqual(self.export('csv', submitted_after='soon').status_code, 400)
+
+    def test_command_writes_the_same_export(self):
+        out = io.StringIO()
+        call_command('export_submissions', '-', format='ndjson', filters=['submitted_by=bob'], stdout=out)
+        self.assertEqual([json.loads(line)['submission_id'] for line in out.getvalue().splitlines()], [self.second])
+
+    def test_memory_stays_flat(self):
+        # WORKFLOW_EXPORT_TEST_ROWS=1000000 runs the same check at full size.
+        rows = int(os.environ.get('WORKFLOW_EXPORT_TEST_ROWS', 12000))
+        templates = benchmark.seed(submissions=rows, workflows=3, users=50)
+
+        def peak(**params):
+            tracemalloc.start()
+            try:
+                lines = sum(chunk.count(b'\n') for chunk in self.export('csv', **params).streaming_content)
+                return lines, tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        some_lines, some_peak = peak(form_template=templates[0].id)
+        all_lines, all_peak = peak()
+        self.assertEqual(all_lines, rows + 3)
+        self.assertGreater(all_lines, 2 * some_lines)
+        self.assertLess(all_peak, 1.2 * some_peak, (some_lines, some_peak, all_lines, all_peak))
+
+
+class ExportOverASGITests(APITestMixin, TransactionTestCase):
+    def test_export_streams_under_asgi(self):
+        from workflow_project.asgi import application
+
+        template, _ = self.create_workflow()
+        submission_id = self.submit(template)
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/submissions/export.csv', 'raw_path': b'/api/submissions/export.csv', 'query_string': b'',
+            'root_path': '', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+            'headers': [(b'host', b'testserver'),
+                        (b'authorization', self.auth('root', 'Admin')['HTTP_AUTHORIZATION'].encode())],
+        }
+
+        async def fetch():
+            communicator = ApplicationCommunicator(application, scope)
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output(5)
+            body = b''
+            while True:
+                message = await communicator.receive_output(5)
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    return start['status'], body
+
+        status_code, body = asyncio.run(fetch())
+        self.assertEqual(status_code, 200)
+        self.assertEqual(body.decode().splitlines()[1].split(',')[0], str(submission_id))
+
+
+class QueryBudgetTests(TestCase):
+    """Every endpoint, on seeded data, stays within its query budget."""
+
+    def setUp(self):
+        cache.clear()
+        clear_compiled_workflows()
+        clear_validators()
+        idempotency.completed.clear()
+        self.addCleanup(keycloak.key_store.clear)
+        self.addCleanup(keycloak.token_cache.clear)
+
+    def test_every_endpoint_is_within_budget(self):
+        templates = benchmark.seed(submissions=300, workflows=3, users=10)
+        report = benchmark.run(benchmark.Scenario(templates, benchmark.TokenFactory()), iterations=3)
+        self.assertEqual(set(report), set(benchmark.QUERY_BUDGETS))
+        for name, result in report.items():
+            with self.subTest(endpoint=name):
+                self.assertTrue(result['within_budget'], result)
+                self.assertTrue(all(200 <= code < 300 for code in result['statuses']), result)
+
+    def test_every_route_has_a_budget(self):
+        # /metrics and the /api/stream/ SSE endpoint are routed outside core.urls.
+        self.assertLessEqual({pattern.name for pattern in urlpatterns}, set(benchmark.QUERY_BUDGETS))
+
+
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.template, self.workflow = self.create_workflow()
+
+    def get(self, url, username, *roles, etag=None, **params):
+        extra = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, params, **self.auth(username, *roles), **extra)
+
+    def assertRevalidates(self, url, username, *roles, change):
+        first = self.get(url, username, *roles)
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+        with self.assertNumQueries(1):
+            cached = self.get(url, username, *roles, etag=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(self.get(url, username, *roles, etag=etag, limit=1).status_code, 200)
+
+        change()
+        changed = self.get(url, username, *roles, etag=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_form_templates(self):
+        def edit():
+            self.client.put(f'/api/form-template/{self.template.id}/', {'schema': {'fields': []}},
+                            content_type='application/json', **self.auth('root', 'Admin'))
+        self.assertRevalidates('/api/form-templates/', 'alice', 'Employee', change=edit)
+
+    def test_workflows(self):
+        self.assertRevalidates('/api/workflows/', 'root', 'Admin',
+                               change=lambda: self.create_workflow(name='Expenses'))
+
+    def test_pending_approvals(self):
+        submission_id = self.submit(self.template)
+        self.assertRevalidates('/api/pending-approvals/', 'mary', 'Manager',
+                               change=lambda: self.transition(submission_id, 'Approved', 'mary', 'Manager'))
+
+    def test_pending_approvals_track_partial_approvals(self):
+        template, _ = self.create_workflow(name='Both', transitions=[
+            ('Submitted', 'Approved', ['Manager', 'HR'], 'AND'),
+        ])
+        submission_id = self.submit(template)
+        self.assertRevalidates('/api/pending-approvals/', 'harry', 'HR',
+                               change=lambda: self.transition(submission_id, 'Approved', 'mary', 'Manager'))
+
+    def test_etag_depends_on_roles(self):
+        self.submit(self.template)
+        manager = self.get('/api/pending-approvals/', 'mary', 'Manager')
+        self.assertEqual(self.get('/api/pending-approvals/', 'harry', 'HR', etag=manager['ETag']).status_code, 200)
+
+
+class MetricsTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        self.template, _ = self.create_workflow()
+
+    def scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    def test_requests_are_recorded_by_endpoint(self):
+        self.submit(self.template)
+        self.client.get('/api/form-templates/', **self.auth('alice', 'Employee'))
+        self.client.get('/api/pending-approvals/', **self.auth('mary', 'Manager'))  # async view
+
+        body = self.scrape()
+        self.assertIn('workflow_http_requests_total{endpoint="submit_form",method="POST",status="201"} 1.0', body)
+        self.assertIn('workflow_http_request_duration_seconds_count{endpoint="list_form_templates",method="GET"} 1',
+                      body)
+        for endpoint in ('submit_form', 'list_form_templates', 'list_pending_approvals'):
+            self.assertEqual(metrics.PHASES['auth'].count(endpoint), 1)
+            self.assertEqual(metrics.DB_QUERIES.count(endpoint), 1)
+            self.assertEqual(metrics.DB_TIME.count(endpoint), 1)
+        self.assertEqual(metrics.PHASES['serializer'].count('list_pending_approvals'), 1)
+        self.assertIn('workflow_db_queries_per_request_bucket{endpoint="list_pending_approvals",le="+Inf"} 1', body)
+
+    def test_query_count_includes_async_view_threads(self):
+        self.submit(self.template)
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get('/api/pending-approvals/', **self.auth('mary', 'Manager'))
+        self.assertGreater(len(captured), 0)
+        self.assertEqual(metrics.DB_QUERIES.total('list_pending_approvals'), len(captured))
+
+    async def test_async_middleware_chain(self):
+        await sync_to_async(self.submit)(self.template)
+        manager = {'Authorization': self.auth('mary', 'Manager')['HTTP_AUTHORIZATION']}
+        response = await AsyncClient().get('/api/pending-approvals/', **manager)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.REQUESTS.value('list_pending_approvals', 'GET', '200'), 1)
+        self.assertEqual(metrics.PHASES['auth'].count('list_pending_approvals'), 1)
+        self.assertEqual(metrics.PHASES['serializer'].count('list_pending_approvals'), 1)
+        self.assertGreater(metrics.DB_QUERIES.total('list_pending_approvals'), 0)
+
+    @override_settings(WORKFLOW_METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_only_record_latency(self):
+        self.client.get('/api/form-templates/', **self.auth('alice', 'Employee'))
+        self.assertEqual(metrics.LATENCY.count('list_form_templates', 'GET'), 1)
+        self.assertEqual(metrics.DB_QUERIES.count('list_form_templates'), 0)
+        self.assertEqual(metrics.PHASES['auth'].count('list_form_templates'), 0)
+
+    @override_settings(WORKFLOW_SLOW_REQUEST_MS=0)
+    def test_slow_requests_log_their_slowest_sql(self):
+        with self.assertLogs('core.metrics', 'WARNING') as logs:
+            self.client.get('/api/form-templates/', **self.auth('alice', 'Employee'))
+        self.assertIn('/api/form-templates/ (list_form_templates)', logs.output[0])
+        self.assertIn('FROM "core_formtemplate"', logs.output[0])
+
+    @override_settings(WORKFLOW_METRICS_TOKEN='scrape-secret')
+    def test_token_protects_the_endpoint(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(WORKFLOW_READ_REPLICAS=['replica'])
+class ReplicaRoutingTests(APITestMixin, TransactionTestCase):
+    """A second connection to the test database stands in for a replica."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        connections.databases['replica'] = dict(connections['default'].settings_dict)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections.databases['replica']
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.template, _ = self.create_workflow()
+
+    def queries(self, method, path, username, *roles, **kwargs):
+        """Status and ``(primary, replica)`` query counts of one request."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(path, **kwargs, **self.auth(username, *roles))
+        return response.status_code, len(primary), len(replica)
+
+    def test_writes_go_to_the_primary_and_list_views_to_the_replica(self):
+        status_code, primary, replica = self.queries(
+            'post', '/api/submit-form/', 'alice', 'Employee',
+            data={'form_template': self.template.id, 'data': {'reason': 'holiday'}}, content_type='application/json',
+        )
+        self.assertEqual((status_code, replica), (201, 0))
+        self.assertGreater(primary, 0)
+
+        for path, roles in (('/api/form-templates/', ['Employee']), ('/api/pending-approvals/', ['Manager']),
+                            ('/api/submissions/', ['Admin'])):
+            status_code, primary, replica = self.queries('get', path, 'mary', *roles)
+            self.assertEqual((status_code, primary), (200, 0), path)
+            self.assertGreater(replica, 0, path)
+
+    def test_writers_read_their_own_writes_from_the_primary(self):
+        self.submit(self.template, username='alice')
+        status_code, primary, replica = self.queries('get', '/api/my-submissions/', 'alice', 'Employee')
+        self.assertEqual((status_code, replica), (200, 0))
+        self.assertGreater(primary, 0)
+        self.assertEqual(self.queries('get', '/api/my-submissions/', 'bob', 'Employee')[1], 0)
+
+        with override_settings(WORKFLOW_REPLICA_PIN_SECONDS=0.01):
+            self.submit(self.template, username='carol')
+        time.sleep(0.05)
+        self.assertEqual(self.queries('get', '/api/my-submissions/', 'carol', 'Employee')[1], 0)
+
+
+class ConnectionHealthCheckTests(SimpleTestCase):
+    def connection(self, idle_for, usable):
+        conn = mock.Mock(connection=object(), idle_since=time.monotonic() - idle_for)
+        conn.is_usable.return_value = usable
+        return conn
+
+    def test_only_long_idle_connections_are_pinged(self):
+        fresh, stale, dead = self.connection(1, False), self.connection(60, True), self.connection(60, False)
+        with mock.patch.object(db, 'connections') as handler, override_settings(WORKFLOW_DB_HEALTH_CHECK_AFTER=30):
+            handler.all.return_value = [fresh, stale, dead]
+            db.check_connections()
+        fresh.is_usable.assert_not_called()
+        stale.close.assert_not_called()
+        dead.close.assert_called_once_with()
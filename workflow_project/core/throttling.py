@@ -0,0 +1,251 @@
+"""Admission control: per-user rate limits and concurrency caps, and load shedding.
+
+``WORKFLOW_THROTTLES`` maps an endpoint (its URL name, ``'*'`` for the rest)
+to rules per role (``'*'`` for any role)::
+
+    'list_pending_approvals': {'*': {'rate': '2/s', 'burst': 10, 'concurrency': 2}},
+
+A user gets the most generous rule among their roles. ``rate`` refills a
+token bucket holding up to ``burst`` requests (default: the rate's count);
+``concurrency`` caps that user's requests in flight on the endpoint. Both
+are keyed by the token's subject and checked by the auth decorators through
+``admit``. Rejected requests get a 429 with ``Retry-After``.
+
+State lives in the ``WORKFLOW_THROTTLE_CACHE`` cache: in-process with the
+default local-memory backend, shared by the workers with a shared one
+(buckets are then approximate, as two workers may refill the same bucket).
+
+``LoadSheddingMiddleware`` tracks the p99 latency of the last
+``WORKFLOW_SHED_WINDOW_SECONDS`` of API requests. While it is above
+``WORKFLOW_SHED_P99_MS`` reads are answered with 503, as they are the
+cheapest to retry; past ``WORKFLOW_SHED_WRITE_FACTOR`` times the threshold
+writes are too.
+"""
+import asyncio
+import hashlib
+import math
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+
+from .metrics import ADMISSION_REJECTED
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+CONCURRENCY_TIMEOUT = 300  # in-flight counts of a worker that died are forgotten after this
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_bucket_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """``'10/m'`` -> ``(10, 60)``: requests per period in seconds, like DRF's throttle rates."""
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+def _per_second(rule):
+    count, seconds = parse_rate(rule['rate']) if rule.get('rate') else (math.inf, 1)
+    return count / seconds
+
+
+def rule_for(endpoint, roles):
+    """The throttle rule applying to ``roles`` on ``endpoint``, or None."""
+    throttles = getattr(settings, 'WORKFLOW_THROTTLES', {})
+    rules = throttles.get(endpoint, throttles.get('*', {}))
+    matching = [rules[role] for role in roles if role in rules]
+    if not matching:
+        return rules.get('*')
+    return max(matching, key=lambda rule: (_per_second(rule), rule.get('concurrency') or math.inf))
+
+
+def _take_token(cache, key, rule, now):
+    """Take a token from the bucket; the seconds until one is available if it is empty."""
+    count, seconds = parse_rate(rule['rate'])
+    rate = count / seconds
+    burst = rule.get('burst', count)
+    with _bucket_lock:
+        tokens, stamp = cache.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - stamp) * rate)
+        if tokens < 1:
+            return math.ceil((1 - tokens) / rate)
+        cache.set(key, (tokens - 1, now), math.ceil(burst / rate) + 1)
+    return None
+
+
+def _enter(cache, key, limit):
+    cache.add(key, 0, CONCURRENCY_TIMEOUT)
+    try:
+        active = cache.incr(key)
+    except ValueError:  # expired just now
+        cache.set(key, 1, CONCURRENCY_TIMEOUT)
+        active = 1
+    if active > limit:
+        _leave(cache, key)
+        return False
+    return True
+
+
+def _leave(cache, key):
+    try:
+        cache.decr(key)
+    except ValueError:
+        pass
+
+
+def _no_op():
+    pass
+
+
+def admit(request, user_info):
+    """Charge the request to its user's limits on this endpoint.
+
+    Returns ``(None, release)`` when admitted, ``release`` to be passed to
+    ``release_when_sent`` with the view's response, or ``(retry_after, None)``
+    when throttled.
+    """
+    match = getattr(request, 'resolver_match', None)
+    endpoint = match.url_name if match and match.url_name else ''
+    rule = rule_for(endpoint, user_info.get('realm_access', {}).get('roles', []))
+    if not rule:
+        return None, _no_op
+    subject = user_info.get('sub') or user_info.get('preferred_username', '')
+    key = f'throttle:{endpoint}:{hashlib.sha256(subject.encode()).hexdigest()[:32]}'
+    cache = caches[getattr(settings, 'WORKFLOW_THROTTLE_CACHE', 'default')]
+
+    if rule.get('rate'):
+        retry_after = _take_token(cache, key + ':bucket', rule, time.time())
+        if retry_after is not None:
+            ADMISSION_REJECTED.inc(endpoint or 'unmatched', 'rate')
+            return retry_after, None
+    if rule.get('concurrency'):
+        if not _enter(cache, key + ':active', rule['concurrency']):
+            ADMISSION_REJECTED.inc(endpoint or 'unmatched', 'concurrency')
+            return 1, None
+        return None, lambda: _leave(cache, key + ':active')
+    return None, _no_op
+
+
+def release_when_sent(response, release):
+    """Call ``release`` once ``response`` is sent: now, or when the server closes a streaming response.
+
+    A streamed export is still running after its view returned, so it holds
+    its concurrency slot until then.
+    """
+    if not response.streaming:
+        release()
+        return response
+    close = response.close
+
+    def close_and_release():
+        response.close = close
+        try:
+            close()
+        finally:
+            release()
+    response.close = close_and_release
+    return response
+
+
+def throttled(retry_after):
+    """Body of a 429; send it with ``Retry-After: retry_after``."""
+    return {"detail": f"Request was throttled. Expected available in {retry_after} seconds."}
+
+
+class LatencyWindow:
+    """Latencies of the requests finished in the last ``seconds``, with their p99.
+
+    The p99 is recomputed at most once per ``refresh`` seconds, and is None
+    until ``min_samples`` requests are in the window.
+    """
+
+    def __init__(self, seconds=10, max_samples=5000, min_samples=20, refresh=1.0):
+        self.seconds = seconds
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self._p99 = None
+        self._computed_at = -math.inf
+
+    def add(self, elapsed, now=None):
+        with self._lock:
+            self._samples.append((now if now is not None else time.monotonic(), elapsed))
+
+    def p99(self, now=None):
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            if now - self._computed_at < self.refresh:
+                return self._p99
+            while self._samples and self._samples[0][0] < now - self.seconds:
+                self._samples.popleft()
+            latencies = sorted(elapsed for _, elapsed in self._samples)
+            self._computed_at = now
+            self._p99 = latencies[int(0.99 * (len(latencies) - 1))] if len(latencies) >= self.min_samples else None
+            return self._p99
+
+
+class LoadSheddingMiddleware:
+    """Rejects API reads, then writes, with 503 while recent p99 latency is too high. Sync and async capable.
+
+    Shed requests are not timed, so once the slow ones leave the window requests are let through again.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        threshold_ms = getattr(settings, 'WORKFLOW_SHED_P99_MS', None)
+        if not threshold_ms:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = threshold_ms / 1000
+        self.write_threshold = self.threshold * getattr(settings, 'WORKFLOW_SHED_WRITE_FACTOR', 2)
+        self.window = LatencyWindow(getattr(settings, 'WORKFLOW_SHED_WINDOW_SECONDS', 10))
+        self._async = asyncio.iscoroutinefunction(get_response)
+        if self._async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # how Django detects async middleware
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        if not request.path.startswith('/api/'):
+            return self.get_response(request)
+        if self.shed(request):
+            return self._rejected(request)
+        started = time.monotonic()
+        response = self.get_response(request)
+        self.window.add(time.monotonic() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not request.path.startswith('/api/'):
+            return await self.get_response(request)
+        if self.shed(request):
+            return self._rejected(request)
+        started = time.monotonic()
+        response = await self.get_response(request)
+        self.window.add(time.monotonic() - started)
+        return response
+
+    def shed(self, request):
+        p99 = self.window.p99()
+        if p99 is None or p99 <= self.threshold:
+            return False
+        return request.method in READ_METHODS or p99 > self.write_threshold
+
+    def _rejected(self, request):
+        try:
+            request.resolver_match = resolve(request.path_info)  # so the metrics name the endpoint
+            endpoint = request.resolver_match.url_name or request.resolver_match.route
+        except Resolver404:
+            endpoint = 'unmatched'
+        ADMISSION_REJECTED.inc(endpoint, 'shed')
+        # By then the requests that made p99 too high have left the window.
+        return JsonResponse({"detail": "Server is overloaded, retry later."}, status=503,
+                            headers={'Retry-After': str(math.ceil(self.window.seconds))})
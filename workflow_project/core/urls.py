@@ -1,8 +1,11 @@
 from django.urls import path
 from .views import (
-    create_form_template, create_workflow_definition, submit_form, transition_workflow,
+    create_form_template, create_workflow_definition, submit_form, bulk_submit_forms,
+    transition_workflow, bulk_transition_workflow,
     list_form_templates, list_workflows, list_user_submissions,
-    list_pending_approvals, get_available_transitions, update_form_template, update_workflow_definition
+    list_pending_approvals, get_available_transitions, update_form_template, update_workflow_definition,
+    submission_history, list_workflow_events, search_submissions, export_submissions, workflow_analytics,
+    create_stream_ticket
 )
 
 urlpatterns = [
@@ -11,8 +14,16 @@ urlpatterns = [
     path('workflow-definition/', create_workflow_definition, name='create_workflow_definition'),
     path('workflow-definition/<int:workflow_id>/', update_workflow_definition, name='update_workflow_definition'),
     path('submit-form/', submit_form, name='submit_form'),
+    path('submissions/', search_submissions, name='search_submissions'),  # ?form_template=&state=&data.<field>__gt=
+    path('submissions/export.<str:export_format>', export_submissions, name='export_submissions'),  # Admin, csv | ndjson
+    path('submissions/bulk/', bulk_submit_forms, name='bulk_submit_forms'),  # Admin, NDJSON body
     path('transition/', transition_workflow, name='transition_workflow'),
+    path('transitions/bulk/', bulk_transition_workflow, name='bulk_transition_workflow'),
     path('transitions/<int:submission_id>/', get_available_transitions, name='get_available_transitions'),
+    path('submissions/<int:submission_id>/history/', submission_history, name='submission_history'),
+    path('events/', list_workflow_events, name='list_workflow_events'),  # Admin, ?actor=&since=&until=
+    path('stream/ticket/', create_stream_ticket, name='create_stream_ticket'),  # for EventSource on /api/stream/
+    path('analytics/', workflow_analytics, name='workflow_analytics'),  # Admin & Manager, ?form_template=&since=&until=
 
     path('form-templates/', list_form_templates, name='list_form_templates'),  # Admin & Employee
     path('workflows/', list_workflows, name='list_workflows'),                  # Admin
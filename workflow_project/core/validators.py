@@ -0,0 +1,247 @@
+import datetime
+import logging
+import re
+import threading
+
+# Compiled validators keyed by template id; each entry remembers the template
+# version it was built from so an edited template is recompiled on next use.
+_validators = {}
+_lock = threading.Lock()
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaError(ValueError):
+    """Raised when a FormTemplate schema cannot be compiled."""
+
+
+def _is_empty(value):
+    return value is None or value == '' or value == [] or value == {}
+
+
+def _check_text(value):
+    if not isinstance(value, str):
+        return "must be a string"
+
+
+def _check_number(value):
+    if isinstance(value, bool):
+        return "must be a number"
+    if isinstance(value, (int, float)):
+        return None
+    if isinstance(value, str):
+        try:
+            float(value)
+            return None
+        except ValueError:
+            pass
+    return "must be a number"
+
+
+def _check_integer(value):
+    if isinstance(value, bool):
+        return "must be an integer"
+    if isinstance(value, int):
+        return None
+    if isinstance(value, str) and value.strip().lstrip('+-').isdigit():
+        return None
+    return "must be an integer"
+
+
+def _check_date(value):
+    if isinstance(value, str):
+        try:
+            datetime.date.fromisoformat(value)
+            return None
+        except ValueError:
+            pass
+    return "must be a date (YYYY-MM-DD)"
+
+
+def _check_email(value):
+    if not isinstance(value, str) or not EMAIL_RE.match(value):
+        return "must be an email address"
+
+
+def _check_boolean(value):
+    if not isinstance(value, bool) and value not in ('true', 'false'):
+        return "must be true or false"
+
+
+TYPE_CHECKS = {
+    'text': _check_text,
+    'string': _check_text,
+    'textarea': _check_text,
+    'number': _check_number,
+    'integer': _check_integer,
+    'date': _check_date,
+    'email': _check_email,
+    'boolean': _check_boolean,
+    'checkbox': _check_boolean,
+}
+
+
+def _as_number(value):
+    return float(value) if isinstance(value, str) else value
+
+
+def _is_bound(value, kind):
+    return value is None or (isinstance(value, kind) and not isinstance(value, bool))
+
+
+class FieldValidator:
+    """The checks of one schema field.
+
+    With ``strict`` a constraint that cannot apply (``min`` on a text field, a
+    bad pattern, ...) raises SchemaError; otherwise it is logged and skipped,
+    so templates saved before constraints were checked keep accepting
+    submissions.
+    """
+    __slots__ = ('name', 'required', 'checks')
+
+    def __init__(self, spec, strict=False):
+        if not isinstance(spec, dict) or not isinstance(spec.get('name'), str) or not spec['name']:
+            raise SchemaError(f"Every field needs a non-empty 'name': {spec!r}")
+        self.name = spec['name']
+        self.required = bool(spec.get('required'))
+        self.checks = []
+
+        def unsupported(message):
+            if strict:
+                raise SchemaError(f"'{self.name}': {message}")
+            logger.warning("Ignoring a constraint of field '%s': %s", self.name, message)
+
+        field_type = spec.get('type', 'text')
+        type_check = TYPE_CHECKS.get(field_type)
+        if type_check is not None:
+            self.checks.append(type_check)
+
+        choices = spec.get('enum', spec.get('options'))
+        if choices is not None:
+            if not isinstance(choices, list):
+                unsupported("enum must be a list")
+            else:
+                allowed = set(map(str, choices))
+                self.checks.append(
+                    lambda value: None if str(value) in allowed else f"must be one of {', '.join(map(str, choices))}"
+                )
+
+        min_length, max_length = spec.get('min_length'), spec.get('max_length')
+        if min_length is not None or max_length is not None:
+            if not (_is_bound(min_length, int) and _is_bound(max_length, int)):
+                unsupported("min_length/max_length must be integers")
+            else:
+                self.checks.append(self._length_check(min_length, max_length))
+
+        minimum, maximum = spec.get('min'), spec.get('max')
+        if minimum is not None or maximum is not None:
+            if field_type not in ('number', 'integer'):
+                unsupported("min/max only apply to number fields")
+            elif not (_is_bound(minimum, (int, float)) and _is_bound(maximum, (int, float))):
+                unsupported("min/max must be numbers")
+            else:
+                self.checks.append(self._range_check(minimum, maximum))
+
+        pattern = spec.get('pattern')
+        if pattern is not None:
+            try:
+                regex = re.compile(pattern)
+            except (re.error, TypeError) as e:
+                unsupported(f"invalid pattern: {e}")
+            else:
+                self.checks.append(
+                    lambda value: None if isinstance(value, str) and regex.fullmatch(value) else f"must match {pattern}"
+                )
+
+    @staticmethod
+    def _length_check(min_length, max_length):
+        def check(value):
+            if not isinstance(value, str):
+                return None
+            if min_length is not None and len(value) < min_length:
+                return f"must be at least {min_length} characters"
+            if max_length is not None and len(value) > max_length:
+                return f"must be at most {max_length} characters"
+        return check
+
+    @staticmethod
+    def _range_check(minimum, maximum):
+        def check(value):
+            try:
+                number = _as_number(value)
+            except (TypeError, ValueError):
+                return None  # reported by the type check
+            if minimum is not None and number < minimum:
+                return f"must be at least {minimum}"
+            if maximum is not None and number > maximum:
+                return f"must be at most {maximum}"
+        return check
+
+
+class FormValidator:
+    """A FormTemplate schema compiled into per-field checks.
+
+    ``validate`` runs every check in one pass and returns ``{field: [errors]}``,
+    empty when the data is valid. Schemas are checked ``strict``ly when a
+    template is saved; stored ones are compiled leniently (see FieldValidator).
+    """
+
+    def __init__(self, schema, strict=False):
+        if not isinstance(schema, dict):
+            raise SchemaError("Schema must be an object")
+        fields = schema.get('fields', [])
+        if not isinstance(fields, list):
+            raise SchemaError("'fields' must be a list")
+        self.fields = [FieldValidator(spec, strict) for spec in fields]
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            return {'data': ["must be an object"]}
+        errors = {}
+        for field in self.fields:
+            value = data.get(field.name)
+            if _is_empty(value):
+                if field.required:
+                    errors[field.name] = ["This field is required."]
+                continue
+            for check in field.checks:
+                message = check(value)
+                if message:
+                    errors.setdefault(field.name, []).append(message)
+        return errors
+
+
+def format_errors(errors):
+    """One-line summary in the form the submit endpoints have always returned."""
+    missing = [name for name, messages in errors.items() if "This field is required." in messages]
+    invalid = [f"{name} {'; '.join(messages)}" for name, messages in errors.items() if name not in missing]
+    parts = []
+    if missing:
+        parts.append(f"Missing required fields: {', '.join(missing)}")
+    if invalid:
+        parts.append(f"Invalid fields: {', '.join(invalid)}")
+    return '. '.join(parts)
+
+
+def get_validator(template):
+    """Return the compiled validator for ``template``, compiling it on first use."""
+    key = (template.version, template.created_at)
+    cached = _validators.get(template.id)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    validator = FormValidator(template.schema)
+    with _lock:
+        _validators[template.id] = (key, validator)
+    return validator
+
+
+def forget_validator(template_id):
+    with _lock:
+        _validators.pop(template_id, None)
+
+
+def clear_validators():
+    with _lock:
+        _validators.clear()
@@ -1,21 +1,122 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework import status
 from .models import (
-    FormTemplate, WorkflowDefinition, FormSubmission, WorkflowInstance, Transition
+    FormTemplate, WorkflowDefinition, FormSubmission, WorkflowInstance, WorkflowInboxEntry,
+    WorkflowEvent, ArchivedInstance, ArchivedEvent
 )
 from .serializers import (
     FormTemplateSerializer, WorkflowDefinitionSerializer,
-    FormSubmissionSerializer, WorkflowInstanceSerializer, TransitionSerializer
+    FormSubmissionSerializer, WorkflowInstanceSerializer, TransitionSerializer, WorkflowEventSerializer,
+    ArchivedInstanceSerializer
+)
+from . import analytics
+from .auth.decorators import async_keycloak_required, keycloak_required
+from .db import read_alias, read_replica
+from .engine import TransitionError, apply_bulk_transitions, apply_transition, user_roles_of
+from .etags import add_validators, catalog_stamp, inbox_stamp, is_fresh, make_etag
+from .export import EXPORT_FORMATS
+from .idempotency import idempotent
+from .inbox import sync_inbox
+from .ingest import ingest_submissions
+from .metrics import timed
+from .notify import instance_message, notify_instances
+from .sse import issue_ticket
+from .pagination import KeysetPagination
+from .renderers import render_json
+from .rows import row_serializer
+from .search import SearchError, filter_instances, visible_to
+from .sla import arm_timers
+from .state_machine import (
+    create_version, get_compiled_version_or_404, get_compiled_workflow_or_404, with_current_version,
 )
-from .auth.decorators import keycloak_required
+from .validators import SchemaError, forget_validator, format_errors, get_validator
 from django.db.models import Q
-
+from django.utils.dateparse import parse_datetime
+
+
+
+def projection(request):
+    """Serializer kwargs for the ``?fields=a,b`` and ``?expand=form_template`` query params."""
+    kwargs = {}
+    for param in ('fields', 'expand'):
+        value = request.query_params.get(param)
+        if value is not None:
+            kwargs[param] = {name.strip() for name in value.split(',') if name.strip()}
+    return kwargs
+
+
+def paginated(request, queryset, serializer_class, ordering=None, **serializer_kwargs):
+    paginator = KeysetPagination(ordering)
+    page = paginator.paginate_queryset(queryset, request)
+    serializer = serializer_class(page, many=True, **serializer_kwargs)
+    with timed('serializer'):
+        data = serializer.data
+    return paginator.get_paginated_response(data)
+
+
+def async_api_view(methods):
+    """Async counterpart of ``@api_view`` for read endpoints served under ASGI.
+
+    The view runs on the event loop; ORM work goes through ``sync_to_async``
+    (Django 3.2 has no async ORM) and responses are plain JSON. Like
+    ``@api_view``, HEAD is answered as GET without the body and OPTIONS with
+    the allowed methods.
+    """
+    allowed = [*methods, *(['HEAD'] if 'GET' in methods else []), 'OPTIONS']
+    allow = ', '.join(allowed)
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(request, *args, **kwargs):
+            if request.method == 'OPTIONS':
+                return HttpResponse(headers={'Allow': allow})
+            if request.method not in allowed:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405,
+                                    headers={'Allow': allow})
+            try:
+                response = await func(request, *args, **kwargs)
+            except Http404:
+                response = JsonResponse({"detail": "Not found."}, status=404)
+            except APIException as e:
+                response = JsonResponse({"detail": e.detail}, status=e.status_code)
+            if request.method == 'HEAD' and not response.streaming:
+                response['Content-Length'] = len(response.content)
+                response.content = b''
+            return response
+        return wrapper
+    return decorator
+
+
+def json_paginated(request, queryset, serializer_class, ordering=None, **serializer_kwargs):
+    """``paginated`` for async views: same body and headers, as a plain HttpResponse. Call via sync_to_async.
+
+    Serializers that ``row_serializer`` can compile are served from ``.values()`` rows, skipping model
+    instances and serializer objects altogether.
+    """
+    request = Request(request)
+    paginator = KeysetPagination(ordering)
+    kwargs = {**projection(request), **serializer_kwargs}
+    rows = row_serializer(serializer_class, **kwargs)
+    if rows is not None:
+        queryset = queryset.values(*rows.columns, *(field.lstrip('-') for field in paginator.ordering))
+    page = paginator.paginate_queryset(queryset, request)
+    with timed('serializer'):
+        data = rows.serialize(page) if rows is not None else serializer_class(page, many=True, **kwargs).data
+    return HttpResponse(render_json(data), content_type='application/json', headers=paginator.get_paginated_headers())
 
 
 @api_view(['POST'])
 @keycloak_required(required_roles=['Admin'])  # Only Admins can create templates
+@idempotent()
 def create_form_template(request):
     serializer = FormTemplateSerializer(data=request.data)
     if serializer.is_valid():
@@ -26,6 +127,7 @@ def create_form_template(request):
 
 @api_view(['POST'])
 @keycloak_required(required_roles=['Admin'])  # Only Admins can define workflows
+@idempotent()
 def create_workflow_definition(request):
     serializer = WorkflowDefinitionSerializer(data=request.data)
     if serializer.is_valid():
@@ -36,6 +138,7 @@ def create_workflow_definition(request):
 
 @api_view(['POST'])
 @keycloak_required()
+@idempotent()
 def submit_form(request):
     user_info = request.user_info
     submitted_by = user_info.get("preferred_username", "anonymous")
@@ -46,104 +149,124 @@ def submit_form(request):
     form_template_id = data.get("form_template")
     form_data = data.get("data", {})
 
-  
-    template = get_object_or_404(FormTemplate, id=form_template_id)
-    # print(f"Form template: {template}",template.schema)  # Debugging line
-  
-    field_definitions = template.schema.get("fields", [])
-    required_fields = [f["name"] for f in field_definitions if f.get("required")]
-    print(f"Required fields: {required_fields}")  # Debugging line
-
-    missing_fields = [field for field in required_fields if field not in form_data or not form_data[field]]
-    print(f"Missing fields: {missing_fields}")  # Debugging line
-    if missing_fields:
-        return Response(
-            {"error": f"Missing required fields: {', '.join(missing_fields)}"},
-            status=400
-        )
+    template = get_object_or_404(with_current_version(FormTemplate.objects), id=form_template_id)
+    try:
+        errors = get_validator(template).validate(form_data)
+    except SchemaError as e:
+        return Response({"error": f"Form template schema is invalid: {e}"}, status=400)
+    if errors:
+        return Response({"error": format_errors(errors), "fields": errors}, status=400)
 
     serializer = FormSubmissionSerializer(data=data)
     if serializer.is_valid():
         submission = serializer.save()
-        # print(f"Form submission created: {submission}",submission.form_template)  # Debugging line
-        workflow = get_object_or_404(WorkflowDefinition, form_template=submission.form_template)
-        initial_state = workflow.states[0] if workflow.states else "Draft"
+        workflow = get_compiled_workflow_or_404(submission.form_template_id, template.current_version_id)
+        initial_state = workflow.initial_state
 
-        WorkflowInstance.objects.create(submission=submission, current_state=initial_state)
+        instance = WorkflowInstance.objects.create(
+            submission=submission, workflow_version_id=workflow.version_id, current_state=initial_state,
+            is_open=not workflow.is_terminal(initial_state),
+        )
+        roles = workflow.actionable_roles(initial_state)
+        sync_inbox(instance, roles)
+        arm_timers({instance.id: (workflow, initial_state)}, replace=False)
+        notify_instances([instance_message(instance, submitted_by, (), roles)])
 
         return Response({"message": "Form submitted", "submission_id": submission.id}, status=201)
-    print("Serializer errors:", serializer.errors)
     return Response(serializer.errors, status=400)
 
 
 
+@api_view(['POST'])
+@keycloak_required(required_roles=['Admin'])
+@idempotent(streamed=True)
+def bulk_submit_forms(request):
+    # Read the NDJSON body line by line instead of through request.data so
+    # large imports are never buffered in memory.
+    stream = request.stream
+    lines = iter(stream.readline, b'') if stream is not None else []
+    report = ingest_submissions(
+        lines,
+        submitted_by=request.user_info.get("preferred_username", "anonymous"),
+        chunk_size=settings.WORKFLOW_INGEST_CHUNK_SIZE,
+    )
+    return Response(report.as_dict(), status=200)
+
+
 @api_view(['POST'])
 @keycloak_required()
+@idempotent()
 def transition_workflow(request):
     submission_id = request.data.get("submission_id")
     target_state = request.data.get("next_state")
-    user_roles = request.user_info.get("realm_access", {}).get("roles", [])
-    username = request.user_info.get("preferred_username")
+    expected_state = request.data.get("expected_state")
 
-    instance = get_object_or_404(WorkflowInstance, submission_id=submission_id)
-    current_state = instance.current_state
-    workflow = get_object_or_404(WorkflowDefinition, form_template=instance.submission.form_template)
+    try:
+        result = apply_transition(submission_id, target_state, request.user_info, expected_state)
+    except TransitionError as e:
+        return Response(e.as_response_data(), status=e.status_code)
+    return Response({"message": result.message}, status=200)
 
-    transition = workflow.transitions.filter(from_state=current_state, to_state=target_state).first()
-    if not transition:
-        return Response({"error": "Invalid transition"}, status=400)
 
-    allowed_roles = transition.allowed_roles
-    logical_type = transition.logical_type.upper()
-
-    if not any(role in user_roles for role in allowed_roles):
-        return Response({"error": "Permission denied. Role not allowed."}, status=403)
-
-    # If transition already done
-    if instance.current_state != current_state:
-        return Response({"message": "Transition already completed by another role."}, status=403)
-
-    approvals = instance.partial_approvals.get(target_state, [])
-    if username in approvals:
-        return Response({"message": "You have already approved this transition."}, status=200)
-
-    approvals.append(username)
-    instance.partial_approvals[target_state] = approvals
-
-    if logical_type == "AND":
-        role_approvers = [role for role in allowed_roles if any(role in user_roles for role in allowed_roles)]
-        if len(approvals) >= len(set(allowed_roles)):
-            instance.current_state = target_state
-            instance.partial_approvals.pop(target_state)
-    else:  # OR
-        instance.current_state = target_state
-        instance.partial_approvals.pop(target_state)
-
-    instance.save()
-    return Response({"message": f"Transitioned to {instance.current_state}"}, status=200)
+@api_view(['POST'])
+@keycloak_required()
+@idempotent()
+def bulk_transition_workflow(request):
+    items = request.data if isinstance(request.data, list) else request.data.get("items")
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return Response({"error": "Expected a list of {submission_id, next_state, expected_state} items."},
+                        status=400)
+    if len(items) > settings.WORKFLOW_BULK_TRANSITION_LIMIT:
+        return Response({"error": f"At most {settings.WORKFLOW_BULK_TRANSITION_LIMIT} items per request."},
+                        status=400)
+    if not all(isinstance(item.get("submission_id"), int) for item in items):
+        return Response({"error": "Every item needs an integer submission_id."}, status=400)
+
+    results = apply_bulk_transitions(items, request.user_info)
+    return Response({"results": results}, status=200)
 
 
 @api_view(['GET'])
 @keycloak_required()
+@read_replica
 def list_form_templates(request):
     templates = FormTemplate.objects.all()
-    serializer = FormTemplateSerializer(templates, many=True)
-    return Response(serializer.data)
+    stamp = catalog_stamp(templates)
+    etag = make_etag(request, 'form-templates', stamp, request.accepted_renderer.format)
+    if is_fresh(request, etag):
+        return add_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag, stamp['last_change'])
+    response = paginated(request, templates, FormTemplateSerializer, ordering=('id',), **projection(request))
+    return add_validators(response, etag, stamp['last_change'])
 
 @api_view(['GET'])
 @keycloak_required(required_roles=['Admin'])
+@read_replica
 def list_workflows(request):
-    workflows = WorkflowDefinition.objects.all()
-    serializer = WorkflowDefinitionSerializer(workflows, many=True)
-    return Response(serializer.data)
-
-@api_view(['GET'])
-@keycloak_required()
-def list_user_submissions(request):
+    workflows = WorkflowDefinition.objects.select_related('current_version').prefetch_related(
+        'current_version__transitions'
+    )
+    stamp = catalog_stamp(WorkflowDefinition.objects.all())
+    etag = make_etag(request, 'workflows', stamp, request.accepted_renderer.format)
+    if is_fresh(request, etag):
+        return add_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag, stamp['last_change'])
+    response = paginated(request, workflows, WorkflowDefinitionSerializer, ordering=('id',), **projection(request))
+    return add_validators(response, etag, stamp['last_change'])
+
+@async_api_view(['GET'])
+@async_keycloak_required()
+@read_replica
+async def list_user_submissions(request):
     username = request.user_info.get("preferred_username")
-    instances = WorkflowInstance.objects.filter(submission__submitted_by=username)
-    serializer = WorkflowInstanceSerializer(instances, many=True)
-    return Response(serializer.data)
+    if request.GET.get('archived') in ('1', 'true'):
+        # Closed submissions moved out of the live tables by manage.py archive_instances.
+        archived = ArchivedInstance.objects.filter(submitted_by=username)
+        return await sync_to_async(json_paginated)(
+            request, archived, ArchivedInstanceSerializer, ordering=('-updated_at', '-submission_id')
+        )
+    instances = WorkflowInstance.objects.filter(submission__submitted_by=username).select_related(
+        'submission__form_template'
+    )
+    return await sync_to_async(json_paginated)(request, instances, WorkflowInstanceSerializer)
 
 # @api_view(['GET'])
 # @keycloak_required()
@@ -152,72 +275,181 @@ def list_user_submissions(request):
 #     serializer = FormTemplateSerializer(templates, many=True)
 #     return Response(serializer.data)
 
-@api_view(['GET'])
-@keycloak_required()
-def list_pending_approvals(request):
+def pending_approvals_response(request, user_roles):
+    # Answers revalidations from the inbox stamp alone, before touching the instances.
+    stamp = inbox_stamp(user_roles)
+    etag = make_etag(request, 'pending-approvals', stamp, sorted(user_roles))
+    if is_fresh(request, etag):
+        return add_validators(HttpResponseNotModified(), etag)
+    actionable = WorkflowInboxEntry.objects.filter(role__in=user_roles).values('instance_id')
+    pending_instances = WorkflowInstance.objects.filter(id__in=actionable).select_related(
+        'submission__form_template'
+    )
+    return add_validators(json_paginated(request, pending_instances, WorkflowInstanceSerializer), etag)
+
+@async_api_view(['GET'])
+@async_keycloak_required()
+@read_replica
+async def list_pending_approvals(request):
     user_roles = request.user_info.get("realm_access", {}).get("roles", [])
-    pending_instances = []
+    return await sync_to_async(pending_approvals_response)(request, user_roles)
 
-    for instance in WorkflowInstance.objects.all():
-        workflow = get_object_or_404(WorkflowDefinition, form_template=instance.submission.form_template)
-        transitions = workflow.transitions.filter(from_state=instance.current_state)
+def available_transitions(submission_id, user_roles):
+    instance = get_object_or_404(WorkflowInstance, submission_id=submission_id)
+    workflow = get_compiled_version_or_404(instance.workflow_version_id)
+    # Transitions out of the current state that the user's roles (or an SLA escalation) allow
+    escalated = {to_state for to_state, roles in instance.escalations.items() if set(roles) & set(user_roles)}
+    return [
+        transition.as_dict()
+        for transition in workflow.outgoing.get(instance.current_state, ())
+        if transition.allows(user_roles) or transition.to_state in escalated
+    ]
+
+@async_api_view(['GET'])
+@async_keycloak_required()
+@read_replica
+async def get_available_transitions(request, submission_id):
+    user_roles = request.user_info.get("realm_access", {}).get("roles", [])
+    transitions = await sync_to_async(available_transitions)(submission_id, user_roles)
+    return JsonResponse(transitions, safe=False)
 
-        for t in transitions:
-            if any(role in user_roles for role in t.allowed_roles):
-                pending_instances.append(instance)
-                break
+@api_view(['POST'])
+@keycloak_required()
+def create_stream_ticket(request):
+    """A short-lived ticket for ``GET /api/stream/?ticket=``, so the access token stays out of URLs."""
+    return Response({"ticket": issue_ticket(request.user_info),
+                     "expires_in": settings.WORKFLOW_STREAM_TICKET_TTL}, status=201)
 
-    serializer = WorkflowInstanceSerializer(pending_instances, many=True)
-    return Response(serializer.data)
 
 @api_view(['GET'])
 @keycloak_required()
-def get_available_transitions(request, submission_id):
-    user_roles = request.user_info.get("realm_access", {}).get("roles", [])
-    
-    # Get the workflow instance
-    instance = get_object_or_404(WorkflowInstance, submission_id=submission_id)
-    workflow = get_object_or_404(WorkflowDefinition, form_template=instance.submission.form_template)
-    
-    # Get all possible transitions from current state
-    transitions = workflow.transitions.filter(from_state=instance.current_state)
-    
-    # Filter transitions based on user roles
-    available_transitions = []
-    for transition in transitions:
-        if any(role in user_roles for role in transition.allowed_roles):
-            available_transitions.append({
-                'from_state': transition.from_state,
-                'to_state': transition.to_state,
-                'allowed_roles': transition.allowed_roles,
-                'logical_type': transition.logical_type
-            })
-    
-    return Response(available_transitions)
+@read_replica
+def submission_history(request, submission_id):
+    # Visible to Admins, the submitter and anyone holding a role in the workflow.
+    try:
+        instance = WorkflowInstance.objects.select_related('submission').get(submission_id=submission_id)
+        submitted_by = instance.submission.submitted_by
+        events = WorkflowEvent.objects.filter(instance=instance)
+    except WorkflowInstance.DoesNotExist:
+        instance = get_object_or_404(ArchivedInstance, submission_id=submission_id)  # archived: one query more
+        submitted_by = instance.submitted_by
+        events = ArchivedEvent.objects.filter(instance=instance)
+    user_roles = user_roles_of(request.user_info)
+    if 'Admin' not in user_roles and submitted_by != request.user_info.get("preferred_username"):
+        workflow = get_compiled_version_or_404(instance.workflow_version_id)
+        if not any(role in workflow.by_role for role in user_roles):
+            return Response({"error": "Permission denied."}, status=403)
+
+    events = events.select_related('instance')
+    return paginated(request, events, WorkflowEventSerializer, ordering=('id',), **projection(request))
+
+@api_view(['GET'])
+@keycloak_required(required_roles=['Admin'])
+@read_replica
+def list_workflow_events(request):
+    events = WorkflowEvent.objects.select_related('instance')
+    actor = request.query_params.get('actor')
+    if actor:
+        events = events.filter(actor=actor)
+    for param, lookup in (('since', 'created_at__gte'), ('until', 'created_at__lt')):
+        value = request.query_params.get(param)
+        if value:
+            try:
+                moment = parse_datetime(value)
+            except ValueError:
+                moment = None
+            if moment is None:
+                return Response({"error": f"'{param}' must be an ISO 8601 datetime."}, status=400)
+            events = events.filter(**{lookup: moment})
+    return paginated(request, events, WorkflowEventSerializer, ordering=('-created_at', '-id'), **projection(request))
+
+@api_view(['GET'])
+@keycloak_required()
+@read_replica
+def search_submissions(request):
+    # Admins search everything; others their own submissions and the workflows they hold a role in.
+    instances = WorkflowInstance.objects.select_related('submission__form_template')
+    user_roles = user_roles_of(request.user_info)
+    if 'Admin' not in user_roles:
+        instances = instances.filter(visible_to(request.user_info.get("preferred_username"), user_roles))
+    try:
+        instances = filter_instances(instances, request.query_params)
+    except SearchError as e:
+        return Response({"error": str(e)}, status=400)
+    return paginated(request, instances, WorkflowInstanceSerializer, **projection(request))
+
+@api_view(['GET'])
+@keycloak_required(required_roles=['Admin', 'Manager'])
+@read_replica
+def workflow_analytics(request):
+    # Served from the rollups of core.analytics, as of their last fold.
+    form_template = request.query_params.get('form_template')
+    if form_template and not form_template.isdigit():
+        return Response({"error": "'form_template' must be an id."}, status=400)
+    window = {}
+    for param in ('since', 'until'):
+        value = request.query_params.get(param)
+        if value:
+            try:
+                window[param] = parse_datetime(value)
+            except ValueError:
+                window[param] = None
+            if window[param] is None:
+                return Response({"error": f"'{param}' must be an ISO 8601 datetime."}, status=400)
+    return Response(analytics.report(int(form_template) if form_template else None, **window))
+
+@api_view(['GET'])
+@keycloak_required(required_roles=['Admin'])
+@read_replica
+def export_submissions(request, export_format):
+    # Takes the same filters as search_submissions; rows are streamed, never held in memory. The rows
+    # are read after the view returns, outside read_replica, hence the explicit using().
+    if export_format not in EXPORT_FORMATS:
+        return Response({"error": f"Unknown export format, use one of: {', '.join(EXPORT_FORMATS)}."}, status=404)
+    try:
+        instances = filter_instances(WorkflowInstance.objects.using(read_alias()), request.query_params)
+    except SearchError as e:
+        return Response({"error": str(e)}, status=400)
+    content_type, chunks = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(
+        chunks(instances, request.query_params.get('form_template'), settings.WORKFLOW_EXPORT_CHUNK_SIZE),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="submissions.{export_format}"'
+    return response
 
 @api_view(['PUT'])
 @keycloak_required(required_roles=['Admin'])
+@idempotent()
 def update_form_template(request, template_id):
     template = get_object_or_404(FormTemplate, id=template_id)
     serializer = FormTemplateSerializer(template, data=request.data, partial=True)
     if serializer.is_valid():
-        serializer.save()
+        template = serializer.save(version=template.version + 1)
+        forget_validator(template.id)
         return Response(serializer.data)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(['PUT'])
 @keycloak_required(required_roles=['Admin'])
+@idempotent()
 def update_workflow_definition(request, workflow_id):
+    # Publishes a new version; instances already running stay on the version they started on.
     workflow = get_object_or_404(WorkflowDefinition, id=workflow_id)
     transitions_data = request.data.pop('transitions', None)
     serializer = WorkflowDefinitionSerializer(workflow, data=request.data, partial=True)
-    if serializer.is_valid():
-        workflow = serializer.save()
-        if transitions_data is not None:
-            # Remove old transitions
-            workflow.transitions.all().delete()
-            # Add new transitions
-            for trans_data in transitions_data:
-                Transition.objects.create(workflow=workflow, **trans_data)
-        return Response(WorkflowDefinitionSerializer(workflow).data)
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    transitions = TransitionSerializer(data=transitions_data or [], many=True)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    if not transitions.is_valid():
+        return Response({'transitions': transitions.errors}, status=status.HTTP_400_BAD_REQUEST)
+    form_template = serializer.validated_data.get('form_template')
+    if form_template is not None and form_template.id != workflow.form_template_id:
+        return Response({'form_template': ["A workflow cannot move to another form template."]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    create_version(
+        workflow, serializer.validated_data.get('states'),
+        transitions.validated_data if transitions_data is not None else None,
+    )
+    return Response(WorkflowDefinitionSerializer(workflow).data)
@@ -10,7 +10,14 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'workflow_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from core.sse import route  # noqa: E402  (needs the app registry loaded above)
+
+# /api/stream/ (Server-Sent Events) is served outside Django's request cycle;
+# exports stream from the database, so they run through the WSGI handler in a thread.
+application = route(django_application, get_wsgi_application(), wsgi_prefixes=['/api/submissions/export.'])
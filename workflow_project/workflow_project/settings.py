@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -43,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',  # first, so it times the whole request
+    'core.throttling.LoadSheddingMiddleware',  # only when WORKFLOW_SHED_P99_MS is set
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,14 +82,38 @@ WSGI_APPLICATION = 'workflow_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# Every value can be overridden from the environment, e.g.
+# DB_ENGINE=django.db.backends.sqlite3 DB_NAME=:memory: python manage.py test
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'workflowdb',
-        'USER': 'postgres',
-        'PASSWORD': 'Sashank@369',
-        'HOST': 'localhost',
-        'PORT': '5432',
+        'ENGINE': os.environ.get('DB_ENGINE', 'django.db.backends.postgresql'),
+        'NAME': os.environ.get('DB_NAME', 'workflowdb'),
+        'USER': os.environ.get('DB_USER', 'postgres'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', 'Sashank@369'),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        # Keep connections open across requests; idle ones are pinged before reuse (core.db).
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+    }
+}
+
+# Read replicas, e.g. DB_REPLICA_HOSTS=replica1.internal,replica2.internal, become the
+# aliases replica1, replica2... with the primary's other settings. List views read from
+# them (core.db.read_replica); test runs mirror them onto the test primary.
+for number, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'HOST': host.strip(), 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['core.db.ReplicaRouter']
+
+
+# Cache
+# Compiled workflow definitions are published here so every worker notices
+# edits. Use a shared backend (Redis, Memcached) when running several workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -131,7 +160,63 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.FastJSONRenderer',  # orjson when installed, same bytes as JSONRenderer
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
 ]
-CORS_ALLOW_CREDENTIALS = True
\ No newline at end of file
+CORS_ALLOW_CREDENTIALS = True
+CORS_EXPOSE_HEADERS = ['Link', 'X-Next-Cursor', 'ETag', 'Retry-After']
+CORS_ALLOW_HEADERS = list(default_headers) + ['if-none-match']
+
+# Keycloak
+KEYCLOAK_CONFIG_URL = 'http://localhost:8080/realms/demo-realm/.well-known/openid-configuration'
+KEYCLOAK_CLIENT_ID = 'django-backend'
+KEYCLOAK_JWKS_TTL = 300  # seconds before signing keys are refreshed in the background
+KEYCLOAK_JWKS_MIN_REFETCH_INTERVAL = 10  # throttle for refetches triggered by unknown kids
+KEYCLOAK_HTTP_TIMEOUT = 5
+KEYCLOAK_TOKEN_CACHE_SIZE = 10000  # verified tokens kept in memory per process, 0 disables
+KEYCLOAK_TOKEN_CACHE_MAX_AGE = 300  # upper bound on how long a verified token is trusted
+
+# Workflow engine
+WORKFLOW_BULK_TRANSITION_LIMIT = 500  # items accepted by POST /api/transitions/bulk/
+WORKFLOW_INGEST_CHUNK_SIZE = 500  # rows per bulk_create when importing NDJSON submissions
+WORKFLOW_EXPORT_CHUNK_SIZE = 2000  # rows per cursor fetch and per streamed chunk of an export
+WORKFLOW_NOTIFY_BROKER = 'core.notify.InProcessBroker'  # or 'core.notify.PostgresBroker' with several workers
+WORKFLOW_STREAM_HEARTBEAT = 15  # seconds between keepalive comments on /api/stream/
+WORKFLOW_STREAM_TICKET_TTL = 30  # seconds a ticket from POST /api/stream/ticket/ can open a stream
+WORKFLOW_ARCHIVE_AFTER_DAYS = 90  # default age of closed instances moved by manage.py archive_instances
+WORKFLOW_ANALYTICS_LAG_SECONDS = 60  # rows younger than this wait for the next fold_analytics run
+WORKFLOW_CURRENT_VERSION_TTL = 5  # seconds a worker keeps resolving a template to the version it last saw
+
+# Idempotency-Key on POST / PUT (core.idempotency)
+WORKFLOW_IDEMPOTENCY_TTL = 24 * 3600  # seconds a key and its response are kept
+WORKFLOW_IDEMPOTENCY_WAIT_SECONDS = 5  # a retry waits this long for the first request before getting 409
+WORKFLOW_IDEMPOTENCY_LOCK_SECONDS = 60  # after this, a key still in progress is taken over (its worker died)
+WORKFLOW_IDEMPOTENCY_CACHE_SIZE = 10000  # completed responses kept in memory per process, 0 disables
+
+# Admission control (core.throttling): rules per endpoint URL name, then per role; '*' matches the rest.
+# None by default, as limits depend on the deployment, e.g.:
+#     'list_pending_approvals': {'*': {'rate': '5/s', 'burst': 20, 'concurrency': 4}},
+#     'bulk_transition_workflow': {'*': {'rate': '1/s', 'burst': 5, 'concurrency': 1}},
+#     '*': {'*': {'rate': '20/s', 'burst': 50, 'concurrency': 8}},
+WORKFLOW_THROTTLES = {}
+WORKFLOW_THROTTLE_CACHE = 'default'  # token buckets and in-flight counts; a shared backend makes limits global
+WORKFLOW_SHED_P99_MS = None  # when set, API reads get 503 while p99 latency is above this
+WORKFLOW_SHED_WRITE_FACTOR = 2  # writes are shed too above this many times WORKFLOW_SHED_P99_MS
+WORKFLOW_SHED_WINDOW_SECONDS = 10  # p99 is taken over the requests finished this recently
+
+# Metrics (GET /metrics, Prometheus text format)
+WORKFLOW_METRICS_ENABLED = True
+WORKFLOW_METRICS_SAMPLE_RATE = 1.0  # share of requests that also record DB, auth and serializer time
+WORKFLOW_SLOW_REQUEST_MS = 1000  # sampled requests slower than this are logged with their slowest SQL
+WORKFLOW_METRICS_TOKEN = None  # when set, /metrics requires "Authorization: Bearer <token>"
+
+# Read replicas and persistent connections (core.db)
+WORKFLOW_READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']  # aliases list views read from
+WORKFLOW_REPLICA_PIN_SECONDS = 5  # after a write, the writer's reads stay on the primary this long
+WORKFLOW_DB_HEALTH_CHECK_AFTER = 30  # seconds idle after which a persistent connection is pinged before reuse